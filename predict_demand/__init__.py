@@ -10,14 +10,66 @@ app.config.from_object(__name__)
 # Load default config and override config from an environment variable
 app.config.update(dict(
     DATABASE=os.path.join(app.root_path, 'predict_client_demand.db'),
+    # Every region (/api/<region>/...) other than DEFAULT_REGION (stored in DATABASE)
+    # is stored in its own database file, REGION_DATABASE with the region's name
+    DEFAULT_REGION='default',
+    REGION_DATABASE=os.path.join(app.root_path, 'regions', '%s.db'),
+    EVENT_CALENDAR=os.path.join(app.root_path, 'events.json'),
+    # Timezone (i.e. 'America/New_York') logins are binned in, as local hours, for every
+    # region (or per region in REGION_TIMEZONES).  None bins timestamps as written,
+    # ignoring their UTC offsets
+    MARKET_TIMEZONE=None,
+    REGION_TIMEZONES={},
     DEBUG=True,
     SECRET_KEY='development key',
     USERNAME='user',
-    PASSWORD='predict'
+    PASSWORD='predict',
+    JOB_WORKERS=1,
+    # Drop logins whose timestamp was already posted within the last DEDUP_WINDOW_DAYS,
+    # tracked by a Bloom filter per day of DEDUP_DAY_CAPACITY logins at DEDUP_ERROR_RATE
+    DEDUP_TIMESTAMPS=False,
+    DEDUP_WINDOW_DAYS=7,
+    DEDUP_DAY_CAPACITY=100000,
+    DEDUP_ERROR_RATE=0.001,
+    # GET /api/predict page sizes [hours], and how long the predictions version
+    # used for ETags is cached in memory [seconds]
+    API_PAGE_SIZE=168,
+    API_MAX_PAGE_SIZE=5000,
+    PREDICTION_VERSION_TTL=1.0,
+    # Maximum number of hours in one POST /api/predict/query
+    API_MAX_QUERY_HOURS=5000,
+    # Whole weeks of hourly history kept in login_history (0 keeps every hour), older
+    # hours are compacted into per-slot rollups and compressed files in ARCHIVE_FOLDER.
+    # With FIT_HOT_WINDOW, fits only read the hot window (compacted yet or not)
+    HOT_WEEKS=0,
+    ARCHIVE_FOLDER=os.path.join(app.root_path, 'archive'),
+    FIT_HOT_WINDOW=False,
+    # Fits read only the last FIT_LOOKBACK_WEEKS weeks of history (0 reads every week),
+    # with each week's regression weighted by its decay ('wls') or not ('ols')
+    FIT_LOOKBACK_WEEKS=0,
+    FIT_WEIGHTING='ols',
+    # Rows read (and encoded) at a time by the /api/export streams
+    EXPORT_BATCH_ROWS=5000,
+    # Days (or weeks) per page of the index page history
+    ROLLUP_PAGE_SIZE=28,
+    # Processes rendering plots in parallel (0 uses every core, 1 renders in-process)
+    PLOT_WORKERS=0,
+    # Images kept in memory by the plots endpoint, and how long browsers may cache them [seconds]
+    PLOT_CACHE_SIZE=64,
+    PLOT_MAX_AGE=60,
+    # Processes forecasting regions in parallel (0 uses every core, 1 forecasts in-process)
+    FORECAST_WORKERS=0,
+    # Automatic prediction refresh after new history arrives [seconds]
+    AUTO_REFRESH=True,
+    REFRESH_DEBOUNCE=10,
+    REFRESH_MIN_INTERVAL=60,
+    REFRESH_MAX_DELAY=300,
+    REFRESH_DAYS=15
 ))
 
 # [optional] Set this env variable to override config settings
 app.config.from_envvar('PREDICT_DEMAND_SETTINGS', silent=True)
 
-# Then import views
-import predict_demand.views
+# Then import views, unless running headless (runbatch.py, see demand_batch)
+if not os.environ.get('PREDICT_DEMAND_HEADLESS'):
+    import predict_demand.views
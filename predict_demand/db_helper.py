@@ -1,29 +1,164 @@
 #!/usr/bin/env python
 
 from predict_demand import app
-from flask import Flask, g
+from flask import Flask, g, has_app_context
+import os
+import glob
 import sqlite3
+import re
+import threading
 
-def connect_db():
-    """Connects to the specific database."""
+# Statements run when upgrading a database that has history but was created
+# before the given table existed, so the new table is populated from the history
+UPGRADE_BACKFILL = [
+    ('history_mad_scores', 'INSERT OR IGNORE INTO mad_dirty_slots (day_name, hour) ' + \
+        'SELECT DISTINCT day_name, hour FROM login_history'),
+    ('slot_stats', 'INSERT OR IGNORE INTO mad_dirty_slots (day_name, hour) ' + \
+        'SELECT DISTINCT day_name, hour FROM login_history'),
+    ('slot_sketches', 'INSERT OR IGNORE INTO mad_dirty_slots (day_name, hour) ' + \
+        'SELECT DISTINCT day_name, hour FROM login_history'),
+    ('daily_rollup', 'INSERT OR REPLACE INTO daily_rollup (day, num_logins, num_hours, peak_logins) ' + \
+        'SELECT substr(id,1,10), SUM(num_logins), COUNT(*), MAX(num_logins) FROM login_history ' + \
+        'GROUP BY substr(id,1,10)'),
+    ('weekly_rollup', 'INSERT OR REPLACE INTO weekly_rollup ' + \
+        '(week, num_logins, num_hours, peak_logins, num_days) ' + \
+        "SELECT date(day,'-6 days','weekday 1'), SUM(num_logins), SUM(num_hours), MAX(peak_logins), " + \
+        "COUNT(*) FROM daily_rollup GROUP BY date(day,'-6 days','weekday 1')"),
+]
+# Columns added to existing tables, (table, column, definition)
+UPGRADE_COLUMNS = [
+    ('login_predictions', 'model_version', "text not null default ''"),
+    ('jobs', 'region', "text not null default ''"),
+]
+# Region names, lowercase letters, digits, '-' and '_'.  Names of the unscoped
+# /api/<name> routes can't be used, as /api/<region>/... would be ambiguous
+REGION_NAME = re.compile(r'^[a-z0-9][a-z0-9_-]{0,31}$')
+RESERVED_REGIONS = set(['demand', 'predict', 'jobs', 'export', 'accuracy', 'regions', 'forecast',
+    'hierarchy', 'reconcile', 'reconciled', 'history', 'ledger'])
+_upgraded = set() # Databases already upgraded by this process
+_upgrade_lock = threading.Lock()
+_headless = threading.local() # Connection of each thread outside of any application context
+
+def validate_region(region):
+    """Returns the region name if it is valid, None otherwise"""
+    if region is None or not REGION_NAME.match(region) or region in RESERVED_REGIONS:
+        return None
+    return region
+
+def current_region():
+    """Returns the region of the current request or job (g.region),
+    DEFAULT_REGION if there is none"""
+    if has_app_context() and g.get('region'):
+        return g.region
+    return app.config['DEFAULT_REGION']
+
+def database_path(region=None):
+    """Returns the database file of the region (the current region if None).
+    The default region is stored in DATABASE, every other region in its own
+    REGION_DATABASE file, so regions never share tables"""
+    region = region or current_region()
+    if region == app.config['DEFAULT_REGION']:
+        return app.config['DATABASE']
+    return app.config['REGION_DATABASE'] % region
+
+def region_exists(region):
+    """Returns True if the region's database exists"""
+    return os.path.exists(database_path(region))
+
+def list_regions():
+    """Returns the sorted names of every region that has a database"""
+    regions = set([app.config['DEFAULT_REGION']])
+    prefix, suffix = app.config['REGION_DATABASE'].split('%s')
+    for path in glob.glob(prefix + '*' + suffix):
+        region = validate_region(path[len(prefix):len(path)-len(suffix)])
+        if region is not None:
+            regions.add(region)
+    return sorted(regions)
+
+def delete_region(region):
+    """Deletes the (non default) region's database file"""
+    path = database_path(region)
+    with _upgrade_lock:
+        _upgraded.discard(path)
+        for filename in (path, path + '-journal'):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+def connect_db(region=None):
+    """Connects to the specific database, of the region (the current region if None).
+    A region's database is created on first use."""
+    path = database_path(region)
+    if not os.path.isdir(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # Created by another thread in the meantime
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
     # Setting the detect_types paramater to better handle datetimes
-    rv = sqlite3.connect(app.config['DATABASE'])
+    # Wait on locks held by other connections (i.e. background jobs) instead of failing
+    rv = sqlite3.connect(path, timeout=30)
     #,detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
     rv.row_factory = sqlite3.Row # allows both index-based and case-insensitive name-based access to columns
+    if path not in _upgraded:
+        with _upgrade_lock:
+            if path not in _upgraded:
+                upgrade_db(rv)
+                _upgraded.add(path)
     return rv
 
+def upgrade_db(db):
+    """Creates any tables and indexes from schema.sql that are missing from an
+    existing database (i.e. created by an older schema.sql), keeping all data"""
+    cur = db.cursor()
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    existing = set([row[0] for row in cur.fetchall()])
+    with app.open_resource('schema.sql', mode='r') as f:
+        schema = f.read()
+    schema = re.sub(r'(?im)^\s*drop table if exists \w+;', '', schema)
+    schema = re.sub(r'(?i)\bcreate (table|index|unique index) ', r'create \1 if not exists ', schema)
+    cur.executescript(schema)
+    for table, column, definition in UPGRADE_COLUMNS:
+        cur.execute('PRAGMA table_info(%s)' % table)
+        if column not in [row[1] for row in cur.fetchall()]:
+            cur.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, definition))
+    if 'login_history' in existing:
+        for table, backfill in UPGRADE_BACKFILL:
+            if table not in existing:
+                cur.execute(backfill)
+    db.commit()
+
 def get_db():
     """Opens a new database connection if there is none yet for the
     current application context.
+    Outside of any application context (i.e. the command line batch), the
+    connection is kept per thread and database file, see close_headless_db.
     """
+    if not has_app_context():
+        path = database_path()
+        if getattr(_headless, 'path', None) != path:
+            close_headless_db()
+            _headless.sqlite_db = connect_db()
+            _headless.path = path
+        return _headless.sqlite_db
     if not hasattr(g, 'sqlite_db'):
         g.sqlite_db = connect_db()
     return g.sqlite_db
     
-def init_db():
-    """Initialize the database from the schema.sql file"""
+def close_headless_db():
+    """Closes the current thread's connection opened outside of an application context"""
+    if getattr(_headless, 'sqlite_db', None) is not None:
+        _headless.sqlite_db.close()
+    _headless.sqlite_db = None
+    _headless.path = None
+
+def init_db(region=None):
+    """Initialize the database (of the region, the current region if None)
+    from the schema.sql file"""
     print "In init_db"
+    region = region or current_region()
     with app.app_context():
+        g.region = region
         db = get_db()
         with app.open_resource('schema.sql', mode='r') as f:
             print "Creating database from schema.sql"
@@ -35,4 +170,18 @@ def query_db(query, args=(), one=False):
     rv = cur.fetchall()
     cur.close()
     return (rv[0] if rv else None) if one else rv
-    
\ No newline at end of file
+    
+def get_state(key, default=None):
+    """Returns the saved pipeline_state value for key (i.e. high-water marks)"""
+    row = query_db('SELECT value FROM pipeline_state WHERE key=?', (key,), one=True)
+    return row['value'] if row is not None else default
+
+def set_state(cur, key, value):
+    """Saves the pipeline_state value for key, committed by the caller"""
+    cur.execute('INSERT or REPLACE into pipeline_state (key, value) values (?, ?)', (key, value))
+
+def increment_state(cur, key):
+    """Adds 1 to the pipeline_state counter for key (i.e. data_version),
+    committed by the caller"""
+    cur.execute('INSERT or IGNORE into pipeline_state (key, value) values (?, 0)', (key,))
+    cur.execute('UPDATE pipeline_state SET value=value+1 WHERE key=?', (key,))
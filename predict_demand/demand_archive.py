@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# Cold archive files of compacted login history.
+#
+# History hours older than the hot window (HOT_WEEKS) are moved out of login_history
+# by demand_main.compact_history into compressed numpy archives (np.savez_compressed
+# of the export's structured 'history' dtype), one file per compaction within the
+# region's ARCHIVE_FOLDER, indexed by the history_archives table.  Archived hours are
+# read back into login_history on demand (demand_main.reload_history), i.e. when late
+# logins arrive for them.
+
+from predict_demand import app, db_helper as dbh, demand_export as deex
+import os
+import numpy as np
+
+def archive_folder(region=None):
+    """Returns the folder of the region's archive files (the current region if None)"""
+    return os.path.join(app.config['ARCHIVE_FOLDER'], region or dbh.current_region())
+
+def archive_path(first_id, last_id, region=None):
+    """Returns the archive file of the history hours first_id to last_id"""
+    return os.path.join(archive_folder(region), 'history-%s-%s.npz' % (first_id, last_id))
+
+def write_archive(path, rows):
+    """Saves the history rows (id, day_name, hour, num_logins tuples) to the
+    compressed archive file, returns the file size in bytes.
+    Written to a temporary file first, so a partial archive is never left behind"""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    history = np.array([tuple(x) for x in rows], dtype=deex.DATASETS['history'][2])
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as archive:
+        np.savez_compressed(archive, history=history)
+    os.rename(tmp_path, path)
+    return os.path.getsize(path)
+
+def read_archive(path):
+    """Returns the history rows saved in the archive file, list of
+    (id, day_name, hour, num_logins) tuples"""
+    with np.load(path) as archive:
+        history = archive['history']
+    return zip(history['id'].tolist(), history['day_name'].tolist(), \
+        history['hour'].tolist(), history['num_logins'].tolist())
+
+def delete_archives(region):
+    """Deletes every archive file of the region"""
+    folder = archive_folder(region)
+    if not os.path.isdir(folder):
+        return
+    for filename in os.listdir(folder):
+        os.remove(os.path.join(folder, filename))
+    os.rmdir(folder)
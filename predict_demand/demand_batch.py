@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# Headless batch pipeline, run from the command line (i.e. cron) without the web server.
+#
+# Each database file is run through the pipeline stages directly, outside of any
+# Flask application context (db_helper keeps a connection per thread instead of
+# flask.g), and without loading the web routes (runbatch.py sets
+# PREDICT_DEMAND_HEADLESS, see __init__).  Stages, in order:
+#   ingest    JSON files of login timestamps (replays are skipped, see demand_ledger)
+#   compact   history older than the hot window, only if HOT_WEEKS
+#   fill      missing hours
+#   outliers  event calendar outliers and MAD scores of the changed slots
+#   predict   model fit and the predictions of the following days
+#   export    datasets written to files (demand_export), only if an export folder is given
+# Every stage is timed, and progress is printed (to stderr) as each stage completes.
+# Several database files are run in parallel by a pool of worker processes.
+# The pipeline modules are only imported once the arguments are valid, and
+# matplotlib (and pyarrow) only if used, so the command starts quickly.
+#
+# Run from the command line with:
+#   python runbatch.py [--ingest logins.json] [--days 15] [--export out/] [--workers 4] db ...
+
+from predict_demand import app, db_helper as dbh
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+STAGES = ['ingest', 'compact', 'fill', 'outliers', 'predict', 'export']
+
+def db_region(path):
+    """Returns the region name of a database file, the default region for the
+    configured DATABASE, otherwise the file's name (i.e. dc for regions/dc.db),
+    so archives and region timezones match the web server's"""
+    if os.path.abspath(path) == os.path.abspath(app.config['DATABASE']):
+        return app.config['DEFAULT_REGION']
+    return os.path.splitext(os.path.basename(path))[0]
+
+def read_logins(json_filename):
+    """Returns the list of login timestamps of a JSON file (a list, or a
+    dictionary with the list as 'timestamps'), error dictionary if invalid"""
+    try:
+        with open(json_filename, 'r') as infile:
+            login_data = json.load(infile)
+    except (IOError, ValueError) as err:
+        return {'error': 'Could not read %s: %s' % (json_filename, err)}
+    if type(login_data) is dict:
+        login_data = login_data.get('timestamps')
+    if type(login_data) is not list:
+        return {'error': '%s must hold a list of timestamps' % json_filename}
+    return login_data
+
+def ingest_stage(options):
+    """Adds the logins of every ingest file, returns the stage's details"""
+    from predict_demand import demand_main
+    details = {'files': 0, 'logins': 0, 'replayed': 0, 'duplicates': 0}
+    for json_filename in options['ingest']:
+        login_data = read_logins(json_filename)
+        if type(login_data) is dict:
+            raise ValueError(login_data['error'])
+        added = demand_main.add_multiple_logins(login_data)
+        if added.get('replayed'):
+            details['replayed'] += 1
+            continue
+        if 'error' in added:
+            raise ValueError('%s: %s' % (json_filename, added['error']))
+        details['files'] += 1
+        details['logins'] += len(login_data)
+        details['duplicates'] += added.get('duplicates', 0)
+    return details
+
+def compact_stage(options):
+    from predict_demand import demand_main
+    report = demand_main.compact_history()
+    if 'error' in report:
+        raise ValueError(report['error'])
+    return report
+
+def fill_stage(options):
+    from predict_demand import demand_main
+    demand_main.fill_missing_hours()
+    return {}
+
+def outliers_stage(options):
+    from predict_demand import demand_main
+    error_msg = demand_main.mark_predetermined_outliers(options['days'])
+    if error_msg is not None:
+        raise ValueError(error_msg)
+    demand_main.update_mad_scores()
+    return {}
+
+def predict_stage(options):
+    from predict_demand import demand_main
+    predictions = demand_main.api_update_predictions(options['days'])
+    if 'error' in predictions:
+        raise ValueError(predictions['error'])
+    pred_ids = sorted(predictions.keys())
+    return {'predicted_hours': len(pred_ids), 'first': pred_ids[0], 'last': pred_ids[-1]}
+
+def export_stage(options):
+    """Writes every export dataset to the region's folder within the export folder,
+    to a temporary file first, so a partial export is never left behind"""
+    from predict_demand import demand_export as deex
+    region = dbh.current_region()
+    folder = os.path.join(options['export'], region)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    files = []
+    for dataset in options['datasets']:
+        path = os.path.join(folder, deex.export_filename(dataset, options['format']))
+        with open(path + '.tmp', 'wb') as outfile:
+            for chunk in deex.export(dataset, options['format'], region=region):
+                outfile.write(chunk)
+        os.rename(path + '.tmp', path)
+        files.append(path)
+    return {'files': files}
+
+STAGE_FUNCTIONS = {
+    'ingest': ingest_stage,
+    'compact': compact_stage,
+    'fill': fill_stage,
+    'outliers': outliers_stage,
+    'predict': predict_stage,
+    'export': export_stage,
+}
+
+def run_pipeline(path_options):
+    """Runs every stage of the pipeline on a single database file, given
+    (path, options) tuple.  Stops at the first failed stage.
+    Returns (path, seconds, list of (stage, seconds, details) tuples, error message or None)"""
+    path, options = path_options
+    app.config['DATABASE'] = os.path.abspath(path)
+    app.config['DEFAULT_REGION'] = options['regions'][path]
+    stdout = sys.stdout
+    if options['quiet']:
+        sys.stdout = open(os.devnull, 'w')
+    start_time = time.time()
+    stages = []
+    error = None
+    try:
+        for stage in options['stages']:
+            stage_start = time.time()
+            try:
+                details = STAGE_FUNCTIONS[stage](options)
+            except Exception as err:
+                error = '%s: %s: %s' % (stage, type(err).__name__, err)
+                break
+            stages.append((stage, time.time()-stage_start, details))
+            if options['progress']:
+                sys.stderr.write('[%s] %s %.3fs\n' % (app.config['DEFAULT_REGION'], stage, stages[-1][1]))
+                sys.stderr.flush()
+    finally:
+        dbh.close_headless_db()
+        if options['quiet']:
+            sys.stdout.close()
+            sys.stdout = stdout
+    return (path, time.time()-start_time, stages, error)
+
+def num_workers():
+    """Returns the number of pipeline processes (FORECAST_WORKERS, every core if 0)"""
+    workers = int(app.config.get('FORECAST_WORKERS', 0))
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+    return workers
+
+def run_batch(paths, options, workers=None):
+    """Runs the pipeline on each of the database files, in parallel if there are
+    several workers.
+    Returns the report dictionary (number of databases run and failed, workers,
+    wall seconds, the summed seconds of each stage and each database's stages and error)"""
+    tasks = [(x, options) for x in paths]
+    workers = min(workers or num_workers(), len(tasks))
+    start_time = time.time()
+    results = []
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for result in pool.imap_unordered(run_pipeline, tasks):
+                results.append(result)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            results.append(run_pipeline(task))
+    stage_seconds = {}
+    for path, seconds, stages, error in results:
+        for stage, stage_time, details in stages:
+            stage_seconds[stage] = stage_seconds.get(stage, 0.0) + stage_time
+    report = {'databases': len(results), 'failed': len([x for x in results if x[3] is not None]),
+        'workers': max(workers, 1), 'wall_seconds': round(time.time()-start_time, 3),
+        'stage_seconds': dict([(x, round(y, 3)) for x, y in stage_seconds.items()]),
+        'results': [{'database': path, 'region': options['regions'][path], 'seconds': round(seconds, 3),
+            'stages': [{'stage': stage, 'seconds': round(stage_time, 3), 'details': details}
+                for stage, stage_time, details in stages], 'error': error}
+            for path, seconds, stages, error in sorted(results)]}
+    return report
+
+def print_report(report):
+    """Prints the timing table of every database's stages"""
+    print "Ran %d databases (%d failed) in %.2fs with %d workers" % \
+        (report['databases'], report['failed'], report['wall_seconds'], report['workers'])
+    for result in report['results']:
+        print "  %.3fs %s (%s)" % (result['seconds'], result['region'], result['database'])
+        for stage in result['stages']:
+            print "    %-8s %.3fs" % (stage['stage'], stage['seconds'])
+        if result['error'] is not None:
+            print "    FAILED %s" % result['error']
+    for stage in STAGES:
+        if stage in report['stage_seconds']:
+            print "  total %-8s %.3fs" % (stage, report['stage_seconds'][stage])
+
+def main(argv=None):
+    """Command line batch pipeline, returns the exit status (1 if any database failed)"""
+    parser = argparse.ArgumentParser(description='Run the demand pipeline on database files, without the web server')
+    parser.add_argument('databases', nargs='+', help='database files (created if missing)')
+    parser.add_argument('--ingest', action='append', default=[], metavar='JSON',
+        help='JSON file of login timestamps to add first (repeatable)')
+    parser.add_argument('--days', type=int, default=15, help='days to predict (default: 15)')
+    parser.add_argument('--stages', default=','.join(STAGES),
+        help='comma separated stages to run (default: %s)' % ','.join(STAGES))
+    parser.add_argument('--export', metavar='FOLDER', help='folder the datasets are exported to, per region')
+    parser.add_argument('--datasets', default='predictions',
+        help='comma separated datasets to export (default: predictions)')
+    parser.add_argument('--format', default='csv.gz', help='export format (default: csv.gz)')
+    parser.add_argument('--workers', type=int, help='pipeline processes (default: FORECAST_WORKERS)')
+    parser.add_argument('--quiet', action='store_true', help='only print progress and the report')
+    parser.add_argument('--no-progress', dest='progress', action='store_false', help='no progress output')
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    args = parser.parse_args(argv)
+    stages = [x for x in args.stages.split(',') if x]
+    unknown = [x for x in stages if x not in STAGES]
+    if unknown:
+        parser.error('unknown stages %s (stages: %s)' % (', '.join(unknown), ', '.join(STAGES)))
+    # Stages without anything to do are skipped
+    skipped = set()
+    if not args.ingest:
+        skipped.add('ingest')
+    if app.config['HOT_WEEKS'] <= 0:
+        skipped.add('compact')
+    if args.export is None:
+        skipped.add('export')
+    stages = [x for x in STAGES if x in stages and x not in skipped]
+    regions = dict([(x, db_region(x)) for x in args.databases])
+    if len(set(regions.values())) != len(regions):
+        parser.error('database files must have different names (regions)')
+    missing = [x for x in args.ingest if not os.path.isfile(x)]
+    if missing:
+        parser.error('could not find %s' % ', '.join(missing))
+    # Pipeline modules are imported only now, as the arguments are valid
+    from predict_demand import demand_main, demand_export as deex
+    error_msg = demand_main.validate_num_days(args.days)
+    if error_msg is None and 'export' in stages:
+        for dataset in [x for x in args.datasets.split(',') if x]:
+            error_msg = error_msg or deex.validate_export(dataset, args.format)
+    if error_msg is not None:
+        print error_msg
+        return 2
+    options = {'ingest': args.ingest, 'days': args.days, 'stages': stages, 'export': args.export,
+        'datasets': [x for x in args.datasets.split(',') if x], 'format': args.format,
+        'quiet': args.quiet, 'progress': args.progress, 'regions': regions}
+    report = run_batch(args.databases, options, args.workers)
+    if args.json:
+        print json.dumps(report, indent=2, sort_keys=True)
+    else:
+        print_report(report)
+    return 1 if report['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
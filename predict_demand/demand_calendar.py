@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# Recurring event calendar, used to tag history outliers and to scale predictions.
+#
+# Events are read from a json file (see events.json), where each event is a rule:
+#   "reason": tag saved with every matching hour (i.e. "Cinco de Mayo")
+#   one day rule:
+#     "date": "2012-03-14"                    single fixed date
+#     "month": 5, "day": 5                    same date every year
+#     "month": 5, "weekday": "Su", "nth": 2   nth weekday of the month (nth -1 is the last)
+#   [optional] "years": [2012, 2013] limits a recurring rule to specific years
+#   [optional] "hours": [0, 2] (list of hours) or "hour_range": [12, 18] (inclusive),
+#     every hour of the day if neither is given
+#   [optional] "multiplier": events with a multiplier scale future predictions
+#     (prediction_outliers), events without one mark history hours to exclude
+#     from predictions (history_outliers)
+# When rules overlap on the same hour, the rule listed last wins.
+
+import os
+import json
+import numpy as np
+
+WEEKDAYS = ['Mo', 'Tu', 'We', 'Th', 'Fr', 'Sa', 'Su']
+# Number of expanded windows kept in memory
+MAX_CACHED_WINDOWS = 32
+
+_calendar_cache = {}  # filename: (modified time, rules)
+_expansion_cache = {} # (filename, modified time, first day, last day): (history, predicted)
+
+def load_calendar(filename):
+    """Reads the event rules from the json calendar file.
+    Rules are only re-read when the file has been modified.
+    Raises ValueError if any rule is invalid"""
+    mtime = os.path.getmtime(filename)
+    cached = _calendar_cache.get(filename)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(filename, 'r') as infile:
+        events = json.load(infile)
+    if type(events) is dict:
+        events = events.get('events', [])
+    rules = [parse_event(event) for event in events]
+    _calendar_cache[filename] = (mtime, rules)
+    return rules
+
+def parse_event(event):
+    """Validates a single event from the calendar file and returns the rule
+    used for expansion (numpy friendly values)"""
+    if 'reason' not in event:
+        raise ValueError('Calendar event missing reason: %s' % event)
+    rule = {'reason': str(event['reason']), 'multiplier': None, 'years': None}
+    if 'date' in event:
+        rule['kind'] = 'date'
+        rule['date'] = np.datetime64(str(event['date'])[0:10], 'D')
+    elif 'month' in event and 'day' in event:
+        rule['kind'] = 'annual'
+        rule['month'] = int(event['month'])
+        rule['day'] = int(event['day'])
+    elif 'month' in event and 'weekday' in event and 'nth' in event:
+        if event['weekday'] not in WEEKDAYS:
+            raise ValueError('Calendar weekday must be one of %s: %s' % (WEEKDAYS, event))
+        rule['kind'] = 'nth_weekday'
+        rule['month'] = int(event['month'])
+        rule['weekday'] = WEEKDAYS.index(event['weekday'])
+        rule['nth'] = int(event['nth'])
+    else:
+        raise ValueError('Calendar event needs a date, month/day or month/weekday/nth: %s' % event)
+    if 'years' in event:
+        rule['years'] = [int(y) for y in event['years']]
+    if 'hours' in event:
+        hours = [int(h) for h in event['hours']]
+    elif 'hour_range' in event:
+        hours = range(int(event['hour_range'][0]), int(event['hour_range'][1])+1)
+    else:
+        hours = range(24)
+    if not hours or min(hours) < 0 or max(hours) > 23:
+        raise ValueError('Calendar hours must be within 0 to 23: %s' % event)
+    rule['hours'] = np.array(hours, dtype='timedelta64[h]')
+    if 'multiplier' in event:
+        rule['multiplier'] = float(event['multiplier'])
+    return rule
+
+def day_fields(days):
+    """Given an array of numpy days (datetime64[D]), returns a dictionary of
+    arrays used to match the rules: year, month, day of month, weekday (0 is Monday),
+    nth occurrence of the weekday within the month, and if it is the last occurrence"""
+    months = days.astype('datetime64[M]')
+    month_start = months.astype('datetime64[D]')
+    month_len = (months + 1).astype('datetime64[D]') - month_start
+    dom = (days - month_start).astype(int) + 1
+    return {
+        'year': days.astype('datetime64[Y]').astype(int) + 1970,
+        'month': months.astype(int) % 12 + 1,
+        'day': dom,
+        'weekday': (days.astype(int) + 3) % 7, # 1970-01-01 was a Thursday
+        'nth': (dom - 1) // 7 + 1,
+        'last': dom + 7 > month_len.astype(int)}
+
+def rule_mask(rule, fields, days):
+    """Returns boolean array of the days that match the rule"""
+    if rule['kind'] == 'date':
+        mask = days == rule['date']
+    elif rule['kind'] == 'annual':
+        mask = (fields['month'] == rule['month']) & (fields['day'] == rule['day'])
+    else:
+        mask = (fields['month'] == rule['month']) & (fields['weekday'] == rule['weekday'])
+        if rule['nth'] < 0:
+            mask &= fields['last']
+        else:
+            mask &= fields['nth'] == rule['nth']
+    if rule['years'] is not None:
+        mask &= np.in1d(fields['year'], rule['years'])
+    return mask
+
+def expand_calendar(filename, start_id, end_id):
+    """Expands every calendar rule over the days from start_id to end_id (inclusive).
+    Returns (history, predicted) tuple of lists, where
+    history holds (id, reason) tuples for events without a multiplier and
+    predicted holds (id, multiplier, reason) tuples.
+    Results are cached per window until the calendar file is modified"""
+    rules = load_calendar(filename)
+    key = (filename, _calendar_cache[filename][0], str(start_id)[0:10], str(end_id)[0:10])
+    if key in _expansion_cache:
+        return _expansion_cache[key]
+    days = np.arange(np.datetime64(key[2], 'D'), np.datetime64(key[3], 'D') + 1)
+    fields = day_fields(days)
+    history = []
+    predicted = []
+    for rule in rules:
+        matched = days[rule_mask(rule, fields, days)]
+        if not matched.size:
+            continue
+        hours = matched.astype('datetime64[h]')[:, None] + rule['hours'][None, :]
+        ids = np.datetime_as_string(hours.ravel(), unit='h')
+        if rule['multiplier'] is None:
+            history.extend([(str(x), rule['reason']) for x in ids])
+        else:
+            predicted.extend([(str(x), rule['multiplier'], rule['reason']) for x in ids])
+    if len(_expansion_cache) >= MAX_CACHED_WINDOWS:
+        _expansion_cache.clear()
+    _expansion_cache[key] = (history, predicted)
+    return (history, predicted)
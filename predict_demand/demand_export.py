@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# Streamed exports of the history, predictions and outliers for downstream analytics.
+#
+# Rows are read from their own database connection in batches of EXPORT_BATCH_ROWS
+# (cursor.fetchmany), and each batch is encoded and yielded before the next one is
+# read, so memory stays bounded no matter how much history is exported.
+# Formats:
+#   csv.gz  gzip'd csv with a header row
+#   npy     numpy structured array (np.load), rows are counted first for the header,
+#           within the same read transaction as the export
+#   arrow   Arrow IPC stream (pyarrow.ipc.open_stream), only if pyarrow is installed
+
+from predict_demand import app, db_helper as dbh, demand_formatter as defo
+import csv
+import zlib
+import numpy as np
+from numpy.lib import format as npy_format
+from cStringIO import StringIO
+
+# Dataset: (table, columns, numpy dtype of a row)
+DATASETS = {
+    'history': ('login_history', ['id', 'day_name', 'hour', 'num_logins'],
+        np.dtype([('id', 'S13'), ('day_name', 'S3'), ('hour', '<i1'), ('num_logins', '<i4')])),
+    'predictions': ('login_predictions', ['id', 'num_logins', 'model_version'],
+        np.dtype([('id', 'S13'), ('num_logins', '<f8'), ('model_version', 'S48')])),
+    'outliers': ('history_outliers', ['id', 'reason'],
+        np.dtype([('id', 'S13'), ('reason', 'S64')])),
+    'predicted_outliers': ('prediction_outliers', ['id', 'multiplier', 'reason'],
+        np.dtype([('id', 'S13'), ('multiplier', '<f8'), ('reason', 'S64')])),
+}
+# Format: (mimetype, file extension)
+FORMATS = {
+    'csv.gz': ('application/gzip', 'csv.gz'),
+    'npy': ('application/octet-stream', 'npy'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+
+def pyarrow():
+    """Returns the pyarrow module, None if it is not installed.  Imported on first
+    use, so processes that never export Arrow start without loading it"""
+    try:
+        import pyarrow
+    except ImportError:
+        return None
+    return pyarrow
+
+def validate_export(dataset, export_format, start_id=None, end_id=None):
+    """Returns error dictionary if the export can't be run, None if valid"""
+    if dataset not in DATASETS:
+        return {'error':'Unknown dataset', 'datasets':sorted(DATASETS.keys())}
+    if export_format not in FORMATS:
+        return {'error':'Unknown format', 'formats':sorted(FORMATS.keys())}
+    if export_format == 'arrow' and pyarrow() is None:
+        return {'error':'Arrow export needs pyarrow installed'}
+    for name, value in (('start', start_id), ('end', end_id)):
+        if value is not None and defo.validate_id(value) is None:
+            return {'error':'Invalid %s hour' % name, '%s_example' % name: '2012-05-01T00'}
+    return None
+
+def export_filename(dataset, export_format):
+    """Returns the download filename of the export"""
+    return '%s.%s' % (dataset, FORMATS[export_format][1])
+
+def iter_batches(dataset, start_id=None, end_id=None, region=None, count=None):
+    """Yields lists of row tuples of the dataset (ordered by id), from start_id
+    (inclusive) to end_id (exclusive), read EXPORT_BATCH_ROWS at a time from
+    a separate connection to the region's database.
+    If count is given, first yields the number of rows"""
+    table, columns, dtype = DATASETS[dataset]
+    conditions = []
+    args = []
+    if start_id is not None:
+        conditions.append('id>=?')
+        args.append(defo.validate_id(start_id))
+    if end_id is not None:
+        conditions.append('id<?')
+        args.append(defo.validate_id(end_id))
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    db = dbh.connect_db(region)
+    try:
+        cur = db.cursor()
+        if count:
+            # Count and rows are read within one transaction, so they always match
+            cur.execute('BEGIN')
+            cur.execute('SELECT COUNT(*) FROM %s%s' % (table, where), args)
+            yield cur.fetchone()[0]
+        cur.execute('SELECT %s FROM %s%s ORDER BY id ASC' % (', '.join(columns), table, where), args)
+        batch_rows = app.config['EXPORT_BATCH_ROWS']
+        while True:
+            rows = cur.fetchmany(batch_rows)
+            if not rows:
+                break
+            yield [tuple(row) for row in rows]
+    finally:
+        db.close()
+
+def export_csv_gz(dataset, start_id=None, end_id=None, region=None):
+    """Yields the gzip'd csv export, one compressed chunk per batch"""
+    columns = DATASETS[dataset][1]
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16+zlib.MAX_WBITS) # gzip header
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    for rows in iter_batches(dataset, start_id, end_id, region):
+        writer.writerows([[x.encode('utf-8') if type(x) is unicode else x for x in row] for row in rows])
+        chunk = compressor.compress(buf.getvalue())
+        buf.seek(0)
+        buf.truncate()
+        if chunk:
+            yield chunk
+    yield compressor.compress(buf.getvalue()) + compressor.flush()
+
+def export_npy(dataset, start_id=None, end_id=None, region=None):
+    """Yields the .npy export of a structured array (DATASETS dtype),
+    the header followed by the raw records of each batch"""
+    dtype = DATASETS[dataset][2]
+    batches = iter_batches(dataset, start_id, end_id, region, count=True)
+    header = StringIO()
+    npy_format.write_array_header_1_0(header, {'descr': npy_format.dtype_to_descr(dtype),
+        'fortran_order': False, 'shape': (batches.next(),)})
+    yield header.getvalue()
+    for rows in batches:
+        yield np.array(rows, dtype=dtype).tostring()
+
+class ChunkSink(object):
+    """Write only file object collecting the bytes written by pyarrow,
+    emptied by take() after every batch"""
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def export_arrow(dataset, start_id=None, end_id=None, region=None):
+    """Yields the Arrow IPC stream export, one record batch per batch of rows"""
+    pa = pyarrow()
+    columns = DATASETS[dataset][1]
+    dtype = DATASETS[dataset][2]
+    types = {'S': pa.string(), 'i': pa.int32(), 'f': pa.float64()}
+    schema = pa.schema([pa.field(name, types[dtype[name].kind]) for name in columns])
+    sink = ChunkSink()
+    writer = pa.RecordBatchStreamWriter(sink, schema)
+    for rows in iter_batches(dataset, start_id, end_id, region):
+        arrays = [pa.array(list(values), type=schema.types[idx]) for idx, values in enumerate(zip(*rows))]
+        writer.write_batch(pa.RecordBatch.from_arrays(arrays, columns))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+EXPORTERS = {
+    'csv.gz': export_csv_gz,
+    'npy': export_npy,
+    'arrow': export_arrow,
+}
+
+def export(dataset, export_format, start_id=None, end_id=None, region=None):
+    """Returns generator of the encoded export of the region (validate_export first).
+    The region is given explicitly, as the export is streamed after the request"""
+    return EXPORTERS[export_format](dataset, start_id, end_id, region)
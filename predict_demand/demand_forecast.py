@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# Batch forecasting of many regions in parallel.
+#
+# Each region's forecast (filling missing hours, fitting the model and saving its
+# predictions) is independent of every other region, so regions are forecast by a
+# pool of FORECAST_WORKERS processes, each region within its own application context
+# and database connection.  With a single worker (or a single region) regions are
+# forecast in this process.  Every region is timed, and a summary report (with the
+# errors of any failed regions) is printed and returned.
+#
+# Run from the command line with:
+#   python -m predict_demand.demand_forecast [--days 15] [--workers 4] [region ...]
+
+from predict_demand import app, db_helper as dbh, demand_main
+from flask import g
+import sys
+import time
+import argparse
+import multiprocessing
+
+# Number of slowest regions listed in the timing report
+REPORT_SLOWEST = 5
+
+def validate_forecast(regions, num_days):
+    """Returns error dictionary if the regions can't be forecast, None if valid"""
+    error_msg = demand_main.validate_num_days(num_days)
+    if error_msg is not None:
+        return error_msg
+    unknown = [x for x in regions or [] if dbh.validate_region(x) is None or not dbh.region_exists(x)]
+    if unknown:
+        return {'error':'Unknown regions', 'regions': unknown}
+    return None
+
+def forecast_region(region_days):
+    """Forecasts a single region, given (region, num_days) tuple.
+    Returns (region, seconds, predicted hours, error message or None)"""
+    region, num_days = region_days
+    start_time = time.time()
+    try:
+        with app.app_context():
+            g.region = region
+            demand_main.fill_missing_hours()
+            predictions = demand_main.api_update_predictions(num_days)
+    except Exception as err:
+        return (region, time.time()-start_time, 0, '%s: %s' % (type(err).__name__, err))
+    if 'error' in predictions:
+        return (region, time.time()-start_time, 0, predictions['error'])
+    return (region, time.time()-start_time, len(predictions), None)
+
+def num_workers():
+    """Returns the number of forecasting processes (FORECAST_WORKERS, every core if 0)"""
+    workers = int(app.config.get('FORECAST_WORKERS', 0))
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+    return workers
+
+def forecast_regions(regions=None, num_days=15, progress=None):
+    """Forecasts num_days for each of the regions (every region if None),
+    in parallel if there are several workers.  progress(fraction, message) is called
+    as each region completes.
+    Returns the report dictionary (number of regions forecast and failed, workers,
+    wall and summed forecast seconds, the slowest regions and each region's
+    seconds, predicted hours and error)"""
+    if regions is None:
+        regions = dbh.list_regions()
+    tasks = [(x, num_days) for x in regions]
+    workers = min(num_workers(), len(tasks))
+    start_time = time.time()
+    results = []
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for result in pool.imap_unordered(forecast_region, tasks):
+                results.append(result)
+                if progress is not None:
+                    progress(float(len(results))/len(tasks), 'Forecast %s' % result[0])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            results.append(forecast_region(task))
+            if progress is not None:
+                progress(float(len(results))/len(tasks), 'Forecast %s' % task[0])
+    wall_seconds = time.time() - start_time
+    failed = [(region, error) for region, seconds, hours, error in results if error is not None]
+    slowest = sorted([(seconds, region) for region, seconds, hours, error in results], reverse=True)
+    report = {'regions': len(results), 'failed': len(failed), 'workers': max(workers, 1),
+        'wall_seconds': round(wall_seconds, 3),
+        'forecast_seconds': round(sum([x[0] for x in slowest]), 3),
+        'slowest': [(region, round(seconds, 3)) for seconds, region in slowest[0:REPORT_SLOWEST]],
+        'results': [{'region': region, 'seconds': round(seconds, 3), 'predicted_hours': hours,
+            'error': error} for region, seconds, hours, error in sorted(results)]}
+    print "Forecast %d regions (%d failed) in %.2fs with %d workers (%.2fs forecasting)" % \
+        (report['regions'], report['failed'], report['wall_seconds'], report['workers'], \
+         report['forecast_seconds'])
+    for region, seconds in report['slowest']:
+        print "  %.3fs %s" % (seconds, region)
+    for region, error in failed:
+        print "  FAILED %s (%s)" % (region, error)
+    return report
+
+def main(argv=None):
+    """Command line batch forecast, returns the exit status (1 if any region failed)"""
+    parser = argparse.ArgumentParser(description='Forecast every region (or the given regions)')
+    parser.add_argument('regions', nargs='*', help='regions to forecast (default: every region)')
+    parser.add_argument('--days', type=int, default=15, help='days to predict (default: 15)')
+    parser.add_argument('--workers', type=int, help='forecasting processes (default: FORECAST_WORKERS)')
+    args = parser.parse_args(argv)
+    if args.workers is not None:
+        app.config['FORECAST_WORKERS'] = args.workers
+    error_msg = validate_forecast(args.regions, args.days)
+    if error_msg is not None:
+        print error_msg
+        return 2
+    report = forecast_regions(args.regions or None, args.days)
+    return 1 if report['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,43 +4,67 @@ import os
 import re
 import calendar
 import datetime
+import numpy as np
+from predict_demand import demand_timezone as detz
 
 # Format of the id's stored in the database (i.e. 2012-03-01T23)
 DATETIME_ID_FORMAT = '%Y-%m-%dT%H'
 # Format of the login times read in through *.json files
 JSON_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
 
-def datetimes_to_dict(login_data):
+def datetimes_to_dict(login_data, zone=None):
     """Takes the client login json data, which is of the format:
     [u'2012-04-30T23:59:29+00:00',...]
     and group login times by hour:
     where each hour contains a list of all the logins
     {
-        '2012-04-30T23': ['2012-04-30T23:59:29+00:00','2012-04-30T23:59:49+00:00']
+        '2012-04-30T23': ['2012-04-30T23','2012-04-30T23']
         ...
-    }"""
+    }
+    If zone is given (i.e. 'America/New_York'), hours are the local hours of the
+    timezone, converted from the timestamps' UTC offsets (demand_timezone).
+    Otherwise timezone information is ignored"""
+    login_data = [unicode(x) for x in login_data]
+    naive = [x[0:19] for x in login_data]
+    try:
+        if any([len(x) != 19 for x in naive]):
+            raise ValueError('Timestamps must start with yyyy-mm-ddThh:mm:ss')
+        naive_times = np.array(naive, dtype='datetime64[s]')
+        valid = np.ones(len(naive), dtype=bool)
+    except ValueError:
+        # Parse one at a time, so only the invalid timestamps are skipped
+        valid = np.zeros(len(naive), dtype=bool)
+        parsed = []
+        for idx, time in enumerate(naive):
+            try:
+                parsed.append(np.datetime64(datetime.datetime.strptime(time, JSON_DATETIME_FORMAT), 's'))
+                valid[idx] = True
+            except ValueError, e:
+                print "Skipping unhandled datetime"
+                print e
+        naive_times = np.array(parsed, dtype='datetime64[s]')
+    if zone is None:
+        hour_ids = np.datetime_as_string(naive_times, unit='h')
+    else:
+        suffixes = [x[19:] for x, ok in zip(login_data, valid) if ok]
+        hour_ids, valid_offsets = detz.local_hour_ids(zone, naive_times, suffixes)
+        if not valid_offsets.all():
+            print "Skipping %d datetimes with unhandled UTC offsets" % np.sum(~valid_offsets)
     binned_data = {}
-    for time in login_data:
-        try:
-            # Ignore timezone information for now
-            login_dt = datetime.datetime.strptime(time[0:19], JSON_DATETIME_FORMAT)
-            dt_id = login_dt.strftime(DATETIME_ID_FORMAT)
-            if dt_id in binned_data:
-                binned_data[dt_id].append(dt_id)
-            else:
-                binned_data[dt_id] = [dt_id]
-                
-        except ValueError, e:
-            print "Skipping unhandled datetime"
-            print e
+    if len(hour_ids):
+        unique_ids, counts = np.unique(hour_ids, return_counts=True)
+        for dt_id, count in zip(unique_ids, counts):
+            binned_data[str(dt_id)] = [str(dt_id)]*count
     return binned_data
 
-def validate_login_string(client_login_id):
+def validate_login_string(client_login_id, zone=None):
     """Takes a client login id, which is of the format:
     2012-04-30T23:59:29
     and returns the associated id which can be stored in the database, formatted:
     2012-04-30T23
-    Tries the database format, if no format matches returns None"""
+    Tries the database format, if no format matches returns None.
+    Full timestamps are converted to the local hour of zone if given (see
+    datetimes_to_dict), hour ids are already local"""
     client_login_id = str(client_login_id)
     try:
         if len(client_login_id) < 19:
@@ -48,6 +72,8 @@ def validate_login_string(client_login_id):
                 login_dt = datetime.datetime.strptime(client_login_id, DATETIME_ID_FORMAT)
                 if login_dt:
                     return login_dt.strftime(DATETIME_ID_FORMAT)
+        elif zone is not None:
+            return datetimes_to_dict([client_login_id], zone).keys()[0]
         else:
             login_dt = datetime.datetime.strptime(client_login_id[0:19], JSON_DATETIME_FORMAT)
             if login_dt:
@@ -200,6 +226,19 @@ def dy_subtract_ids(id_hi, id_lo):
     day_lo = datetime.datetime.strptime(str(id_lo)[0:11]+'00', DATETIME_ID_FORMAT)
     return (day_hi - day_lo).days
     
+def get_week_start(day_str):
+    """Returns the Monday (format: yyyy-mm-dd) of the week containing the day
+    (format: yyyy-mm-dd, or any id starting with it)"""
+    day = datetime.datetime.strptime(str(day_str)[0:10], '%Y-%m-%d')
+    return (day - datetime.timedelta(days=day.weekday())).strftime('%Y-%m-%d')
+
+def validate_day(check_day):
+    """Returns the day (format: yyyy-mm-dd), None if it is not the correct format"""
+    try:
+        return datetime.datetime.strptime(str(check_day)[0:10], '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+
 def get_day_of_year(dt_id):
     """Returns the day of year, from 001 to 366"""
     dt = datetime.datetime.strptime(str(dt_id), DATETIME_ID_FORMAT)
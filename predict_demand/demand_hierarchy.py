@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# Hierarchical forecasts, reconciled so every level adds up.
+#
+# Each node of the hierarchy (i.e. city, zone and neighborhood) is a region with its
+# own history, forecast by the existing engine (demand_forecast).  The hierarchy is
+# saved in the region_hierarchy table of the default region's database, as the
+# parent of each region.
+# Base forecasts of every node are loaded as one nodes x hours matrix, and reconciled
+# for all nodes and hours at once through the summing matrix S (nodes x leaves,
+# 1 where the leaf is within the node):
+#   bottom_up  leaf forecasts summed up every level, S * leaves
+#   mint       MinT (minimum trace) combination of every level's forecasts,
+#              S (S' W^-1 S)^-1 S' W^-1 * base forecasts, where W is diagonal: each
+#              node's archived forecast error variance, or (if any node has no archived
+#              errors yet) its number of leaves (structural scaling)
+# Reconciled forecasts are saved to each region's reconciled_predictions table.
+
+from predict_demand import app, db_helper as dbh, demand_forecast
+import time
+import numpy as np
+
+RECONCILE_METHODS = ['bottom_up', 'mint']
+
+def hierarchy_db():
+    """Returns a new connection to the database holding the region_hierarchy
+    table (the default region's), closed by the caller"""
+    return dbh.connect_db(app.config['DEFAULT_REGION'])
+
+def get_hierarchy():
+    """Returns the saved hierarchy, list of dictionaries of region, parent
+    (None for top level regions) and level (i.e. 'zone')"""
+    db = hierarchy_db()
+    try:
+        rows = db.execute('SELECT region, parent, level FROM region_hierarchy ORDER BY region ASC').fetchall()
+    finally:
+        db.close()
+    return [dict(zip(x.keys(), x)) for x in rows]
+
+def validate_hierarchy(nodes):
+    """Returns error dictionary if the list of nodes (dictionaries of region,
+    parent and level) is not a valid hierarchy, None if valid"""
+    if type(nodes) is not list or not nodes or \
+        any([type(x) is not dict or 'region' not in x for x in nodes]):
+        return {'error':'Hierarchy must be a list of regions with their parent',
+            'example':[{'region':'dc', 'level':'city'}, {'region':'dc-nw', 'parent':'dc', 'level':'zone'}]}
+    parents = dict([(x['region'], x.get('parent')) for x in nodes])
+    if len(parents) != len(nodes):
+        return {'error':'Regions must only be listed once'}
+    unknown = [x for x in parents if dbh.validate_region(x) is None or not dbh.region_exists(x)]
+    unknown += [x for x in set(parents.values()) if x is not None and x not in parents]
+    if unknown:
+        return {'error':'Unknown regions', 'regions':sorted(set(unknown))}
+    for region in parents:
+        seen = set([region])
+        parent = parents[region]
+        while parent is not None:
+            if parent in seen:
+                return {'error':'Hierarchy has a cycle', 'region':region}
+            seen.add(parent)
+            parent = parents[parent]
+    return None
+
+def set_hierarchy(nodes):
+    """Replaces the saved hierarchy (validate_hierarchy first)"""
+    db = hierarchy_db()
+    try:
+        db.execute('DELETE FROM region_hierarchy')
+        db.executemany('INSERT INTO region_hierarchy (region, parent, level) values (?, ?, ?)', \
+            [(x['region'], x.get('parent'), x.get('level')) for x in nodes])
+        db.commit()
+    finally:
+        db.close()
+
+def summing_matrix(hierarchy):
+    """Returns (nodes, leaves, S) tuple for the hierarchy, the list of every region
+    (parents before their children), the list of leaf regions (no children) and
+    the summing matrix, S[i][j] is 1 if leaf j is within node i (or is node i)"""
+    parents = dict([(x['region'], x['parent']) for x in hierarchy])
+    depth = {}
+    for region in parents:
+        depth[region] = 0
+        parent = parents[region]
+        while parent is not None:
+            depth[region] += 1
+            parent = parents[parent]
+    nodes = sorted(parents, key=lambda x: (depth[x], x))
+    has_children = set(parents.values())
+    leaves = [x for x in nodes if x not in has_children]
+    node_idx = dict([(region, idx) for idx, region in enumerate(nodes)])
+    S = np.zeros((len(nodes), len(leaves)))
+    for leaf_idx, leaf in enumerate(leaves):
+        region = leaf
+        while region is not None:
+            S[node_idx[region], leaf_idx] = 1.0
+            region = parents[region]
+    return (nodes, leaves, S)
+
+def load_forecasts(regions):
+    """Returns (hours, forecasts) tuple, the hours predicted by every one of the
+    regions, and the regions x hours matrix of their saved predictions"""
+    predictions = []
+    for region in regions:
+        db = dbh.connect_db(region)
+        try:
+            rows = db.execute('SELECT id, num_logins FROM login_predictions').fetchall()
+        finally:
+            db.close()
+        predictions.append(dict([(x['id'], x['num_logins']) for x in rows]))
+    hours = sorted(set.intersection(*[set(x) for x in predictions])) if predictions else []
+    return (hours, np.array([[x[hour] for hour in hours] for x in predictions]).reshape(len(regions), len(hours)))
+
+def error_variances(regions):
+    """Returns the mean squared error of each region's archived forecasts
+    (forecast_archive), None for regions without any archived forecasts"""
+    variances = []
+    for region in regions:
+        db = dbh.connect_db(region)
+        try:
+            mse = db.execute('SELECT AVG((num_logins - actual_logins)*(num_logins - actual_logins)) ' + \
+                'FROM forecast_archive').fetchone()[0]
+        finally:
+            db.close()
+        variances.append(mse)
+    return variances
+
+def leaf_rows(S):
+    """Returns the row of each leaf (column of S).  Nodes with a single child cover a
+    single leaf too, the leaf itself being the deepest (last) of those rows"""
+    single = np.flatnonzero(S.sum(axis=1) == 1)
+    rows = np.zeros(S.shape[1], dtype=int)
+    np.maximum.at(rows, S[single].argmax(axis=1), single)
+    return rows
+
+def reconcile(S, base, method, variances=None):
+    """Reconciles the base forecasts (nodes x hours) of every node and hour at once,
+    S being the summing matrix (nodes x leaves).  For 'mint', variances are the
+    diagonal of W (every node's forecast error variance, structural scaling if None).
+    Returns the reconciled nodes x hours matrix"""
+    leaves = leaf_rows(S)
+    if method == 'bottom_up':
+        return S.dot(base[leaves])
+    if variances is None:
+        variances = S.sum(axis=1)
+    # Nodes with no forecast errors at all are given a tiny variance (fully trusted)
+    weights = 1.0 / np.maximum(np.asarray(variances, dtype=float), 1e-9)
+    # S is the leaves' identity below the aggregate rows C, so S' W^-1 S = D + C' A C
+    # (D and A the leaf and aggregate weights), solved through the Woodbury identity
+    # with only an aggregates x aggregates system, as there are far fewer aggregates
+    aggregates = np.setdiff1d(np.arange(S.shape[0]), leaves)
+    C = S[aggregates]
+    D = weights[leaves]
+    A = weights[aggregates]
+    rhs = D[:, None] * base[leaves] + C.T.dot(A[:, None] * base[aggregates]) # S' W^-1 base
+    CDinv = C / D
+    inner = np.diag(1.0 / A) + CDinv.dot(C.T)
+    leaf_forecasts = rhs / D[:, None] - CDinv.T.dot(np.linalg.solve(inner, CDinv.dot(rhs)))
+    return S.dot(leaf_forecasts)
+
+def validate_reconcile(method, num_days):
+    """Returns error dictionary if the reconciliation can't be run, None if valid"""
+    if method not in RECONCILE_METHODS:
+        return {'error':'Unknown method', 'methods':RECONCILE_METHODS}
+    if not get_hierarchy():
+        return {'error':'No hierarchy, PUT /api/hierarchy first'}
+    if num_days is not None:
+        return demand_forecast.validate_forecast(None, num_days)
+    return None
+
+def reconcile_hierarchy(method='mint', num_days=None, progress=None):
+    """Forecasts num_days for every region of the hierarchy (unless num_days is None,
+    reconciling the saved predictions), reconciles them with method and saves the
+    reconciled forecasts of every region.
+    Returns the report dictionary (method, variance weighting, number of nodes,
+    leaves and hours, seconds taken and the forecast report) or error dictionary"""
+    nodes, leaves, S = summing_matrix(get_hierarchy())
+    report = {'method': method, 'nodes': len(nodes), 'leaves': len(leaves)}
+    if num_days is not None:
+        if progress is not None:
+            progress(0.0, 'Forecasting %d regions' % len(nodes))
+        report['forecast'] = demand_forecast.forecast_regions(nodes, num_days)
+    if progress is not None:
+        progress(0.8, 'Reconciling %d regions' % len(nodes))
+    start_time = time.time()
+    forecast_nodes = leaves if method == 'bottom_up' else nodes
+    hours, forecasts = load_forecasts(forecast_nodes)
+    if not hours:
+        return {'error':'No hours predicted by every region'}
+    if method == 'bottom_up':
+        base = np.zeros((len(nodes), len(hours)))
+        # Leaves can be at any depth, so are placed at their own rows
+        base[leaf_rows(S)] = forecasts
+        reconciled = reconcile(S, base, method)
+    else:
+        variances = error_variances(nodes)
+        report['weights'] = 'error_variance' if None not in variances else 'structural'
+        reconciled = reconcile(S, forecasts, method, variances if None not in variances else None)
+    report['reconcile_seconds'] = round(time.time()-start_time, 3)
+    report['hours'] = len(hours)
+    for region, row in zip(nodes, reconciled):
+        db = dbh.connect_db(region)
+        try:
+            db.execute('DELETE FROM reconciled_predictions')
+            db.executemany('INSERT INTO reconciled_predictions (id, num_logins, method) values (?, ?, ?)', \
+                [(hour, float(value), method) for hour, value in zip(hours, row)])
+            db.commit()
+        finally:
+            db.close()
+    print "Reconciled %d regions (%d leaves) x %d hours with %s in %.2fs" % \
+        (len(nodes), len(leaves), len(hours), method, report['reconcile_seconds'])
+    return report
+
+def get_reconciled():
+    """Returns the reconciled predictions of the current region, dictionary of
+    id: num_logins and the method used"""
+    rows = dbh.query_db('SELECT id, num_logins, method FROM reconciled_predictions ORDER BY id ASC')
+    return {'predictions': dict([(x['id'], x['num_logins']) for x in rows]),
+        'method': rows[0]['method'] if rows else None}
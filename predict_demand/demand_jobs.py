@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# Background job runner, so long running work (filling missing hours, fitting and
+# saving predictions, analysis plots) does not run within an HTTP request.
+#
+# Jobs are saved in the jobs table (status, progress, timing & result) and run by a
+# pool of worker threads (JOB_WORKERS), each job within its own application context.
+# Submitting a job identical to one that is still queued returns the queued job's id.
+# Jobs still queued when the server stopped are queued again on startup.
+# Jobs of every region are saved in the default region's database, each job runs
+# against the database of the region it was submitted for.
+
+from predict_demand import app, db_helper as dbh, demand_main, demand_forecast, \
+    demand_hierarchy as dehi
+from flask import g
+import json
+import time
+import threading
+import Queue
+
+_queue = Queue.Queue()
+_workers = []
+_lock = threading.Lock()
+
+def predict_job(progress, num_days=15):
+    """Compacts history older than the hot window (if HOT_WEEKS), fills missing
+    hours, archives predictions with actuals and saves predictions for the
+    num_days following the latest history"""
+    if app.config['HOT_WEEKS'] > 0:
+        progress(0.0, 'Compacting history')
+        demand_main.compact_history()
+    progress(0.1, 'Filling missing hours')
+    demand_main.fill_missing_hours()
+    progress(0.2, 'Predicting %d days' % num_days)
+    predictions = demand_main.api_update_predictions(num_days)
+    if 'error' in predictions:
+        raise ValueError(predictions['error'])
+    pred_ids = sorted(predictions.keys())
+    return {'predicted_hours': len(pred_ids), 'first': pred_ids[0], 'last': pred_ids[-1]}
+
+def analysis_job(progress):
+    """Fills missing hours, runs the analytics and updates the predictions,
+    saving every analysis and prediction plot.
+    Returns the plot timing reports"""
+    progress(0.0, 'Filling missing hours')
+    demand_main.fill_missing_hours()
+    progress(0.1, 'Running analytics')
+    demand_main.run_analytics()
+    progress(0.2, 'Plotting history')
+    history_report = demand_main.plot_logins()
+    progress(0.6, 'Updating predictions & plotting')
+    prediction_report = demand_main.plot_predictions(1)
+    return {'history_plots': history_report, 'prediction_plots': prediction_report}
+
+def forecast_job(progress, num_days=15, regions=None):
+    """Forecasts num_days for each of the regions (every region if None)
+    in parallel, returns the timing and error report"""
+    progress(0.0, 'Forecasting %s regions' % (len(regions) if regions else 'all'))
+    return demand_forecast.forecast_regions(regions, num_days, progress)
+
+def reconcile_job(progress, method='mint', num_days=None):
+    """Forecasts num_days for every region of the hierarchy (unless None) and
+    saves their reconciled forecasts, returns the reconciliation report"""
+    report = dehi.reconcile_hierarchy(method, num_days, progress)
+    if 'error' in report:
+        raise ValueError(report['error'])
+    return report
+
+def compact_job(progress, hot_weeks=None):
+    """Compacts history older than the hot_weeks (HOT_WEEKS if None) window,
+    returns the compaction report"""
+    progress(0.0, 'Compacting history')
+    return demand_main.compact_history(hot_weeks)
+
+def reload_job(progress, start_id=None, end_id=None):
+    """Reloads the archived history of the days from start_id to end_id,
+    returns the number of reloaded hours"""
+    progress(0.0, 'Reloading archived history')
+    reloaded = demand_main.api_reload_history(start_id, end_id)
+    if 'error' in reloaded:
+        raise ValueError(reloaded['error'])
+    return reloaded
+
+# Job name: function(progress, **params), where progress(fraction, message)
+# reports how far along the job is
+JOB_FUNCTIONS = {
+    'predict': predict_job,
+    'analysis': analysis_job,
+    'forecast': forecast_job,
+    'reconcile': reconcile_job,
+    'compact': compact_job,
+    'reload': reload_job,
+}
+
+def jobs_db():
+    """Returns a new connection to the database holding the jobs table
+    (the default region's), closed by the caller"""
+    return dbh.connect_db(app.config['DEFAULT_REGION'])
+
+def submit(name, **params):
+    """Queues the named job with the given parameters for the current region,
+    returns the job id.
+    If an identical job (same name, parameters and region) is already queued,
+    returns the id of the queued job instead of adding another"""
+    if name not in JOB_FUNCTIONS:
+        raise ValueError('Unknown job: %s' % name)
+    params_json = json.dumps(params, sort_keys=True)
+    region = dbh.current_region()
+    start_workers()
+    with _lock:
+        db = jobs_db()
+        try:
+            cur = db.cursor()
+            cur.execute("SELECT id FROM jobs WHERE name=? AND params=? AND region=? AND status='queued' " + \
+                "ORDER BY id ASC", (name, params_json, region))
+            match = cur.fetchone()
+            if match:
+                return match['id']
+            cur.execute("INSERT INTO jobs (name, params, region, status, created_at) " + \
+                "values (?, ?, ?, 'queued', datetime('now'))", (name, params_json, region))
+            job_id = cur.lastrowid
+            db.commit()
+        finally:
+            db.close()
+    _queue.put(job_id)
+    return job_id
+
+def get_job(job_id):
+    """Returns the saved status of the job as a dictionary, None if no such job"""
+    db = jobs_db()
+    try:
+        job = db.execute('SELECT * FROM jobs WHERE id=?', (job_id,)).fetchone()
+    finally:
+        db.close()
+    if job is None:
+        return None
+    return job_to_dict(job)
+
+def get_jobs(limit=50):
+    """Returns the most recent jobs (as dictionaries), newest first"""
+    db = jobs_db()
+    try:
+        jobs = db.execute('SELECT * FROM jobs ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+    finally:
+        db.close()
+    return [job_to_dict(x) for x in jobs]
+
+def job_to_dict(job):
+    """Formats a row from the jobs table, decoding the json parameters and result"""
+    job_dict = dict(zip(job.keys(), job))
+    job_dict['region'] = job['region'] or app.config['DEFAULT_REGION']
+    job_dict['params'] = json.loads(job['params'])
+    if job['result'] is not None:
+        job_dict['result'] = json.loads(job['result'])
+    return job_dict
+
+def start_workers():
+    """Starts the worker threads (once per process). Jobs left queued by a previous
+    server are queued again, jobs left running are marked as failed"""
+    with _lock:
+        if _workers:
+            return
+        db = jobs_db()
+        cur = db.cursor()
+        cur.execute("UPDATE jobs SET status='failed', message='Interrupted by server restart', " + \
+            "finished_at=datetime('now') WHERE status='running'")
+        cur.execute("SELECT id FROM jobs WHERE status='queued' ORDER BY id ASC")
+        for job in cur.fetchall():
+            _queue.put(job['id'])
+        db.commit()
+        db.close()
+        for idx in range(max(1, int(app.config.get('JOB_WORKERS', 1)))):
+            worker = threading.Thread(target=worker_loop, name='job-worker-%d' % idx)
+            worker.daemon = True
+            worker.start()
+            _workers.append(worker)
+
+def worker_loop():
+    """Runs queued jobs forever"""
+    while True:
+        job_id = _queue.get()
+        try:
+            with app.app_context():
+                run_job(job_id)
+        except Exception as err:
+            print "Job runner error for job %s" % job_id
+            print err
+
+def run_job(job_id):
+    """Runs a single queued job (within an application context), saving its status,
+    progress, timing and result.
+    Job status is saved through a separate connection, so the job's own
+    database changes are only committed by the job"""
+    status_db = jobs_db()
+    try:
+        cur = status_db.cursor()
+        cur.execute("UPDATE jobs SET status='running', started_at=datetime('now') " + \
+            "WHERE id=? AND status='queued'", (job_id,))
+        status_db.commit()
+        if cur.rowcount != 1:
+            return # Already run (i.e. queued twice on restart)
+        cur.execute('SELECT name, params, region FROM jobs WHERE id=?', (job_id,))
+        job = cur.fetchone()
+        g.region = job['region'] or app.config['DEFAULT_REGION']
+
+        def progress(fraction, message):
+            cur.execute('UPDATE jobs SET progress=?, message=? WHERE id=?', \
+                (float(fraction), message, job_id))
+            status_db.commit()
+
+        print "Running job %d: %s %s (%s)" % (job_id, job['name'], job['params'], g.region)
+        start_time = time.time()
+        try:
+            result = JOB_FUNCTIONS[job['name']](progress, **json.loads(job['params']))
+        except Exception as err:
+            # The failed job's uncommitted changes would hold the database's write lock
+            if hasattr(g, 'sqlite_db'):
+                g.sqlite_db.rollback()
+            cur.execute("UPDATE jobs SET status='failed', message=?, finished_at=datetime('now'), " + \
+                "duration=? WHERE id=?", (str(err), time.time()-start_time, job_id))
+        else:
+            cur.execute("UPDATE jobs SET status='done', progress=1.0, message='Complete', result=?, " + \
+                "finished_at=datetime('now'), duration=? WHERE id=?", \
+                (json.dumps(result), time.time()-start_time, job_id))
+        status_db.commit()
+    finally:
+        status_db.close()
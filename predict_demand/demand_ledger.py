@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# Replay-safe ingestion, a ledger of ingested batches and per-login dedup.
+#
+# Every posted batch of logins is fingerprinted (sha256 of its sorted timestamps, so
+# the same logins in any order match) and recorded in the ingest_ledger table within
+# the same transaction as its logins, along with the client's optional batch id.
+# A batch whose fingerprint (or batch id) is already in the ledger is a replay and is
+# rejected, found through the table's primary key (or batch id index).
+# If DEDUP_TIMESTAMPS is set, logins with a timestamp already seen (in this or any
+# earlier batch) within the last DEDUP_WINDOW_DAYS days are dropped.  Seen timestamps
+# are kept in a Bloom filter per day (dedup_filters table, DEDUP_DAY_CAPACITY logins
+# at DEDUP_ERROR_RATE false positives), filters of days before the window are dropped,
+# so memory stays bounded.  Logins older than the window are not checked.
+
+from predict_demand import app, db_helper as dbh
+import re
+import math
+import hashlib
+import sqlite3
+import datetime
+import numpy as np
+
+DAY = re.compile(r'^\d{4}-\d\d-\d\d$')
+
+def batch_fingerprint(login_data):
+    """Returns the fingerprint of a batch of login timestamps, independent of their order"""
+    content = u'\n'.join(sorted([unicode(x) for x in login_data]))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def record_batch(cur, login_data, batch_id=None):
+    """Records the batch in the ingest ledger (committed by the caller, along with its
+    logins), returns its fingerprint.
+    Returns a replay dictionary (error, the earlier batch's fingerprint, batch id and
+    time ingested) instead if the batch, or its batch id, has already been ingested"""
+    fingerprint = batch_fingerprint(login_data)
+    try:
+        cur.execute('INSERT INTO ingest_ledger (fingerprint, batch_id, num_logins, ingested_at) ' + \
+            "values (?, ?, ?, datetime('now'))", (fingerprint, batch_id, len(login_data)))
+    except sqlite3.IntegrityError:
+        cur.execute('SELECT fingerprint, batch_id, num_logins, ingested_at FROM ingest_ledger ' + \
+            'WHERE fingerprint=? OR batch_id=?', (fingerprint, batch_id))
+        earlier = cur.fetchone()
+        return {'error':'Batch already ingested', 'replayed': True, 'fingerprint': earlier['fingerprint'],
+            'batch_id': earlier['batch_id'], 'num_logins': earlier['num_logins'],
+            'ingested_at': earlier['ingested_at']}
+    return fingerprint
+
+def get_ledger(limit=50):
+    """Returns the most recently ingested batches, newest first"""
+    rows = dbh.query_db('SELECT fingerprint, batch_id, num_logins, ingested_at FROM ingest_ledger ' + \
+        'ORDER BY rowid DESC LIMIT ?', (limit,))
+    return [dict(zip(x.keys(), x)) for x in rows]
+
+def bloom_size(capacity, error_rate):
+    """Returns (bits, hashes) of a Bloom filter holding capacity keys at the error rate"""
+    bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2)**2))
+    bits += -bits % 8 # Whole bytes
+    return (bits, max(1, int(round(float(bits) / capacity * math.log(2)))))
+
+def bloom_indexes(keys, bits, hashes):
+    """Returns the keys x hashes array of bit indexes of each key, double hashing
+    the two halves of the key's md5"""
+    digests = np.frombuffer(''.join([hashlib.md5(x.encode('utf-8')).digest() for x in keys]), \
+        dtype='<u8').reshape(len(keys), 2)
+    steps = np.arange(hashes, dtype=np.uint64)
+    return (digests[:, 0:1] + steps * digests[:, 1:2]) % np.uint64(bits)
+
+def dedup_logins(cur, login_data):
+    """Returns (logins, duplicates) tuple, the logins of the batch whose timestamps
+    have not been seen within the dedup window (or are older than it) and the number
+    of logins dropped.  Updates the days' Bloom filters, committed by the caller"""
+    keys = [unicode(x) for x in login_data]
+    days = np.array([x[0:10] for x in keys])
+    cur.execute("SELECT value FROM pipeline_state WHERE key='dedup_latest_day'")
+    saved = cur.fetchone()
+    latest_day = max([saved[0] if saved else ''] + [x for x in set(days.tolist()) if DAY.match(x)])
+    if not latest_day:
+        return (login_data, 0) # No valid days
+    first_day = (datetime.datetime.strptime(latest_day, '%Y-%m-%d') - \
+        datetime.timedelta(days=app.config['DEDUP_WINDOW_DAYS']-1)).strftime('%Y-%m-%d')
+    bits, hashes = bloom_size(app.config['DEDUP_DAY_CAPACITY'], app.config['DEDUP_ERROR_RATE'])
+    keep = np.ones(len(keys), dtype=bool)
+    for day in np.unique(days[(days >= first_day) & (days <= latest_day)]):
+        in_day = np.flatnonzero(days == day)
+        # Repeats within the batch, only the first is kept
+        unique_keys, first_idx = np.unique(np.array([keys[x] for x in in_day]), return_index=True)
+        keep[in_day] = False
+        cur.execute('SELECT bits FROM dedup_filters WHERE day=?', (day,))
+        saved_filter = cur.fetchone()
+        if saved_filter is not None and len(saved_filter[0]) == bits // 8:
+            day_filter = np.frombuffer(saved_filter[0], dtype=np.uint8).copy()
+        else:
+            day_filter = np.zeros(bits // 8, dtype=np.uint8)
+        indexes = bloom_indexes(unique_keys.tolist(), bits, hashes)
+        masks = (np.uint8(1) << (indexes % np.uint64(8)).astype(np.uint8))
+        seen = ((day_filter[indexes // np.uint64(8)] & masks) != 0).all(axis=1)
+        keep[in_day[first_idx[~seen]]] = True
+        np.bitwise_or.at(day_filter, (indexes // np.uint64(8)).ravel().astype(np.int64), masks.ravel())
+        cur.execute('INSERT or REPLACE into dedup_filters (day, bits) values (?, ?)', \
+            (day, sqlite3.Binary(day_filter.tostring())))
+    cur.execute('DELETE FROM dedup_filters WHERE day<?', (first_day,))
+    dbh.set_state(cur, 'dedup_latest_day', latest_day)
+    return ([x for x, ok in zip(login_data, keep) if ok], int(len(keys) - keep.sum()))
@@ -23,44 +23,72 @@
 #   over neighboring hours, then re-extrapolated based on the weighted mean).
 #
 
-from predict_demand import db_helper as dbh, demand_formatter as defo, \
-    demand_plotter as depl, demand_predictor as depr 
+from predict_demand import app, db_helper as dbh, demand_formatter as defo, \
+    demand_plotter as depl, demand_predictor as depr, demand_calendar as deca, \
+    demand_render as deren, demand_sketch as desk, demand_archive as dear, \
+    demand_timezone as detz, demand_ledger as dele
 import os
+import itertools
+import collections
+import numpy as np
 import csv
 import sqlite3
 import json
-from collections import deque
+import time
 
-def api_insert(json_data, single=None):
+# Rollup period: (table, key column)
+ROLLUPS = {'day': ('daily_rollup', 'day'), 'week': ('weekly_rollup', 'week')}
+# Day name & plot name of each day of the week's box plots
+WEEKDAY_PLOTS = [('Mo', '1_Monday'), ('Tu', '2_Tuesday'), ('We', '3_Wednesday'), ('Th', '4_Thursday'), \
+    ('Fr', '5_Friday'), ('Sa', '6_Saturday'), ('Su', '7_Sunday')]
+# Ids per "IN (...)" lookup (two lists of variables stay below SQLite's limit of 999)
+QUERY_CHUNK = 400
+# Archived model versions are the model and the last history hour it was fit on
+# (model/yyyy-mm-ddThh), older versions are the model alone
+ARCHIVE_FIT_SUFFIX = "model_version GLOB '*/[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]T[0-9][0-9]'"
+ARCHIVE_MODEL = 'CASE WHEN %s THEN substr(model_version, 1, length(model_version)-14) ' % ARCHIVE_FIT_SUFFIX + \
+    'ELSE model_version END'
+ARCHIVE_FIT_HOUR = 'CASE WHEN %s THEN substr(model_version, -13) END' % ARCHIVE_FIT_SUFFIX
+
+_prediction_etags = {} # database: (etag, time loaded)
+_fitted_models = {}    # database: (etag, fitted model)
+
+def api_insert(json_data, single=None, batch_id=None):
     """Inserts client login timestamp data to the database.
     Input parameter single specifies if json_data is a single timestamp or a list
-    of timestamps."""
+    of timestamps, batch_id is the client's optional id of the post."""
     if single:
-        return add_single_login(json_data)
+        return add_single_login(json_data, batch_id)
     else:
-        return add_multiple_logins(json_data)
+        return add_multiple_logins(json_data, batch_id)
 
 def api_update_predictions(num_days_to_predict):
     """Updates the predictions based on historic logins that are contained within
-    the database.  Deletes existing predictions that have actual data for matching
+    the database.  Archives existing predictions that have actual data for matching
     days and loads the predetermined outliers.  
     The input paramter num_days_to_predict specifies the number of days that will
     be predicted, starting at the day following the latest actual (historic) timestamp."""
-    if num_days_to_predict <= 0:
-        return {'error':'Number of days to predict must be positive'}
-    if num_days_to_predict >= 100:
-        return {'error':'Cannot predict more than 99 days forward'}
-    delete_predictions_with_actuals()
-    mark_predetermined_outliers()
+    error_msg = validate_num_days(num_days_to_predict)
+    if error_msg is not None:
+        return error_msg
+    mark_predetermined_outliers(num_days_to_predict)
+    update_mad_scores()
+    # Archive and new predictions are committed together (by predict_demand, nothing
+    # is committed in between), so readers always see a complete set of predictions
+    archive_predictions_with_actuals(commit=None)
     db = dbh.get_db()
     cur = db.cursor()
     cur.execute('SELECT id FROM login_history ORDER BY id DESC')
     latest = cur.fetchone() # Get latest id so we can start predictions on following day
     if latest:
         next_year, next_month, next_day = defo.tp_add_x_days_to_id(latest['id'], 1)
-        return predict_demand(next_year,next_month,next_day,num_days_to_predict)
+        predictions = predict_demand(next_year,next_month,next_day,num_days_to_predict)
     else:
-        return {'error':'No data in login_history DB'}
+        predictions = {'error':'No data in login_history DB'}
+    if 'error' in predictions:
+        # Archived predictions are kept until they can be replaced
+        db.rollback()
+    return predictions
 
 def api_predict(num_days_to_predict):
     """Returns the predicted values that are in the database.
@@ -69,10 +97,9 @@ def api_predict(num_days_to_predict):
     to be returned.  If this value exceeds the number of predicted days currently
     in the database, returns an error."""
     if num_days_to_predict is not None:
-        if num_days_to_predict <= 0:
-            return {'error':'Number of days to predict must be positive'}
-        if num_days_to_predict >= 100:
-            return {'error':'Cannot predict more than 99 days forward'}
+        error_msg = validate_num_days(num_days_to_predict)
+        if error_msg is not None:
+            return error_msg
     
     try:
         db = dbh.get_db()
@@ -109,9 +136,193 @@ def api_predict(num_days_to_predict):
     else:
         return {'error':'No data in login_history DB'}
 
+def validate_num_days(num_days_to_predict):
+    """Returns error dictionary if the number of days to predict is out of range,
+    None if valid"""
+    if num_days_to_predict <= 0:
+        return {'error':'Number of days to predict must be positive'}
+    if num_days_to_predict >= 100:
+        return {'error':'Cannot predict more than 99 days forward'}
+    return None
+
+def api_predict_range(start_id=None, end_id=None, cursor=None, limit=None):
+    """Returns one page of the predicted values that are in the database, from
+    start_id (inclusive) to end_id (exclusive), where either bound is optional.
+    A page holds at most limit hours (API_PAGE_SIZE if None) following the cursor,
+    which is the last id of the previous page.
+    Returns dictionary with the ordered list of 'predictions' (id and num_logins)
+    and the 'next_cursor' to request the following page (None on the last page)"""
+    if limit is None:
+        limit = app.config['API_PAGE_SIZE']
+    if limit <= 0 or limit > app.config['API_MAX_PAGE_SIZE']:
+        return {'error':'Limit must be from 1 to %d hours' % app.config['API_MAX_PAGE_SIZE']}
+    conditions = []
+    args = []
+    for name, value, condition in (('start', start_id, 'id>=?'), ('end', end_id, 'id<?'), \
+                                   ('cursor', cursor, 'id>?')):
+        if value is not None:
+            valid_id = defo.validate_id(value)
+            if valid_id is None:
+                return {'error':'Invalid %s hour' % name, '%s_example' % name: '2012-05-01T00'}
+            conditions.append(condition)
+            args.append(valid_id)
+    query = 'SELECT id, num_logins FROM login_predictions'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    predictions = dbh.query_db(query + ' ORDER BY id ASC LIMIT ?', args + [limit+1])
+    next_cursor = None
+    if len(predictions) > limit:
+        predictions = predictions[:limit]
+        next_cursor = predictions[-1]['id']
+    return {'predictions': [{'id': x['id'], 'num_logins': x['num_logins']} for x in predictions],
+            'next_cursor': next_cursor}
+
+def api_predict_query(hour_list):
+    """Returns the predicted logins for each requested hour (list of ids),
+    without writing to the database.  Hours with saved predictions are read from
+    login_predictions, hours with actual data from login_history, and hours beyond
+    the saved predictions (up to 99 days after the first predicted day) are evaluated
+    from the model fitted by the latest prediction update, including predicted
+    outlier multipliers.
+    Returns dictionary with the 'model_version' and 'predictions', a list (in the
+    requested order) of id, num_logins and source ('stored', 'history', 'model',
+    or None with num_logins None if the hour cannot be predicted)"""
+    if type(hour_list) is not list or not hour_list:
+        return {'error':'Needs a list of hours', 'hours_example':['2012-05-01T00', '2012-06-01T12']}
+    if len(hour_list) > app.config['API_MAX_QUERY_HOURS']:
+        return {'error':'Cannot query more than %d hours at once' % app.config['API_MAX_QUERY_HOURS']}
+    ids = [defo.validate_id(x) for x in hour_list]
+    invalid = [hour_list[idx] for idx, x in enumerate(ids) if x is None]
+    if invalid:
+        return {'error':'Invalid hours, format: 2012-05-01T00', 'invalid':invalid[0:10]}
+    found = {} # id: (num_logins, source)
+    unique_ids = sorted(set(ids))
+    for idx in range(0, len(unique_ids), QUERY_CHUNK):
+        chunk = unique_ids[idx:idx+QUERY_CHUNK]
+        marks = ','.join('?'*len(chunk))
+        rows = dbh.query_db(("SELECT id, num_logins, 'history' AS source FROM login_history WHERE id IN (%s) " + \
+            "UNION ALL SELECT id, num_logins, 'stored' FROM login_predictions WHERE id IN (%s)") % (marks, marks), \
+            chunk + chunk)
+        for row in rows:
+            # Actual data wins over predictions not archived yet
+            if row['id'] not in found or row['source'] == 'history':
+                found[row['id']] = (row['num_logins'], row['source'])
+    model = get_fitted_model()
+    remaining = [x for x in unique_ids if x not in found]
+    if remaining and model is not None:
+        # Same horizon as validate_num_days
+        last_id = defo.add_x_hours(model['start_id'], 24*100)
+        remaining = [x for x in remaining if x >= model['start_id'] and x < last_id]
+        multipliers = get_prediction_multipliers(remaining)
+        for pred_id in remaining:
+            found[pred_id] = (evaluate_model(model, pred_id)*multipliers.get(pred_id, 1.0), 'model')
+    return {'model_version': model['model_version'] if model is not None else None,
+            'predictions': [{'id': x, 'num_logins': found.get(x, (None, None))[0], \
+                             'source': found.get(x, (None, None))[1]} for x in ids]}
+
+def get_fitted_model():
+    """Returns the model fitted by the latest prediction update (dictionary of
+    first_id, start_id, predictions, slopes and model_version), None if predictions
+    have never been updated.  The parsed model is cached until predictions change"""
+    etag = get_prediction_etag()
+    cached = _fitted_models.get(dbh.database_path())
+    if cached is not None and cached[0] == etag:
+        return cached[1]
+    model_json = dbh.get_state('fitted_model')
+    model = json.loads(model_json) if model_json else None
+    _fitted_models[dbh.database_path()] = (etag, model)
+    return model
+
+def evaluate_model(model, pred_id):
+    """Returns the predicted logins of the fitted model for a single hour
+    (on or after the model's first predicted day), extrapolated the same way
+    as predict_demand, before predicted outlier multipliers"""
+    delta_days = defo.dy_delta_days(model['first_id'], model['start_id'])
+    count = defo.dy_subtract_ids(pred_id, model['start_id'])
+    extrap_weeks = int(delta_days+count/7)
+    offset = int(defo.hr_subtract_ids(pred_id, model['first_id'])%(24*7))
+    return model['predictions'][offset] + extrap_weeks*model['slopes'][offset]
+
+def get_prediction_multipliers(id_list):
+    """Returns dictionary of predicted outlier multipliers for the ids, from
+    prediction_outliers and the event calendar (calendar events win, the same as
+    when mark_predetermined_outliers saves them), without writing to the database"""
+    multipliers = {}
+    if not id_list:
+        return multipliers
+    for idx in range(0, len(id_list), QUERY_CHUNK):
+        chunk = id_list[idx:idx+QUERY_CHUNK]
+        rows = dbh.query_db('SELECT id, multiplier FROM prediction_outliers WHERE id IN (%s)' % \
+            ','.join('?'*len(chunk)), chunk)
+        multipliers.update([(str(x['id']), float(x['multiplier'])) for x in rows])
+    try:
+        history, predicted = deca.expand_calendar(app.config['EVENT_CALENDAR'], min(id_list), max(id_list))
+    except (IOError, ValueError) as err:
+        print "Error reading event calendar"
+        print err
+        predicted = []
+    wanted = set(id_list)
+    for pred_id, multiplier, reason in predicted:
+        if pred_id in wanted:
+            multipliers[pred_id] = multiplier
+    return multipliers
+
+def get_prediction_etag():
+    """Returns the ETag of the saved predictions (database creation time and
+    prediction_version), cached in memory for PREDICTION_VERSION_TTL seconds so
+    conditional requests don't touch the database.
+    Saving predictions within this process updates the cached value immediately"""
+    cached = _prediction_etags.get(dbh.database_path())
+    if cached is not None and time.time() - cached[1] < app.config['PREDICTION_VERSION_TTL']:
+        return cached[0]
+    return refresh_prediction_etag()
+
+def refresh_prediction_etag():
+    """Reloads the ETag of the saved predictions from the database"""
+    etag = 'p%s-%s' % (dbh.get_state('created', ''), dbh.get_state('prediction_version', '0'))
+    _prediction_etags[dbh.database_path()] = (etag, time.time())
+    return etag
+
 def initialize():
     """Clears the existing data, reloads the SQL tables"""
     dbh.init_db()
+    dear.delete_archives(dbh.current_region())
+    _prediction_etags.pop(dbh.database_path(), None)
+    _fitted_models.pop(dbh.database_path(), None)
+
+def get_regions():
+    """Returns a summary of every region's database, a list of dictionaries of
+    region, hours (of history), first and last history hour and data_version"""
+    regions = []
+    for region in dbh.list_regions():
+        db = dbh.connect_db(region)
+        try:
+            cur = db.cursor()
+            cur.execute('SELECT MIN(id), MAX(id) FROM login_history')
+            first_id, last_id = cur.fetchone()
+            cur.execute('SELECT SUM(num_hours) FROM daily_rollup')
+            num_hours = cur.fetchone()[0] or 0
+            cur.execute("SELECT value FROM pipeline_state WHERE key='data_version'")
+            data_version = cur.fetchone()
+        finally:
+            db.close()
+        regions.append({'region': region, 'hours': num_hours, 'first': first_id, 'last': last_id,
+            'data_version': int(data_version[0]) if data_version else 0})
+    return regions
+
+def delete_region(region):
+    """Deletes the region's database (history, predictions and outliers).
+    Returns error dictionary if the region can't be deleted, None if deleted"""
+    if region == app.config['DEFAULT_REGION']:
+        return {'error':'The default region can only be cleared, not deleted'}
+    if not dbh.region_exists(region):
+        return {'error':'No such region'}
+    path = dbh.database_path(region)
+    dbh.delete_region(region)
+    dear.delete_archives(region)
+    _prediction_etags.pop(path, None)
+    _fitted_models.pop(path, None)
+    return None
 
 def get_login_history():
     """Returns the entire contents of the read-in historic client
@@ -124,6 +335,79 @@ def get_login_history():
         print err
         return []
 
+def get_history_rollup(period='day', before=None, after=None, limit=None):
+    """Returns one page (ROLLUP_PAGE_SIZE rows if limit is None) of the daily
+    (period 'day') or weekly ('week') login rollups, newest first.
+    Pages are found by key (keyset pagination), the rows older than before or
+    newer than after (yyyy-mm-dd), so every page is an indexed range read
+    regardless of the size of the history.
+    Returns dictionary with the 'rows' (key, num_logins, num_hours, peak_logins and
+    the day following the period as 'end') and the 'older' and 'newer' keys
+    to request the neighboring pages (None if there are no more rows)"""
+    table, key = ROLLUPS[period]
+    if limit is None:
+        limit = app.config['ROLLUP_PAGE_SIZE']
+    columns = "%s AS key, num_logins, num_hours, peak_logins, date(%s, '+%d days') AS end" % \
+        (key, key, 1 if period == 'day' else 7)
+    before = defo.validate_day(before) if before is not None else None
+    after = defo.validate_day(after) if after is not None else None
+    if after is not None:
+        rows = dbh.query_db('SELECT %s FROM %s WHERE %s>? ORDER BY %s ASC LIMIT ?' % \
+            (columns, table, key, key), (after, limit))
+        rows.reverse()
+    elif before is not None:
+        rows = dbh.query_db('SELECT %s FROM %s WHERE %s<? ORDER BY %s DESC LIMIT ?' % \
+            (columns, table, key, key), (before, limit))
+    else:
+        rows = dbh.query_db('SELECT %s FROM %s ORDER BY %s DESC LIMIT ?' % \
+            (columns, table, key), (limit,))
+    newer = None
+    older = None
+    if rows:
+        if dbh.query_db('SELECT 1 FROM %s WHERE %s>?' % (table, key), (rows[0]['key'],), one=True):
+            newer = rows[0]['key']
+        if dbh.query_db('SELECT 1 FROM %s WHERE %s<?' % (table, key), (rows[-1]['key'],), one=True):
+            older = rows[-1]['key']
+    return {'rows': rows, 'older': older, 'newer': newer}
+
+def get_prediction_rollup():
+    """Returns the daily totals of the saved predictions (key, num_logins,
+    num_hours and peak_logins), in order.  Predictions span at most 99 days"""
+    return dbh.query_db('SELECT substr(id,1,10) AS key, SUM(num_logins) AS num_logins, ' + \
+        'COUNT(*) AS num_hours, MAX(num_logins) AS peak_logins FROM login_predictions ' + \
+        'GROUP BY substr(id,1,10) ORDER BY key ASC')
+
+def get_day_detail(day):
+    """Returns the hourly history and predictions of a single day (yyyy-mm-dd)
+    as dictionary of 'history' and 'predictions' lists (id & num_logins), with the
+    'previous' and 'next' days, None if the day is invalid"""
+    day = defo.validate_day(day)
+    if day is None:
+        return None
+    bounds = (day+'T00', day+'T23')
+    return {'day': day,
+        'history': dbh.query_db('SELECT id, num_logins FROM login_history ' + \
+            'WHERE id>=? AND id<=? ORDER BY id ASC', bounds),
+        'predictions': dbh.query_db('SELECT id, num_logins FROM login_predictions ' + \
+            'WHERE id>=? AND id<=? ORDER BY id ASC', bounds),
+        'previous': defo.get_id_str(*defo.tp_add_x_days_to_id(day+'T00', -1)+(0,))[0:10],
+        'next': defo.get_id_str(*defo.tp_add_x_days_to_id(day+'T00', 1)+(0,))[0:10]}
+
+def update_rollups(cur, id_list):
+    """Recomputes the daily_rollup of the days of the given history ids from
+    login_history, and the weekly_rollup of their weeks from daily_rollup,
+    committed by the caller"""
+    days = sorted(set([str(x)[0:10] for x in id_list]))
+    cur.executemany('INSERT or REPLACE into daily_rollup (day, num_logins, num_hours, peak_logins) ' + \
+        'SELECT substr(id,1,10), SUM(num_logins), COUNT(*), MAX(num_logins) FROM login_history ' + \
+        'WHERE id>=? AND id<=? GROUP BY substr(id,1,10)', [(x+'T00', x+'T23') for x in days])
+    weeks = sorted(set([defo.get_week_start(x) for x in days]))
+    cur.executemany('INSERT or REPLACE into weekly_rollup ' + \
+        '(week, num_logins, num_hours, peak_logins, num_days) ' + \
+        'SELECT ?, SUM(num_logins), SUM(num_hours), MAX(peak_logins), COUNT(*) FROM daily_rollup ' + \
+        "WHERE day>=? AND day<date(?, '+7 days') GROUP BY date(day,'-6 days','weekday 1')", \
+        [(x, x, x) for x in weeks])
+
 def get_predictions():
     """Returns the entire contents of the future predicted data from the
     login_predictions database.
@@ -172,16 +456,63 @@ def load_json_file(json_filename):
             
     return None
 
-def add_multiple_logins(login_data):
-    login_dict = defo.datetimes_to_dict(login_data)
+def market_timezone():
+    """Returns the timezone logins of the current region are binned in (its
+    REGION_TIMEZONES entry, or MARKET_TIMEZONE), None to bin timestamps as written"""
+    return app.config['REGION_TIMEZONES'].get(dbh.current_region(), app.config['MARKET_TIMEZONE'])
+
+def validate_timezone(cur):
+    """Returns error dictionary if the current region's timezone is unknown, or is not
+    the timezone its history has been binned in, None if valid.
+    The timezone of a region's first history is saved (committed by the caller),
+    history saved before timezones were tracked was binned as written"""
+    zone = market_timezone()
+    if zone is not None:
+        try:
+            detz.load_zone(zone)
+        except (IOError, ValueError):
+            return {'error':'Unknown timezone', 'timezone': zone}
+    saved = dbh.get_state('timezone')
+    if saved is None:
+        cur.execute('SELECT EXISTS (SELECT 1 FROM login_history) OR EXISTS (SELECT 1 FROM daily_rollup)')
+        saved = '' if cur.fetchone()[0] else (zone or '')
+        dbh.set_state(cur, 'timezone', saved)
+    if saved != (zone or ''):
+        return {'error':'History is binned in another timezone', 'timezone': saved or None}
+    return None
+
+def add_multiple_logins(login_data, batch_id=None):
+    """Adds a batch of client login timestamps to the database, recorded in the
+    ingest ledger so replays of the batch (or batch id) are rejected, and dropping
+    already seen timestamps if DEDUP_TIMESTAMPS (see demand_ledger)"""
+    db = dbh.get_db()
+    cur = db.cursor()
+    error_msg = validate_timezone(cur)
+    if error_msg is not None:
+        return error_msg
+    fingerprint = dele.record_batch(cur, login_data, batch_id)
+    if type(fingerprint) is dict:
+        db.rollback()
+        return fingerprint
+    duplicates = 0
+    if app.config['DEDUP_TIMESTAMPS']:
+        login_data, duplicates = dele.dedup_logins(cur, login_data)
+    login_dict = defo.datetimes_to_dict(login_data, market_timezone())
+    if not login_dict and duplicates:
+        db.commit()
+        return {'duplicates': duplicates, 'timestamps': [], 'fingerprint': fingerprint}
     if not login_dict:
+        db.rollback()
         return { 'error': 'No valid timestamps', 
             'timestamps_example': '["2012-03-01T00:05:55+00:00", "2012-03-01T00:06:23+00:00"]'}
     else:
         latest_dt = None
-        db = dbh.get_db()
-        cur = db.cursor()
+        # Late logins for compacted days, reload the days' archived hours first
+        reload_history(cur, [(x[0:10], x[0:10]) for x in archived_ids(cur, login_dict.keys())])
         added_logins = {}
+        inserted_ids = []
+        added = []   # Sketch changes, (day_name, hour, num_logins, count)
+        removed = []
         for id_str,hour in login_dict.items():
             #print "Read in hour: %s"%(id_str)
             cur_hour = len(hour) # simple count of logins in this hour
@@ -190,7 +521,10 @@ def add_multiple_logins(login_data):
             if match:
                 print 'Updating hour count: %d + %d' % (match['num_logins'], cur_hour)
                 cur.execute('UPDATE login_history SET num_logins=? WHERE id=?', (match['num_logins']+cur_hour, id_str))
+                cur.execute('UPDATE forecast_archive SET actual_logins=? WHERE id=?', (match['num_logins']+cur_hour, id_str))
                 added_logins['update'] = added_logins.get('update',0) + 1
+                removed.append((match['day_name'], match['hour'], match['num_logins'], 1))
+                added.append((match['day_name'], match['hour'], match['num_logins']+cur_hour, 1))
             else:
                 print 'Adding %s with %d logins' % (id_str,len(hour))
                 cur.execute('INSERT INTO login_history ' + \
@@ -198,23 +532,49 @@ def add_multiple_logins(login_data):
                     'values (?, ?, ?, ?)', \
                     (id_str, defo.get_day_2char(id_str), defo.get_hour(id_str), cur_hour))
                 added_logins['insert'] = added_logins.get('insert',0) + 1
+                inserted_ids.append(id_str)
+                added.append((defo.get_day_2char(id_str), int(defo.get_hour(id_str)), cur_hour, 1))
+        update_slot_sketches(cur, added, removed)
+        mark_slots_dirty(cur, login_dict.keys())
+        update_rollups(cur, login_dict.keys())
+        if inserted_ids:
+            lower_fill_mark(cur, inserted_ids)
+        dbh.increment_state(cur, 'data_version')
         # Commit changes
         db.commit()
         added_logins['timestamps'] = login_dict.keys()
+        added_logins['fingerprint'] = fingerprint
+        if app.config['DEDUP_TIMESTAMPS']:
+            added_logins['duplicates'] = duplicates
         return added_logins
     
 
-def add_single_login(login_timestamp):
+def add_single_login(login_timestamp, batch_id=None):
     """Loads one client login data point i.e. "2012-03-01T00:05:55+00:00",
     into the database.  If hour entry exists, adds 1 to existing value.
+    Given a batch_id, the login is recorded in the ingest ledger (as a batch of one),
+    so a retried post is rejected.  Without one, single logins are not recorded, as
+    identical timestamps may be separate logins.
     Returns error message if anything goes wrong.
     """
-    login_dt = defo.validate_login_string(login_timestamp)
+    db = dbh.get_db()
+    cur = db.cursor()
+    error_msg = validate_timezone(cur)
+    if error_msg is not None:
+        return error_msg
+    login_dt = defo.validate_login_string(login_timestamp, market_timezone())
     if login_dt is None:
         return { 'error': 'Invalid timestamp', 
              'timestamp_example': '2012-03-01T00:05:55+00:00' }
-    db = dbh.get_db()
-    cur = db.cursor()
+    if batch_id is not None:
+        fingerprint = dele.record_batch(cur, [login_timestamp], batch_id)
+        if type(fingerprint) is dict:
+            db.rollback()
+            return fingerprint
+    if app.config['DEDUP_TIMESTAMPS'] and dele.dedup_logins(cur, [login_timestamp])[1]:
+        db.commit()
+        return {'duplicates': 1, 'timestamp': login_timestamp}
+    reload_history(cur, [(x[0:10], x[0:10]) for x in archived_ids(cur, [login_dt])])
     cur.execute('SELECT * FROM login_history WHERE id=?', (login_dt,))
     match = cur.fetchone()
     print login_dt
@@ -225,7 +585,10 @@ def add_single_login(login_timestamp):
         # Update hour entry, add 1 to existing value
         print match['num_logins']
         cur.execute('UPDATE login_history SET num_logins=? WHERE id=?', (1+match['num_logins'], login_dt))
+        cur.execute('UPDATE forecast_archive SET actual_logins=? WHERE id=?', (1+match['num_logins'], login_dt))
         added_login['update'] = 1
+        update_slot_sketches(cur, [(match['day_name'], match['hour'], 1+match['num_logins'], 1)], \
+            [(match['day_name'], match['hour'], match['num_logins'], 1)])
     else:
         # Entry does not exist
         cur.execute('INSERT INTO login_history ' + \
@@ -233,6 +596,11 @@ def add_single_login(login_timestamp):
             'values (?, ?, ?, ?)', \
             (login_dt,defo.get_day_2char(login_dt), defo.get_hour(login_dt),1))
         added_login['insert'] = 1
+        update_slot_sketches(cur, [(defo.get_day_2char(login_dt), int(defo.get_hour(login_dt)), 1, 1)])
+        lower_fill_mark(cur, [login_dt])
+    mark_slots_dirty(cur, [login_dt])
+    update_rollups(cur, [login_dt])
+    dbh.increment_state(cur, 'data_version')
     db.commit()
     added_login['timestamp'] = login_timestamp
     return added_login
@@ -243,21 +611,18 @@ def run_analytics(debug=1):
     Pass empty array [] to turn off debug printouts"""
     db = dbh.get_db()
     cur = db.cursor()
-    cur.execute('SELECT * FROM login_history ORDER BY id ASC')
-    all_data = cur.fetchall()
-    cur.execute('SELECT * FROM history_outliers')
-    outlier_data = cur.fetchall()
-    cur.execute('SELECT * FROM prediction_outliers')
-    predicted_outlier_data = cur.fetchall()
+    all_data, outlier_data, mad_masks = get_fit_history(cur)
     if not all_data:
         print "No data loaded in DB"
         return
-    predicted_ids,predictions,predicted_slopes=depr.lin_reg_by_hour(all_data,outlier_data,debug)
+    predicted_ids,predictions,predicted_slopes=depr.lin_reg_by_hour(all_data,outlier_data,debug,mad_masks, \
+        app.config['FIT_LOOKBACK_WEEKS'], app.config['FIT_WEIGHTING'])
     depl.scatter_plot(range(len(predicted_slopes)),predicted_slopes,'Predicted_Slopes','Hour','Slope',predicted_ids[-1])
     
 def plot_logins():
     """Use the loaded history of client login data to create plots,
     which are saved within the predict_demand/plots folder.
+    Plots are rendered in parallel (see demand_render), returns the timing report.
     Used for manual analysis"""
     print "Running analytics on DB\n"
     db = dbh.get_db()
@@ -268,141 +633,168 @@ def plot_logins():
         print "No data loaded in DB"
         return
     
-    # Tabulate by hour
-    hour_x = []
-    hour_y = []
-    base_day = None
+    # Day totals, slot distributions & complete weeks come from the rollup tables
+    # (daily_rollup kept up to date by ingest, slot_stats by update_mad_scores)
+    update_mad_scores()
     
     ## Get first predicted day (1 day past last history day)
     pred_year,pred_month,pred_day = defo.tp_add_x_days_to_id(all_data[-1]['id'],1)
     
-    ## Plot trends per day over time (for first week predictions)
+    # Every plot is a render task with its own slice of the data
+    tasks = []
+    ## Plot trends per day over time (for first week predictions),
+    ## from the history pivoted to weeks x day of week x hour
+    pred_ids = []
     for i in range(7):
-        pred_day_str = defo.get_day_str(pred_year, pred_month, pred_day)
-        hist_day = filter(lambda x: x['day_name']==pred_day_str, all_data)
-        pred_id = defo.get_id_str(pred_year, pred_month, pred_day, 00)
-        depl.plot_day_trend(pred_id, hist_day)
+        pred_ids.append(defo.get_id_str(pred_year, pred_month, pred_day, 00))
         pred_year,pred_month,pred_day = defo.tp_add_x_days(pred_year,pred_month,pred_day,1)
-    # Weekday analysis
-    depl.plot_weekdays([(x['id'],x['num_logins']) for x in all_data \
-        if x['day_name'] in ['Mo', 'Tu', 'We', 'Th']])
+    first_monday, cube = depr.weekly_cube([x['id'] for x in all_data], [x['num_logins'] for x in all_data])
+    for pred_id, trend in zip(pred_ids, depr.day_trends(first_monday, cube, pred_ids)):
+        week_drifts = [week[~np.isnan(week)].tolist() for week in trend]
+        tasks.append(deren.task('days/ByWeek_'+defo.get_day_of_week(pred_id), 'plot_day_trend', \
+            pred_id, [x for x in week_drifts if x]))
+    # Weekday analysis, from the merged sketches of each hour from Monday to Thursday
+    weekday_stats = []
+    for hour in range(24):
+        hour_sketch = desk.merge([get_slot_sketch(cur, x, hour) for x in ['Mo', 'Tu', 'We', 'Th']])
+        if hour_sketch['count']:
+            weekday_stats.append(dict(desk.box_stats(hour_sketch), hour=hour))
+    tasks.append(deren.task('WeekdayHour', 'plot_weekdays', weekday_stats))
     
     ## Tabulate by day
-    depl.plot_each_day(all_data)
-    # Creates dictionaries for each day, 
-    #  where the keys are each hour of that day,
-    #  and values are a list of tuple pairs (id, count)
-    cur.execute('SELECT MAX(num_logins) FROM login_history')
-    max_login = cur.fetchone()[0]
-    # Monday
-    mo_dict = defo.get_hours_dict()
-    map(lambda y: mo_dict[y['hour']].append((y['id'],y['num_logins'])), \
-        filter(lambda x: x['day_name']=='Mo', all_data))
-    depl.plot_day_dict(mo_dict, '1_Monday', max_login)
-    # Tuesday
-    tu_dict = defo.get_hours_dict()
-    map(lambda y: tu_dict[y['hour']].append((y['id'],y['num_logins'])), \
-        filter(lambda x: x['day_name']=='Tu', all_data))
-    depl.plot_day_dict(tu_dict, '2_Tuesday', max_login)
-    # Wednesday
-    we_dict = defo.get_hours_dict()
-    map(lambda y: we_dict[y['hour']].append((y['id'],y['num_logins'])), \
-        filter(lambda x: x['day_name']=='We', all_data))
-    depl.plot_day_dict(we_dict, '3_Wednesday', max_login)
-    # Thursday
-    th_dict = defo.get_hours_dict()
-    map(lambda y: th_dict[y['hour']].append((y['id'],y['num_logins'])), \
-        filter(lambda x: x['day_name']=='Th', all_data))
-    depl.plot_day_dict(th_dict, '4_Thursday', max_login)
-    # Friday
-    fr_dict = defo.get_hours_dict()
-    map(lambda y: fr_dict[y['hour']].append((y['id'],y['num_logins'])), \
-        filter(lambda x: x['day_name']=='Fr', all_data))
-    depl.plot_day_dict(fr_dict, '5_Friday', max_login)
-    # Saturday
-    sa_dict = defo.get_hours_dict()
-    map(lambda y: sa_dict[y['hour']].append((y['id'],y['num_logins'])), \
-        filter(lambda x: x['day_name']=='Sa', all_data))
-    depl.plot_day_dict(sa_dict, '6_Saturday', max_login)
-    # Sunday
-    su_dict = defo.get_hours_dict()
-    map(lambda y: su_dict[y['hour']].append((y['id'],y['num_logins'])), \
-        filter(lambda x: x['day_name']=='Su', all_data))
-    depl.plot_day_dict(su_dict, '7_Sunday', max_login)
-    day_dict = {}
-    base_year = None
-    
-    ## Tabulate by week
-    # Creates list of most recent week (7 consecutive days)
-    last_complete_week_id = None
-    temp_complete = deque([])
-    min_id = None
+    cur.execute('SELECT MAX(peak_logins), MIN(day) FROM daily_rollup')
+    max_login, first_day = cur.fetchone()
+    # Each day separately, with identical y axis scales
+    for day_id,day_list in itertools.groupby(all_data, lambda x: x['id'][:-3]):
+        tasks.append(day_plot_task(list(day_list), max_login))
+    # Box plots of each hour's distribution of logins, for each day of the week
+    for day_name, day_str in WEEKDAY_PLOTS:
+        tasks.append(slot_plot_task(cur, day_name, max_login))
     
-    for entry in all_data:
-        # Getting keys of most recent consecutive week
-        if not temp_complete:
-            #print 'Starting w/ %d' % entry_doy
-            temp_complete.append(entry['id']) # add subsequent day
-        else:
-            day_delta = defo.dy_subtract_ids(entry['id'],temp_complete[-1])
-            if day_delta == 1:
-                temp_complete.append(entry['id']) # add subsequent day
-                if len(temp_complete) > 7: # can also use while
-                    temp_complete.popleft()
-                # Save id corresponding to day (hour 0) that has a complete weeks
-                # worth of previous data
-                if len(temp_complete) == 7:
-                    last_complete_week_id = entry['id']
-            elif day_delta != 0: # current entry is not the same or a subsequent day
-                temp_complete = deque([entry['id']])
-        # Save minimum (start) ID key
-        if min_id is None or min_id > entry['id']:
-            min_id = entry['id']
-        
-        # Create dictionary with key as the day of year
-        # Handle multiple years in database
-        year_str = defo.get_year(entry['id'])
-        if base_year is None:
-            base_year = year_str # if multiple years, assuming years are monotonically increasing
-        if year_str != base_year:
-            days = (int(year_str)-int(base_year))*365 # Doesn't account for leap years...
-        else:
-            days = 0
-        days = days+int(defo.get_day_of_year(entry['id']))
-        day_dict[days] = day_dict.get(days,0) + entry['num_logins']
-        if base_day is None:
-            base_day = days
-        hours = (days - base_day)*24 + entry['hour']
-        hour_x.append(hours)
-        hour_y.append(entry['num_logins'])
-    depl.scatter_plot(hour_x, hour_y)
-    depl.plot_by_day(day_dict)
+    # Day totals by day of year (of the first year, continuing past the end of the year)
+    cur.execute("SELECT CAST(julianday(day) - julianday(substr(?,1,4)||'-01-01') AS INTEGER) + 1, " + \
+        "num_logins FROM daily_rollup ORDER BY day ASC", (first_day,))
+    tasks.append(deren.task('Day_Analysis', 'plot_by_day', dict([tuple(x) for x in cur.fetchall()])))
+    # Hours since the first day of history
+    hour_x = [int(defo.hr_subtract_ids(x['id'], first_day+'T00')) for x in all_data]
+    hour_y = [x['num_logins'] for x in all_data]
+    tasks.append(deren.task('Hour_Analysis', 'scatter_plot', hour_x, hour_y))
     
-    # Need at least 1 consecutive week's worth of data
-    if last_complete_week_id is not None: 
-        print 'Plotting week data...'
-        end_id = last_complete_week_id[:-2]+'23' # Last hour of the day
-        start_id = defo.subtract_one_week(end_id)
-        print "%s to %s"%(start_id,end_id)
-        # Plot full weeks starting at the latest complete week,
-        #  where complete means there is at least one data point for 7 consecutive days
-        # Lexigraphical (default) string comparison should work with ID format yyyy-hh-ddThh
-        while end_id > min_id:
-            cur.execute('SELECT id, num_logins FROM login_history WHERE id>? AND id <=? ' \
-                + 'ORDER BY id ASC', (start_id, end_id))
-            wk_data = cur.fetchall() # Data from an entire week, sorted by most recent first
-            # Find the time delta in hours (compute negative x values so  
-            #  the most recent is on the right)
-            if wk_data:
-                last_time = wk_data[-1][0]
-                time_delta = map(lambda entry: defo.hr_subtract_ids(entry[0], last_time), wk_data)
-                id_list,val_list = [list(entry) for entry in zip(*wk_data)]
-                depl.plot_by_week(time_delta, val_list, id_list, max_login)
-                
-            end_id = start_id
-            start_id = defo.subtract_one_week(end_id)
-    else:
-        print('WARNING: Database does not have continuous week of data')
+    ## Tabulate by week
+    # Calendar weeks (Monday to Sunday, from weekly_rollup), so a week's plot
+    # only changes when its own data does
+    print 'Plotting week data...'
+    cur.execute('SELECT week FROM weekly_rollup ORDER BY week DESC')
+    for week in cur.fetchall():
+        week_task = week_plot_task(cur, week[0], max_login)
+        if week_task is not None:
+            tasks.append(week_task)
+    return deren.render(tasks, 'analysis plots')
+
+def day_plot_task(day_data, ymax, folder='days'):
+    """Returns the render task plotting the hours of a single day (rows of id
+    and num_logins), saved within folder"""
+    savename = folder+'/'+defo.get_year_month_day_str(day_data[0]['id'][0:10]+'T00')
+    return deren.task(savename, 'plot_single_day', \
+        deren.row_dicts(day_data, ['id', 'num_logins']), savename, ymax)
+
+def slot_plot_task(cur, day_name, ymax):
+    """Returns the render task of the box plots of each hour's distribution of
+    logins (slot_stats) for the day of the week (two letter day name)"""
+    day_str = dict(WEEKDAY_PLOTS)[day_name]
+    cur.execute('SELECT * FROM slot_stats WHERE day_name=? ORDER BY hour ASC', (day_name,))
+    return deren.task('days/ByHour_'+day_str, 'plot_slot_stats', \
+        deren.row_dicts(cur.fetchall()), day_str, ymax)
+
+def week_plot_task(cur, start_day, ymax):
+    """Returns the render task plotting the history of the calendar week starting
+    on start_day (Monday, yyyy-mm-dd), marking MAD outliers.
+    None if the week has no history"""
+    end_id = defo.get_id_str(*defo.tp_add_x_days_to_id(start_day+'T00', 7)+(0,))
+    cur.execute('SELECT h.id, h.num_logins, s.is_outlier FROM login_history h ' \
+        + 'LEFT JOIN history_mad_scores s ON s.id=h.id WHERE h.id>=? AND h.id<? ' \
+        + 'ORDER BY h.id ASC', (start_day+'T00', end_id))
+    wk_data = cur.fetchall() # Data from an entire week
+    if not wk_data:
+        return None
+    # Find the time delta in hours (compute negative x values so  
+    #  the most recent is on the right)
+    last_time = wk_data[-1][0]
+    time_delta = map(lambda entry: defo.hr_subtract_ids(entry[0], last_time), wk_data)
+    id_list,val_list,outlier_list = [list(entry) for entry in zip(*wk_data)]
+    outlier_idx = [idx for idx,ol in enumerate(outlier_list) if ol]
+    return deren.task('weeks/'+defo.get_year_month_day_str(id_list[-1]), 'plot_by_week', \
+        time_delta, val_list, id_list, ymax, outlier_idx=outlier_idx)
+
+def plot_task(kind, key=None):
+    """Returns the render task of a single plot, None if there is no such plot:
+      'week': history of the calendar week containing day key (yyyy-mm-dd)
+      'day': hours of day key, history or (if there is none) predictions
+      'slot': box plots of each hour of the day of the week key (two letter day name)
+      'slopes': slope of each hour of the week, from the latest fitted model
+    Plots use the same y axis scales as the saved plots.  Outliers and slot stats are
+    read as last saved (rescored by predictions and analysis), so
+    rendering never writes to the database"""
+    db = dbh.get_db()
+    cur = db.cursor()
+    if kind == 'slopes':
+        model = get_fitted_model()
+        if model is None:
+            return None
+        return deren.task('Predicted_Slopes', 'scatter_plot', range(len(model['slopes'])), model['slopes'], \
+            'Predicted_Slopes', 'Hour', 'Slope', defo.add_x_hours(model['first_id'], 24*7-1))
+    if kind == 'slot':
+        if key not in dict(WEEKDAY_PLOTS):
+            return None
+        cur.execute('SELECT MAX(peak_logins) FROM daily_rollup')
+        return slot_plot_task(cur, key, cur.fetchone()[0])
+    day = defo.validate_day(key)
+    if day is None:
+        return None
+    if kind == 'week':
+        cur.execute('SELECT MAX(peak_logins) FROM daily_rollup')
+        return week_plot_task(cur, defo.get_week_start(day), cur.fetchone()[0])
+    if kind == 'day':
+        detail = get_day_detail(day)
+        if detail['history']:
+            cur.execute('SELECT MAX(peak_logins) FROM daily_rollup')
+            return day_plot_task(detail['history'], cur.fetchone()[0])
+        if detail['predictions']:
+            cur.execute('SELECT MAX(num_logins) FROM login_predictions')
+            return day_plot_task(detail['predictions'], max(0, cur.fetchone()[0]), 'predicted')
+    return None
+
+def fit_window_start(cur):
+    """Returns the first history hour read by fits, the later of the start of the
+    hot window (if FIT_HOT_WINDOW) and of the last FIT_LOOKBACK_WEEKS weeks (if set),
+    None if fits read every hour"""
+    starts = []
+    if app.config['FIT_HOT_WINDOW']:
+        starts.append(hot_window_start(cur))
+    if app.config['FIT_LOOKBACK_WEEKS'] > 0:
+        cur.execute('SELECT MAX(id) FROM login_history')
+        last_id = cur.fetchone()[0]
+        if last_id is not None:
+            starts.append(defo.add_x_hours(last_id, 1-24*7*app.config['FIT_LOOKBACK_WEEKS']))
+    starts = [x for x in starts if x is not None]
+    return max(starts) if starts else None
+
+def get_fit_history(cur, commit=True):
+    """Returns (history, tagged outliers, MAD masks) tuple read by fits, the history
+    rows and outliers within the fit window only (fit_window_start, an indexed range
+    read), so a fit's cost does not grow with the length of the history.
+    Set commit to None to leave any MAD score updates to be committed by the caller"""
+    fit_start = fit_window_start(cur)
+    cur.execute('SELECT * FROM login_history WHERE id>=? ORDER BY id ASC', (fit_start or '',))
+    all_data = cur.fetchall()
+    cur.execute('SELECT * FROM history_outliers WHERE id>=?', (fit_start or '',))
+    outlier_data = cur.fetchall()
+    update_mad_scores(commit)
+    mad_masks = get_mad_masks()
+    if fit_start is not None and dbh.query_db('SELECT 1 FROM login_history WHERE id<?', (fit_start,), one=True):
+        # Saved MAD scores cover the older hours too, classify the fit window alone
+        mad_masks = None
+    return (all_data, outlier_data, mad_masks)
 
 def predict_demand(year,month,day,num_days,enable_plots=None):
     """
@@ -414,19 +806,22 @@ def predict_demand(year,month,day,num_days,enable_plots=None):
     print "Predicting Demand for %d days starting on %d/%d/%d" % (num_days,month,day,year)
     db = dbh.get_db()
     cur = db.cursor()
-    # For now (smaller dataset), loading all 3 tables in memory is not a problem
-    cur.execute('SELECT * FROM history_outliers')
-    outlier_data = cur.fetchall()
+    # Version of the history these predictions are based on
+    data_version = dbh.get_state('data_version', '0')
+    # Predicted outliers are few, loading them in memory is not a problem
     cur.execute('SELECT * FROM prediction_outliers')
     predicted_outlier_data = cur.fetchall()
-    cur.execute('SELECT * FROM login_history ORDER BY id ASC')
-    all_data = cur.fetchall()
+    all_data, outlier_data, mad_masks = get_fit_history(cur, commit=None)
     if not all_data:
         return {'error':'No data in login_history DB'}
     if len(all_data) < 7*24:
         return {'error':'Not enough data to accurately predict demand'}
-    predicted_ids,predictions,predicted_slopes=depr.lin_reg_by_hour(all_data,outlier_data)
+    predicted_ids,predictions,predicted_slopes=depr.lin_reg_by_hour(all_data,outlier_data,mad_masks=mad_masks, \
+        lookback_weeks=app.config['FIT_LOOKBACK_WEEKS'], weighting=app.config['FIT_WEIGHTING'])
+    model_version = '%s/%s' % (depr.model_version(app.config['FIT_LOOKBACK_WEEKS'], \
+        app.config['FIT_WEIGHTING']), all_data[-1]['id'])
     cur_pred_id = defo.get_id_str(year, month, day, 0)
+    start_pred_id = cur_pred_id
     end_pred_id = defo.add_x_hours(cur_pred_id,24*(num_days+1))
     delta_days = defo.dy_delta_days(predicted_ids[0],cur_pred_id)
     # Filter predicted outlier ids to those within prediction timespan
@@ -452,55 +847,387 @@ def predict_demand(year,month,day,num_days,enable_plots=None):
                 #print 'Predicted (%fx) Multiplier'%ol_dict[cur_pred_id]
             #print 'Prediction ID: %s, Logins: %f (%s: %fx%dWeeks + %f)'%(cur_pred_id,prediction,
             #    predicted_ids[offset],predicted_slopes[offset],extrap_weeks,predictions[offset])
-            pred_data.append((cur_pred_id,prediction))
+            pred_data.append((cur_pred_id,prediction,model_version))
             demand_predictions[cur_pred_id] = prediction
         # Add to database, doing predictions on a day at a time basis (always 24 entries/hours)
-        cur.executemany("INSERT or REPLACE into login_predictions (id, num_logins) values (?, ?)",\
+        cur.executemany("INSERT or REPLACE into login_predictions (id, num_logins, model_version) values (?, ?, ?)",\
             pred_data)
         # Move to next day
         year, month, day = defo.tp_add_x_days(year, month, day, 1)
+    # Fitted model, so hours beyond the saved predictions can be evaluated (api_predict_query)
+    dbh.set_state(cur, 'fitted_model', json.dumps({'model_version': model_version,
+        'first_id': str(predicted_ids[0]), 'start_id': start_pred_id,
+        'predictions': [float(x) for x in predictions], 'slopes': [float(x) for x in predicted_slopes]}))
+    dbh.set_state(cur, 'predicted_data_version', data_version)
+    dbh.increment_state(cur, 'prediction_version')
     db.commit()
+    refresh_prediction_etag()
     return demand_predictions
 
 def fill_missing_hours():
-    """Reads login data from database and fills in any missing hours.
-    Inserts new entries with number of login counts set to 0."""
+    """Fills in any missing hours within the login history.
+    Inserts new entries with number of login counts set to 0, only when the gap
+    between data is less than 3 days.
+    Missing hours are generated by a single recursive query over the gaps
+    following the high-water mark (fill_hwm in pipeline_state, the latest hour
+    already checked), so an already filled history is not scanned again."""
     db = dbh.get_db()
     cur = db.cursor()
-    cur.execute('SELECT id FROM login_history ORDER BY id ASC')
-    all_data = cur.fetchall()
-    if all_data:
-        hours_missing = False
-        prev_id = defo.add_x_hours(all_data[0]['id'], -1) # start at 1 hour before first entry
-        for hour in all_data:
-            if hour['id'] != defo.add_x_hours(prev_id, 1):
-                print 'prev: %s'%(prev_id)
-                print 'next: %s'%(hour['id'])
-                if defo.dy_subtract_ids(hour['id'], prev_id) < 3:
-                    # Only insert 0's for missing entries when the gap
-                    # between data is less than 3 days
-                    missing_hour = defo.add_x_hours(prev_id, 1)
-                    while missing_hour < hour['id']:
-                        cur.execute('INSERT INTO login_history ' + \
-                            '(id, day_name, hour, num_logins) ' + \
-                            'values (?, ?, ?, ?)', \
-                            (missing_hour, defo.get_day_2char(missing_hour), \
-                             defo.get_hour(missing_hour), 0))
-                        missing_hour = defo.add_x_hours(missing_hour, 1)
-                    hours_missing = True
-            prev_id = hour['id']
-        if hours_missing:
+    cur.execute('SELECT MAX(id) FROM login_history')
+    last_id = cur.fetchone()[0]
+    fill_hwm = dbh.get_state('fill_hwm', '')
+    if last_id is None or fill_hwm >= last_id:
+        return
+    cur.execute('CREATE TEMP TABLE IF NOT EXISTS missing_hours ' + \
+        '(id text primary key, day_name text not null, hour integer not null)')
+    cur.execute('DELETE FROM missing_hours')
+    # Each gap is a history hour and the next existing hour (found through the index),
+    # recursively adding 1 hour until reaching the next existing hour.
+    # Day names match calendar.weekheader(2), with %w of 0 being Sunday
+    cur.execute("""
+        WITH RECURSIVE
+        gaps(prev_id, next_id) AS (
+            SELECT h.id, (SELECT MIN(n.id) FROM login_history n WHERE n.id>h.id)
+            FROM login_history h WHERE h.id>=?),
+        missing(id, next_id) AS (
+            SELECT strftime('%Y-%m-%dT%H', prev_id||':00', '+1 hour'), next_id FROM gaps
+            WHERE next_id IS NOT NULL
+            AND julianday(substr(next_id,1,10)) - julianday(substr(prev_id,1,10)) < 3
+            UNION ALL
+            SELECT strftime('%Y-%m-%dT%H', id||':00', '+1 hour'), next_id FROM missing
+            WHERE id<next_id)
+        INSERT INTO missing_hours (id, day_name, hour)
+        SELECT id, substr('SuMoTuWeThFrSa', 1+2*strftime('%w', id||':00'), 2),
+            CAST(strftime('%H', id||':00') AS INTEGER)
+        FROM missing WHERE id<next_id""", (fill_hwm,))
+    zone = market_timezone()
+    if zone is not None:
+        # Local hours skipped as clocks move forward are not missing
+        cur.execute('SELECT MIN(id), MAX(id) FROM missing_hours')
+        first_id, last_id = cur.fetchone()
+        if first_id is not None:
+            cur.executemany('DELETE FROM missing_hours WHERE id=?', \
+                [(x,) for x in detz.skipped_hours(zone, first_id, last_id)])
+    cur.execute('SELECT COUNT(*) FROM missing_hours')
+    num_missing = cur.fetchone()[0]
+    if num_missing:
+        print 'Filling %d missing hours' % num_missing
+        cur.execute('INSERT INTO login_history (id, day_name, hour, num_logins) ' + \
+            'SELECT id, day_name, hour, 0 FROM missing_hours')
+        cur.execute('INSERT or IGNORE into mad_dirty_slots (day_name, hour) ' + \
+            'SELECT DISTINCT day_name, hour FROM missing_hours')
+        cur.execute('SELECT day_name, hour, 0, COUNT(*) FROM missing_hours GROUP BY day_name, hour')
+        update_slot_sketches(cur, [tuple(x) for x in cur.fetchall()])
+        cur.execute('SELECT DISTINCT substr(id,1,10) FROM missing_hours')
+        update_rollups(cur, [x[0] for x in cur.fetchall()])
+    dbh.set_state(cur, 'fill_hwm', last_id)
+    db.commit()
+
+def lower_fill_mark(cur, id_list):
+    """Moves the gap filling high-water mark back before the earliest of the
+    given (newly inserted) history ids, so fill_missing_hours checks the gaps
+    around them"""
+    first_id = min(id_list)
+    fill_hwm = dbh.get_state('fill_hwm')
+    if fill_hwm is not None and first_id <= fill_hwm:
+        cur.execute('SELECT MAX(id) FROM login_history WHERE id<?', (first_id,))
+        dbh.set_state(cur, 'fill_hwm', cur.fetchone()[0] or '')
+
+def mark_slots_dirty(cur, id_list):
+    """Flags the slots (day of week & hour) of the given history ids, so that
+    their MAD scores are recomputed by the next update_mad_scores"""
+    slots = set([(defo.get_day_2char(x), int(defo.get_hour(x))) for x in id_list])
+    cur.executemany('INSERT or IGNORE into mad_dirty_slots (day_name, hour) values (?, ?)', slots)
+
+def get_slot_sketch(cur, day_name, hour):
+    """Returns the login sketch (demand_sketch) of the slot (day of week & hour),
+    built from the slot's history (and saved) if there is none yet"""
+    cur.execute('SELECT sketch FROM slot_sketches WHERE day_name=? AND hour=?', (day_name, hour))
+    saved = cur.fetchone()
+    if saved:
+        return desk.from_json(saved['sketch'])
+    # Distinct values & their counts, so the slot's history is never held in memory
+    cur.execute('SELECT num_logins, COUNT(*) FROM login_history WHERE day_name=? AND hour=? ' + \
+        'GROUP BY num_logins ORDER BY num_logins ASC', (day_name, hour))
+    sketch = desk.new_sketch()
+    for num_logins, count in cur.fetchall():
+        desk.add(sketch, num_logins, count)
+    cur.execute('INSERT or REPLACE into slot_sketches (day_name, hour, sketch) values (?, ?, ?)', \
+        (day_name, hour, desk.to_json(sketch)))
+    return sketch
+
+def update_slot_sketches(cur, added, removed=()):
+    """Updates the saved login sketches with the changed history hours, lists of
+    (day_name, hour, num_logins, count) added to and removed from a slot
+    (i.e. an hour's previous login count is removed, and its new count added).
+    Slots without a saved sketch are skipped, their sketch is built from history
+    when first needed (get_slot_sketch).  Committed by the caller"""
+    slots = sorted(set([(x[0], int(x[1])) for x in list(added) + list(removed)]))
+    for day_name, hour in slots:
+        cur.execute('SELECT sketch FROM slot_sketches WHERE day_name=? AND hour=?', (day_name, hour))
+        saved = cur.fetchone()
+        if saved is None:
+            continue
+        sketch = desk.from_json(saved['sketch'])
+        for x in removed:
+            if (x[0], int(x[1])) == (day_name, hour):
+                desk.remove(sketch, x[2], x[3])
+        for x in added:
+            if (x[0], int(x[1])) == (day_name, hour):
+                desk.add(sketch, x[2], x[3])
+        cur.execute('UPDATE slot_sketches SET sketch=? WHERE day_name=? AND hour=?', \
+            (desk.to_json(sketch), day_name, hour))
+
+def update_slot_rollups(cur, added, removed=()):
+    """Updates the per-slot rollups of compacted history (slot_rollup, number of
+    hours, total logins and login sketch of every archived week of the slot), lists
+    of (day_name, hour, num_logins, count) added to and removed from a slot.
+    Committed by the caller"""
+    slots = sorted(set([(x[0], int(x[1])) for x in list(added) + list(removed)]))
+    for day_name, hour in slots:
+        cur.execute('SELECT total, sketch FROM slot_rollup WHERE day_name=? AND hour=?', (day_name, hour))
+        saved = cur.fetchone()
+        sketch = desk.from_json(saved['sketch']) if saved else desk.new_sketch()
+        total = saved['total'] if saved else 0
+        for x in removed:
+            if (x[0], int(x[1])) == (day_name, hour):
+                desk.remove(sketch, x[2], x[3])
+                total -= x[2]*x[3]
+        for x in added:
+            if (x[0], int(x[1])) == (day_name, hour):
+                desk.add(sketch, x[2], x[3])
+                total += x[2]*x[3]
+        if not sketch['count']:
+            cur.execute('DELETE FROM slot_rollup WHERE day_name=? AND hour=?', (day_name, hour))
+            continue
+        cur.execute('INSERT or REPLACE into slot_rollup (day_name, hour, num_hours, total, sketch) ' + \
+            'values (?, ?, ?, ?, ?)', (day_name, hour, sketch['count'], total, desk.to_json(sketch)))
+
+def hot_window_start(cur, hot_weeks=None):
+    """Returns the first hour (a Monday at midnight) of the hot window of history,
+    the whole weeks covering at least hot_weeks (HOT_WEEKS if None) weeks before the
+    latest history hour, None if every hour is hot (0 weeks, or no history)"""
+    hot_weeks = app.config['HOT_WEEKS'] if hot_weeks is None else hot_weeks
+    if hot_weeks <= 0:
+        return None
+    cur.execute('SELECT MAX(id) FROM login_history')
+    last_id = cur.fetchone()[0]
+    if last_id is None:
+        return None
+    return defo.get_week_start(defo.get_id_str(*defo.tp_add_x_days_to_id(last_id, -7*hot_weeks)+(0,))) + 'T00'
+
+def compact_history(hot_weeks=None):
+    """Moves the history hours older than the hot window (hot_weeks, HOT_WEEKS if
+    None) out of login_history, into a compressed archive file (demand_archive) and
+    the per-slot rollups (slot_rollup).  Daily and weekly rollups are kept, and the
+    slots' login sketches and MAD scores then only cover the hot window.
+    Archive files already reloaded into login_history are deleted.
+    Returns the compaction report (archived hours & logins, first & last archived
+    hour, start of the hot window, archive file & size)"""
+    db = dbh.get_db()
+    cur = db.cursor()
+    hot_start = hot_window_start(cur, hot_weeks)
+    report = {'archived_hours': 0, 'hot_start': hot_start}
+    cur.execute('SELECT path FROM history_archives WHERE restored=1')
+    reloaded = [x['path'] for x in cur.fetchall()]
+    if hot_start is not None:
+        cur.execute('SELECT id, day_name, hour, num_logins FROM login_history WHERE id<? ORDER BY id ASC', \
+            (hot_start,))
+        rows = cur.fetchall()
+    else:
+        rows = []
+    # Reloaded archives are in login_history, or about to be archived again
+    cur.executemany('DELETE FROM history_archives WHERE path=?', [(x,) for x in reloaded])
+    if rows:
+        path = dear.archive_path(rows[0]['id'], rows[-1]['id'])
+        if path in reloaded:
+            reloaded.remove(path) # Replaced by the new archive of the same hours
+        report.update({'archived_hours': len(rows), 'archived_logins': sum([x['num_logins'] for x in rows]),
+            'first': rows[0]['id'], 'last': rows[-1]['id'], 'file': os.path.basename(path),
+            'bytes': dear.write_archive(path, rows)})
+        cur.execute('SELECT day_name, hour, num_logins, COUNT(*) FROM login_history WHERE id<? ' + \
+            'GROUP BY day_name, hour, num_logins', (hot_start,))
+        archived = [tuple(x) for x in cur.fetchall()]
+        update_slot_sketches(cur, [], archived)
+        update_slot_rollups(cur, archived)
+        cur.execute('INSERT or IGNORE into mad_dirty_slots (day_name, hour) ' + \
+            'SELECT DISTINCT day_name, hour FROM login_history WHERE id<?', (hot_start,))
+        cur.execute('DELETE FROM history_mad_scores WHERE id<?', (hot_start,))
+        cur.execute('DELETE FROM login_history WHERE id<?', (hot_start,))
+        cur.execute('INSERT INTO history_archives (path, first_id, last_id, num_hours, num_logins, ' + \
+            "size, created_at) values (?, ?, ?, ?, ?, ?, datetime('now'))", (path, report['first'], \
+            report['last'], report['archived_hours'], report['archived_logins'], report['bytes']))
+        print 'Compacted %d history hours before %s into %s' % (len(rows), hot_start, path)
+    db.commit()
+    for path in reloaded:
+        if os.path.exists(path):
+            os.remove(path)
+    return report
+
+def archived_ids(cur, id_list):
+    """Returns the ids on or before the last archived (and not reloaded) history hour"""
+    cur.execute('SELECT MAX(last_id) FROM history_archives WHERE restored=0')
+    last_id = cur.fetchone()[0]
+    if last_id is None:
+        return []
+    return [x for x in id_list if x[0:10] <= last_id[0:10]]
+
+def reload_history(cur, day_ranges=None):
+    """Reads the archived history hours back into login_history (and their slots'
+    login sketches), from every archive file holding any day within the
+    (first day, last day) ranges (every archive if None), so their rollups are
+    recomputed from complete days.
+    Returns the number of hours reloaded, committed by the caller"""
+    cur.execute('SELECT path, first_id, last_id FROM history_archives WHERE restored=0 ORDER BY first_id ASC')
+    archives = cur.fetchall()
+    if day_ranges is not None:
+        archives = [x for x in archives if any([x['first_id'] <= last_day+'T23' and \
+            x['last_id'] >= first_day+'T00' for first_day, last_day in day_ranges])]
+    num_hours = 0
+    for archive in archives:
+        rows = dear.read_archive(archive['path'])
+        cur.execute('SELECT id, num_logins FROM login_history WHERE id>=? AND id<=?', \
+            (archive['first_id'], archive['last_id']))
+        existing = dict([(x['id'], x['num_logins']) for x in cur.fetchall()])
+        added = collections.Counter()
+        removed = collections.Counter()
+        for id_str, day_name, hour, num_logins in rows:
+            if id_str in existing:
+                # Late logins for the hour were added while it was archived
+                removed[(day_name, hour, existing[id_str])] += 1
+                added[(day_name, hour, existing[id_str]+num_logins)] += 1
+            else:
+                added[(day_name, hour, num_logins)] += 1
+        cur.executemany('UPDATE login_history SET num_logins=num_logins+? WHERE id=?', \
+            [(x[3], x[0]) for x in rows if x[0] in existing])
+        cur.executemany('INSERT INTO login_history (id, day_name, hour, num_logins) values (?, ?, ?, ?)', \
+            [x for x in rows if x[0] not in existing])
+        update_slot_sketches(cur, [x + (n,) for x, n in added.items()], [x + (n,) for x, n in removed.items()])
+        update_slot_rollups(cur, [], [(x[1], x[2], x[3], n) for x, n in \
+            collections.Counter([tuple(x) for x in rows]).items()])
+        ids = [x[0] for x in rows]
+        mark_slots_dirty(cur, ids)
+        update_rollups(cur, ids)
+        cur.execute('UPDATE history_archives SET restored=1 WHERE path=?', (archive['path'],))
+        num_hours += len(rows)
+        print 'Reloaded %d history hours from %s' % (len(rows), archive['path'])
+    return num_hours
+
+def api_reload_history(start_id=None, end_id=None):
+    """Reloads the archived history hours of the days from start_id to end_id (every
+    archived hour if both are None) into login_history, until the next compaction.
+    Returns dictionary of the number of reloaded hours, or error dictionary"""
+    for name, value in (('start', start_id), ('end', end_id)):
+        if value is not None and defo.validate_id(value) is None:
+            return {'error':'Invalid %s hour' % name, '%s_example' % name: '2012-05-01T00'}
+    db = dbh.get_db()
+    cur = db.cursor()
+    day_ranges = None
+    if start_id is not None or end_id is not None:
+        day_ranges = [(str(start_id or '')[0:10], str(end_id or '9999-12-31')[0:10])]
+    num_hours = reload_history(cur, day_ranges)
+    db.commit()
+    return {'reloaded_hours': num_hours}
+
+def get_history_archives():
+    """Returns the archive files of the compacted history (first & last hour, number
+    of hours & logins, size and whether it has been reloaded) and the per-slot rollups
+    of the archived hours (number of hours, total and median logins)"""
+    archives = dbh.query_db('SELECT first_id, last_id, num_hours, num_logins, size, created_at, restored ' + \
+        'FROM history_archives ORDER BY first_id ASC')
+    slots = dbh.query_db('SELECT day_name, hour, num_hours, total, sketch FROM slot_rollup')
+    return {'archives': [dict(zip(x.keys(), x)) for x in archives],
+        'slots': [{'day_name': x['day_name'], 'hour': x['hour'], 'num_hours': x['num_hours'], 'total': x['total'],
+            'median': desk.median(desk.from_json(x['sketch']))} for x in slots]}
+
+def update_mad_scores(commit=True):
+    """Recomputes the MAD-based outlier classification for each slot (day of week
+    & hour) that received new data or outliers since the last update, and saves the
+    score of every history hour in the slot to history_mad_scores.
+    The median and MAD come from the slot's login sketch, less the manually tagged
+    outliers, and the scores are computed by the database, so slots are never
+    loaded into memory.
+    Also saves the distribution summary of all the slot's logins to slot_stats.
+    Set commit to None to leave the changes to be committed by the caller.
+    Returns the number of slots that were updated."""
+    db = dbh.get_db()
+    cur = db.cursor()
+    cur.execute('SELECT day_name, hour FROM mad_dirty_slots')
+    dirty_slots = [(x['day_name'], x['hour']) for x in cur.fetchall()]
+    for day_name, hour in dirty_slots:
+        sketch = get_slot_sketch(cur, day_name, hour)
+        cur.execute('DELETE FROM history_mad_scores WHERE day_name=? AND hour=?', (day_name, hour))
+        cur.execute('DELETE FROM slot_stats WHERE day_name=? AND hour=?', (day_name, hour))
+        if not sketch['count']:
+            continue
+        summary = desk.box_stats(sketch)
+        summary.update({'day_name': day_name, 'hour': hour, 'fliers': json.dumps(summary['fliers'])})
+        cur.execute('INSERT INTO slot_stats (day_name, hour, num_weeks, total, mean, min_logins, ' + \
+            'q1, median, q3, max_logins, whislo, whishi, fliers) values (:day_name, :hour, ' + \
+            ':num_weeks, :total, :mean, :min_logins, :q1, :median, :q3, :max_logins, ' + \
+            ':whislo, :whishi, :fliers)', summary)
+        # Manually tagged outliers are excluded from the MAD statistics
+        cur.execute('SELECT h.num_logins FROM history_outliers o JOIN login_history h ON h.id=o.id ' + \
+            'WHERE h.day_name=? AND h.hour=?', (day_name, hour))
+        valid = desk.merge([sketch])
+        for tagged in cur.fetchall():
+            desk.remove(valid, tagged[0])
+        if not valid['count']:
+            continue
+        med_logins, hour_mad = desk.median_mad(valid)
+        if hour_mad == 0.0:
+            hour_mad = desk.std(valid) # Use standard deviation if MAD is zero
+        low_bound, high_bound = depr.mad_bounds(med_logins, hour_mad)
+        if desk.count_between(valid, low_bound, high_bound):
+            outlier = 'NOT (h.num_logins > :low_bound AND h.num_logins < :high_bound)'
+        else:
+            outlier = 'NOT (abs(h.num_logins - :median) <= 5*:mad)'
+            print 'WARNING: No points within MAD threshold! Increasing tolerance'
+        score = '(h.num_logins - :median) / :mad' if hour_mad > 0.0 else '0.0'
+        cur.execute('INSERT INTO history_mad_scores ' + \
+            '(id, day_name, hour, score, low_bound, high_bound, threshold, is_outlier) ' + \
+            'SELECT h.id, h.day_name, h.hour, %s, :low_bound, :high_bound, :threshold, %s ' % (score, outlier) + \
+            'FROM login_history h LEFT JOIN history_outliers o ON o.id=h.id ' + \
+            'WHERE h.day_name=:day_name AND h.hour=:hour AND o.id IS NULL', \
+            {'day_name': day_name, 'hour': hour, 'median': med_logins, 'mad': hour_mad, \
+             'low_bound': low_bound, 'high_bound': high_bound, 'threshold': depr.MAD_THRESHOLD})
+    if dirty_slots:
+        cur.executemany('DELETE FROM mad_dirty_slots WHERE day_name=? AND hour=?', dirty_slots)
+        if commit:
             db.commit()
-    
+        print "Updated MAD scores for %d slots" % len(dirty_slots)
+    return len(dirty_slots)
+
+def get_mad_masks():
+    """Returns the saved MAD-based classification of every scored history hour
+    as a dictionary, where the key is the id and the value is True if the hour
+    is valid (not an outlier)"""
+    scores = dbh.query_db('SELECT id, is_outlier FROM history_mad_scores')
+    return dict([(x['id'], not x['is_outlier']) for x in scores])
+
+def get_outliers():
+    """Returns (manual, automatic) tuple of outlier lists for review, where
+    manual holds the tagged history_outliers (id, reason, num_logins) and
+    automatic holds the MAD-based outliers (id, num_logins, score, low_bound,
+    high_bound, threshold)"""
+    update_mad_scores()
+    manual = dbh.query_db('SELECT o.id, o.reason, h.num_logins FROM history_outliers o ' + \
+        'LEFT JOIN login_history h ON h.id=o.id ORDER BY o.id ASC')
+    automatic = dbh.query_db('SELECT s.id, h.num_logins, s.score, s.low_bound, s.high_bound, ' + \
+        's.threshold FROM history_mad_scores s JOIN login_history h ON h.id=s.id ' + \
+        'WHERE s.is_outlier=1 ORDER BY s.id ASC')
+    return (manual, automatic)
+
 def plot_predictions(update_plots=None):
     """Updates the predictions (if update_plots is not None) which will also plot
     the linear regression predictions with past data,
-    and Plots (saved to file) each predicted day in login_predictions"""
+    and Plots (saved to file) each predicted day in login_predictions.
+    Plots are rendered in parallel (see demand_render), returns the timing report"""
     db = dbh.get_db()
     cur = db.cursor()
     if update_plots is not None:
         num_days_predicted=15
-        delete_predictions_with_actuals()
+        archive_predictions_with_actuals()
         # Find start day for predictions (=1+last day of actuals)
         cur.execute("SELECT id FROM login_history ORDER BY id DESC")
         latest = cur.fetchone()
@@ -513,19 +1240,13 @@ def plot_predictions(update_plots=None):
     if not pred_data:
         print "No predictions in database! Nothing to plot"
         return
-    # Get list of days that have been predicted
-    pred_dict = {}
-    max_pred = 0 # Save max prediction to set identical y axis scales
-    for hours in pred_data:
-        if hours['num_logins'] > max_pred:
-            max_pred = hours['num_logins']
-        day_id = hours['id'][:-3]
-        if day_id in pred_dict:
-            pred_dict[day_id].append(hours)
-        else:
-            pred_dict[day_id] = [hours]
-    for day_id,pred_list in pred_dict.items():
-        depl.plot_single_day(pred_list, 'predicted/'+defo.get_year_month_day_str(day_id+'T00'), max_pred)
+    # Save max prediction to set identical y axis scales
+    max_pred = max([0] + [hours['num_logins'] for hours in pred_data])
+    # Every plot is a render task with its own slice of the data
+    tasks = []
+    # Each predicted day
+    for day_id,pred_list in itertools.groupby(pred_data, lambda x: x['id'][:-3]):
+        tasks.append(day_plot_task(list(pred_list), max_pred, 'predicted'))
         
     pred_start = pred_data[0]['id']
     pred_end = pred_data[-1]['id']
@@ -535,8 +1256,9 @@ def plot_predictions(update_plots=None):
         pred_y = [x['num_logins'] for x in pred_data if x['id']>pred_week_start and x['id']<=pred_end]
         pred_id = [x['id'] for x in pred_data if x['id']>pred_week_start and x['id']<=pred_end]
         if pred_id:
-            depl.plot_by_week(x_list=range(-1*len(pred_y),0),y_list=pred_y,id_list=pred_id,
-                fix_y=max_pred,predicted_color=1,savename='predicted/Week_'+pred_end[:10])
+            tasks.append(deren.task('predicted/Week_'+pred_end[:10], 'plot_by_week', \
+                x_list=range(-1*len(pred_y),0),y_list=pred_y,id_list=pred_id,
+                fix_y=max_pred,predicted_color=1,savename='predicted/Week_'+pred_end[:10]))
         pred_end = pred_week_start
         pred_week_start = defo.subtract_one_week(pred_end)
     
@@ -551,26 +1273,51 @@ def plot_predictions(update_plots=None):
             pred_y = [x['num_logins'] for x in pred_data if x['id']<=pred_end]
             pred_id = [x['id'] for x in pred_data if x['id']<=pred_end]
             plot_y = hist_y+pred_y
-            depl.plot_by_week(x_list=range(-1*len(plot_y),0),y_list=plot_y,id_list=hist_id+pred_id,
-                fix_y=max_pred,savename='predicted/Week_'+pred_end[:10],split=len(hist_y))
+            tasks.append(deren.task('predicted/Week_'+pred_end[:10], 'plot_by_week', \
+                x_list=range(-1*len(plot_y),0),y_list=plot_y,id_list=hist_id+pred_id,
+                fix_y=max_pred,savename='predicted/Week_'+pred_end[:10],split=len(hist_y)))
+    return deren.render(tasks, 'prediction plots')
     
-def delete_predictions_with_actuals():
+def archive_predictions_with_actuals(commit=True):
     """Finds any predicted hours that have actual data in the login_history table,
-    removes matching entries from login_predictions"""
+    moves matching entries from login_predictions into forecast_archive (along
+    with the actual number of logins), so forecast error can be measured later.
+    Set commit to None to leave the changes to be committed by the caller"""
     db = dbh.get_db()
     cur = db.cursor()
-    cur.execute("SELECT id FROM login_predictions")
-    pred_ids = cur.fetchall()
-    cur.execute("SELECT id FROM login_history ORDER BY id ASC")
-    hist_ids = cur.fetchall()
-    if hist_ids:
-        all_ids = [x['id'] for x in hist_ids]
-        for id in pred_ids:
-            if id['id'] in all_ids:
-                cur.execute("DELETE FROM login_predictions WHERE id=?",\
-                    (id['id'],))
+    cur.execute("INSERT or REPLACE into forecast_archive " + \
+        "(id, model_version, num_logins, actual_logins, archived_at) " + \
+        "SELECT p.id, p.model_version, p.num_logins, h.num_logins, datetime('now') " + \
+        "FROM login_predictions p JOIN login_history h ON h.id=p.id")
+    cur.execute("DELETE FROM login_predictions WHERE EXISTS " + \
+        "(SELECT 1 FROM login_history h WHERE h.id=login_predictions.id)")
+    if cur.rowcount > 0:
+        dbh.increment_state(cur, 'prediction_version')
+    if commit:
         db.commit()
-    
+        refresh_prediction_etag()
+
+def get_forecast_accuracy(runs=None):
+    """Returns the forecast error of the archived predictions for each model (the
+    algorithm version, i.e. linreg-mad-1-wls-lb12, without the last history hour the
+    model was fit on), as a list of dictionaries with the number of hours, mean
+    absolute error, bias (mean of predicted - actual) and mean absolute percentage
+    error (hours with actual logins only).
+    If runs, each model also lists the error of each of its fits ('runs', by fit hour)"""
+    errors = 'COUNT(*) AS num_hours, AVG(ABS(num_logins-actual_logins)) AS mae, ' + \
+        'AVG(num_logins-actual_logins) AS bias, ' + \
+        'AVG(CASE WHEN actual_logins>0 THEN ABS(num_logins-actual_logins)/actual_logins END) AS mape'
+    accuracy = dbh.query_db('SELECT %s AS model, %s FROM forecast_archive ' % (ARCHIVE_MODEL, errors) + \
+        'GROUP BY model ORDER BY model ASC')
+    accuracy = [dict(zip(x.keys(), x)) for x in accuracy]
+    if runs:
+        fits = dbh.query_db('SELECT %s AS model, %s AS fit_hour, %s FROM forecast_archive ' % \
+            (ARCHIVE_MODEL, ARCHIVE_FIT_HOUR, errors) + 'GROUP BY model_version ORDER BY fit_hour ASC')
+        for model in accuracy:
+            model['runs'] = [dict([(k, x[k]) for k in x.keys() if k != 'model']) \
+                for x in fits if x['model'] == model['model']]
+    return accuracy
+
 def clear_existing_predictions(year, month, day):
     """Delete all predictions associated with the input day
     from the login_predictions database"""
@@ -622,6 +1369,7 @@ def mark_outlier(outlier_id, reason='DefaultOutlier'):
         else:
             #print 'Adding %s in Outlier DB' % (str(outlier_id))
             cur.execute('INSERT INTO history_outliers (id, reason) values (?, ?)', (outlier_id, str(reason)))
+        mark_slots_dirty(cur, [outlier_id])
         db.commit()
     return None
 
@@ -642,68 +1390,41 @@ def mark_predicted_outlier(outlier_id, multiplier, reason='DefaultOutlier'):
     db.commit()
     return None
 
-def mark_predetermined_outliers():
+def mark_predetermined_outliers(num_days_to_predict=15):
     """Load known outlier dates to increase accuracy of demand prediction.
-    Hardcoded for now...implement as reading in *.json text file"""
-
-    mark_outlier('2012-03-01T00', '#YelpDrinksDC')
-    mark_outlier('2012-03-01T02', '#YelpDrinksDC')
-    mark_outlier('2012-03-03T03', '#YelpDrinksDC')
-    mark_outlier('2012-03-03T04', '#YelpDrinksDC')
-    mark_outlier('2012-03-03T05', '#YelpDrinksDC')
-    mark_outlier('2012-03-03T06', '#YelpDrinksDC')
-    mark_outlier('2012-03-14T04', 'Uber Down')
-    mark_outlier('2012-03-14T05', 'Uber Down')
-    mark_outlier('2012-03-14T06', 'Uber Down')
-    mark_outlier('2012-03-14T07', 'Uber Down')
-    mark_outlier('2012-03-14T08', 'Uber Down')
-    mark_outlier('2012-04-07T17', 'Easter')
-    mark_outlier('2012-04-07T18', 'Easter')
-    mark_outlier('2012-04-07T19', 'Easter')
-    mark_outlier('2012-04-07T20', 'Easter')
-    mark_outlier('2012-04-07T21', 'Easter')
-    mark_outlier('2012-04-07T22', 'Easter')
-    mark_outlier('2012-04-07T23', 'Easter')
-    mark_outlier('2012-04-08T01', 'Easter')
-    mark_outlier('2012-04-08T02', 'Easter')
-    mark_outlier('2012-04-08T03', 'Easter')
-    mark_outlier('2012-04-08T04', 'Easter')
-    mark_outlier('2012-04-21T22', 'GWWIB Conference')
-    mark_outlier('2012-04-21T23', 'GWWIB Conference')
-    mark_outlier('2012-04-22T00', 'GWWIB Conference')
-    mark_outlier('2012-04-22T01', 'GWWIB Conference')
-    mark_outlier('2012-04-22T02', 'GWWIB Conference')
-    mark_outlier('2012-04-22T03', 'GWWIB Conference')
-    mark_outlier('2012-04-22T17', 'Earth Day')
-    mark_outlier('2012-04-22T18', 'Earth Day')
-    mark_outlier('2012-04-22T19', 'Earth Day')
-    mark_outlier('2012-04-22T20', 'Earth Day')
-    mark_outlier('2012-04-22T21', 'Earth Day')
-    mark_outlier('2012-04-22T22', 'Earth Day')    
-    mark_outlier('2012-04-25T19', 'Tech Cocktail Session')
-    mark_outlier('2012-04-25T20', 'Tech Cocktail Session')
-    mark_outlier('2012-04-25T21', 'Tech Cocktail Session')
-    mark_outlier('2012-04-25T22', 'Tech Cocktail Session')
-    
-    for hour in range(12,18+1):
-        # Festival in DC is 12 to 6
-        mark_predicted_outlier('2012-05-05T'+str(hour), 1.4, 'Cinco de Mayo Festival')
-    mark_predicted_outlier('2012-05-05T20', 1.2, 'Cinco de Mayo')
-    mark_predicted_outlier('2012-05-05T20', 1.4, 'Cinco de Mayo')
-    mark_predicted_outlier('2012-05-05T21', 1.5, 'Cinco de Mayo')
-    mark_predicted_outlier('2012-05-05T22', 1.5, 'Cinco de Mayo')
-    mark_predicted_outlier('2012-05-05T23', 1.4, 'Cinco de Mayo')
-    mark_predicted_outlier('2012-05-06T00', 1.4, 'Cinco de Mayo')
-    mark_predicted_outlier('2012-05-06T01', 1.4, 'Cinco de Mayo')
-    mark_predicted_outlier('2012-05-06T02', 1.4, 'Cinco de Mayo')
-    mark_predicted_outlier('2012-05-06T03', 1.3, 'Cinco de Mayo')
-    mark_predicted_outlier('2012-05-06T04', 1.1, 'Cinco de Mayo')
-    
-    mark_predicted_outlier('2012-05-13T15', 0.9, 'Mothers Day')
-    mark_predicted_outlier('2012-05-13T16', 0.8, 'Mothers Day')
-    mark_predicted_outlier('2012-05-13T17', 0.8, 'Mothers Day')
-    mark_predicted_outlier('2012-05-13T18', 0.8, 'Mothers Day')
-    mark_predicted_outlier('2012-05-13T19', 0.8, 'Mothers Day')
-    mark_predicted_outlier('2012-05-13T20', 0.8, 'Mothers Day')
-    mark_predicted_outlier('2012-05-13T20', 0.9, 'Mothers Day')
-    
\ No newline at end of file
+    Expands the event calendar (EVENT_CALENDAR json file) over the entire history
+    and the following num_days_to_predict days, then writes every matching hour
+    to history_outliers (history hours that exist in login_history) and
+    prediction_outliers (hours with a multiplier) within a single transaction.
+    Returns error message if anything goes wrong."""
+    db = dbh.get_db()
+    cur = db.cursor()
+    cur.execute('SELECT MIN(id), MAX(id) FROM login_history')
+    first_id, last_id = cur.fetchone()
+    if first_id is None:
+        return "No data in login_history DB"
+    end_id = defo.add_x_hours(last_id, 24*num_days_to_predict)
+    try:
+        history, predicted = deca.expand_calendar(app.config['EVENT_CALENDAR'], first_id, end_id)
+    except (IOError, ValueError) as err:
+        print "Error reading event calendar"
+        print err
+        return "Could not load event calendar: %s" % err
+    print "Marking %d history and %d predicted outliers" % (len(history), len(predicted))
+    # Only history hours that exist in the database are marked, and only the slots
+    # of newly marked (or changed reason) hours need their MAD scores recomputed
+    changed = []
+    for outlier_id, reason in history:
+        cur.execute('UPDATE history_outliers SET reason=? WHERE id=? AND reason IS NOT ?', \
+            (reason, outlier_id, reason))
+        updated = cur.rowcount
+        cur.execute('INSERT or IGNORE into history_outliers (id, reason) ' + \
+            'SELECT id, ? FROM login_history WHERE id=?', (reason, outlier_id))
+        if updated > 0 or cur.rowcount > 0:
+            changed.append((outlier_id,))
+    cur.executemany('INSERT or IGNORE into mad_dirty_slots (day_name, hour) ' + \
+        'SELECT day_name, hour FROM login_history WHERE id=?', changed)
+    cur.executemany("INSERT or REPLACE into prediction_outliers (id, multiplier, reason) values (?, ?, ?)",\
+        predicted)
+    db.commit()
+    return None
@@ -1,15 +1,75 @@
 #!/usr/bin/env python
 
 import os
-import matplotlib.pyplot as plt
+import json
+import threading
+from cStringIO import StringIO
 import numpy as np
 import datetime
 from predict_demand import demand_formatter as defo
 
+class LazyPyplot(object):
+    """matplotlib.pyplot, imported on first use, so processes that never plot
+    (i.e. the command line batch) start without loading matplotlib.
+    Plots are only ever saved (to file or in memory, also from web request threads
+    on servers without a display), so pyplot always uses the non-interactive Agg backend"""
+    def __getattr__(self, name):
+        return getattr(pyplot(), name)
+
+def pyplot():
+    """Returns matplotlib.pyplot, using the Agg backend"""
+    import sys
+    import matplotlib
+    if 'matplotlib.pyplot' not in sys.modules:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot
+    if matplotlib.get_backend().lower() != 'agg':
+        matplotlib.pyplot.switch_backend('Agg') # Imported elsewhere first
+    return matplotlib.pyplot
+
+plt = LazyPyplot()
+
+# pyplot's current figure is global state, plots are rendered by one thread at a time
+render_lock = threading.RLock()
+# In-memory save target of the current thread (see render_to_buffer)
+_target = threading.local()
+
+def plot_columns():
+    """Returns the width in pixels of the plot area of a default figure,
+    at the resolution plots are saved with"""
+    dpi = plt.rcParams['savefig.dpi']
+    if dpi == 'figure':
+        dpi = plt.rcParams['figure.dpi']
+    axes_fraction = plt.rcParams['figure.subplot.right'] - plt.rcParams['figure.subplot.left']
+    return int(plt.rcParams['figure.figsize'][0] * dpi * axes_fraction)
+
+def downsample(x_list, y_list, columns=None):
+    """Given x values (ascending) and their y values, returns the (x_list, y_list)
+    min/max envelope: the lowest and highest point within each of columns equal
+    width x ranges (pixel columns of the plot area by default), along with the
+    first and last points.  Peaks are always kept, and lines drawn through the
+    envelope look the same as through every point at the saved resolution.
+    Lists of no more than 2 points per column are returned unchanged"""
+    if columns is None:
+        columns = plot_columns()
+    if len(x_list) <= 2*columns:
+        return x_list, y_list
+    x_arr = np.asarray(x_list, dtype=float)
+    y_arr = np.asarray(y_list, dtype=float)
+    span = (x_arr[-1] - x_arr[0]) or 1.0
+    column = np.minimum(((x_arr - x_arr[0]) * columns / span).astype(int), columns-1)
+    # Points sorted by column then y, so each column starts at its min, ends at its max
+    order = np.lexsort((y_arr, column))
+    starts = np.flatnonzero(np.r_[True, column[1:] != column[:-1]])
+    ends = np.r_[starts[1:], len(column)] - 1
+    keep = np.unique(np.r_[order[starts], order[ends], 0, len(column)-1])
+    return x_arr[keep].tolist(), y_arr[keep].tolist()
+
 def scatter_plot(x_list, y_list, save_name='Hour_Analysis', \
     x_label='Hour', y_label='Login Count [per hour]', id_str=None):
     """Given a list of hours and list of client login counts,
-    plots the time vs. count data"""
+    plots the time vs. count data (min/max envelope of long histories)"""
+    x_list, y_list = downsample(x_list, y_list)
     fig = plt.figure()
     if id_str is not None: #len(y_list) == 24*7
         fig.add_subplot(111, autoscale_on=False, xlim=(-1,24*7+1), ylim=(min(y_list)-.5,max(y_list)+.5))
@@ -29,12 +89,13 @@ def scatter_plot(x_list, y_list, save_name='Hour_Analysis', \
 def plot_by_day(day_dict):
     """Given a dictionary where the key is day of year,
     and the value is the client login count for that entire day,
-    plots the time vs. count data"""
+    plots the time vs. count data (min/max envelope of long histories)"""
     x_list = []
     y_list = []
     for key in sorted(day_dict):
         x_list.append(key)
         y_list.append(day_dict[key])
+    x_list, y_list = downsample(x_list, y_list)
     
     plt.figure()
     plt.plot(x_list, y_list)
@@ -44,10 +105,11 @@ def plot_by_day(day_dict):
     plt.close()
 
 def plot_by_week(x_list, y_list, id_list, fix_y=None, predicted_color=None, \
-                 savename=None, split=None):
+                 savename=None, split=None, outlier_idx=None):
     """Given a list of hours and list of client login counts,
     plots the time vs. count data and uses the id_list for
-    formatting x tick labels and saving correctly"""
+    formatting x tick labels and saving correctly.
+    Points at the indices in outlier_idx are marked as outliers"""
     fig = plt.figure()
     if fix_y is None:
         fix_y = max(y_list)+3
@@ -61,6 +123,9 @@ def plot_by_week(x_list, y_list, id_list, fix_y=None, predicted_color=None, \
         else:
             scatter_color = 'blue'
         ax.scatter(x_list, y_list, color=scatter_color)
+    if outlier_idx:
+        ax.scatter([x_list[idx] for idx in outlier_idx], [y_list[idx] for idx in outlier_idx],
+                   color='red', marker='x', s=60)
     # Label high peak
     peak_idx = y_list.index(max(y_list))
     ax.annotate(defo.day_hour_from_id(id_list[peak_idx]), 
@@ -103,22 +168,6 @@ def plot_by_hour(x_list, y_list, id_list):
     save('weeks/'+str(id_list[-1])[:-2])
     plt.close()
 
-def plot_each_day(all_data):
-    """Given the entire history database, plot each day separately and
-    save as a new image file"""
-    max_pred = 0 # Save max prediction to set identical y axis scales
-    day_dict = {}
-    for hours in all_data:
-        if hours['num_logins'] > max_pred:
-            max_pred = hours['num_logins']
-        day_id = hours['id'][:-3]
-        if day_id in day_dict:
-            day_dict[day_id].append(hours)
-        else:
-            day_dict[day_id] = [hours]
-    for day_id,day_list in day_dict.items():
-        plot_single_day(day_list, 'days/'+defo.get_year_month_day_str(day_id+'T00'), max_pred)
-
 def plot_single_day(id_cnt_list, savename, ymax=None):
     """Given a list of tuples (id, cnt) for a 24 hours,
     plots the hour vs. count data"""
@@ -137,23 +186,18 @@ def plot_single_day(id_cnt_list, savename, ymax=None):
     save(savename)
     plt.close()
 
-def plot_day_dict(day_dict, day_str, fix_y=None, enable_scatter=False):
-    """Given input data for a single day in the form of a dictionary, where 
-    the keys are hours (0 to 23) and
-    the values are lists of login counts per hour,
-    scatter plots the values and creates a summary box plot on top"""
+def plot_slot_stats(slot_stats, day_str, fix_y=None):
+    """Given the slot_stats rows of a single day of the week (distribution
+    summary of each hour's logins, ordered by hour), draws the summary box plots"""
     fig = plt.figure()
     if fix_y is not None:
         ax = fig.add_subplot(111, autoscale_on=False, xlim=(-1,24), ylim=(-1,fix_y+2))
     else:
         ax = fig.add_subplot(111)
-    plot_data = []
-    for hour in sorted(day_dict.keys()):
-        vals = [ entry[1] for entry in day_dict[hour] ]
-        plot_data.append(vals)
-        if enable_scatter:
-            ax.scatter([hour]*len(vals), vals)
-    ax.boxplot(plot_data, positions=sorted(day_dict.keys()))
+    if slot_stats:
+        ax.bxp([{'med': x['median'], 'q1': x['q1'], 'q3': x['q3'], 'whislo': x['whislo'],
+                 'whishi': x['whishi'], 'mean': x['mean'], 'fliers': json.loads(x['fliers'])}
+                for x in slot_stats], positions=[x['hour'] for x in slot_stats])
     # Add a horizontal grid to the plot, but make it very light in color
     # so we can use it for reading data values but not be distracting
     ax.yaxis.grid(True, linestyle='-', which='major', color='lightgrey',
@@ -182,44 +226,18 @@ def correlation(x_list, y_list, title):
     save(title)
     plt.close(fig)
 
-def plot_day_trend(predicted_id, hist_day):
-    """Given a date to predict, and the past history of client login data,
-    plot the normalized (by mean) drift over time for each hour of the given day.
-    Group the box plots by week, where the datapoints for each box/week consist
-    of all 24 hours (difference from corresponding hour's mean).
+def plot_day_trend(predicted_id, week_drifts):
+    """Given a date to predict, and the normalized (by mean) drift over time for
+    each hour of the given day (demand_predictor.day_trends, a list per past week),
+    plot the drift grouped by week.
+    The datapoints for each box/week consist of all 24 hours (difference from
+    corresponding hour's mean).
     An increase in the mean over time/weeks (x axis), shows the amount of demand
     increase over time (broken down by day, normalized by mean of each individual hour)."""
     fig = plt.figure()
     ax = fig.add_subplot(111)
-    # Limit number of weeks back in time to 11 (data must be within last 11 weeks)
-    limit_past = 11 # [weeks]
-    max_week_idx = None
-    min_week_idx = None
-    week_arr = np.empty((limit_past,24)) # 11 (max) arrays of 24 [hours]
-    for hour in range(24):
-        hist_hour = filter(lambda x: x['hour']==hour and defo.dy_delta_days(x['id'],predicted_id)/7 < limit_past, hist_day)
-        delta_weeks = map(lambda x: defo.dy_delta_days(x['id'],predicted_id)/7, hist_hour)
-        if max_week_idx is None:
-            # Assuming history has sequential weeks
-            max_week_idx = max(delta_weeks)
-            min_week_idx = min(delta_weeks)
-        login_list = map(lambda x: x['num_logins'], hist_hour)
-        x_arr = np.array(delta_weeks)
-        y_arr = np.array(login_list)
-        mean_y = np.mean(y_arr)
-        #ax.plot(x_arr, (y_arr-mean_y)/mean_y)
-        for wk,cnt in zip(x_arr,y_arr):
-            week_arr[wk][hour] = (cnt-mean_y)/mean_y
-    #boxplot_arr = np.array(max_week_idx-min_week_idx,24)
-    boxplot_arr = []
-    wk_rng = range(max_week_idx,min_week_idx-1,-1)
-    x_lbl = []
-    for wk in wk_rng:
-        boxplot_arr.append(week_arr[wk])
-    ax.boxplot(boxplot_arr)
-    #ax.boxplot(week_arr[min_week_idx:max_week_idx])
+    ax.boxplot(week_drifts)
     # TBD - use weights for known outliers
-    #weights_arr = np.ones(y_arr.shape)
     day_str = defo.get_day_of_week(predicted_id)
     ax.yaxis.grid(True, linestyle='-', which='major', color='lightgrey',
                   alpha=0.5)
@@ -229,16 +247,15 @@ def plot_day_trend(predicted_id, hist_day):
     save('days/ByWeek_'+day_str)
     plt.close(fig)
     
-def plot_weekdays(wkday_data):
-    """Given all the weekday data (Mon->Thurs), 
-    saves a boxplot binned by hours"""
+def plot_weekdays(weekday_stats):
+    """Given the distribution summary of each hour's weekday logins (Mon->Thurs,
+    demand_sketch.box_stats with the hour), saves a boxplot binned by hours"""
     fig = plt.figure()
     ax = fig.add_subplot(111)
-    plot_data = []
-    for hour in range(24):
-        hour_data = map(lambda x: x[1], filter(lambda x: int(defo.get_hour(x[0]))==hour, wkday_data))
-        plot_data.append(hour_data)
-    ax.boxplot(plot_data)
+    if weekday_stats:
+        ax.bxp([{'med': x['median'], 'q1': x['q1'], 'q3': x['q3'], 'whislo': x['whislo'],
+                 'whishi': x['whishi'], 'mean': x['mean'], 'fliers': x['fliers']}
+                for x in weekday_stats], positions=[x['hour']+1 for x in weekday_stats])
     # Add a horizontal grid to the plot, but make it very light in color
     # so we can use it for reading data values but not be distracting
     ax.yaxis.grid(True, linestyle='-', which='major', color='lightgrey',
@@ -262,14 +279,39 @@ def linear_regression_plot(xi, line, data, prediction, pred_id):
     save('day_predict/'+pred_id)
     plt.close()
     
+def render_to_buffer(func_name, args, kwargs, ext='png'):
+    """Calls the plotting function func_name(*args, **kwargs), returning the
+    figure it saves as bytes (format ext, png or svg) instead of writing it
+    within the Plots folder"""
+    buf = StringIO()
+    with render_lock:
+        _target.buffer = buf
+        _target.ext = ext
+        try:
+            globals()[func_name](*args, **kwargs)
+        finally:
+            _target.buffer = None
+            plt.close('all')
+    return buf.getvalue()
+
 def save(name, ext='png'):
-    """Save pyplot figure to top level Plots folder."""
+    """Save pyplot figure to top level Plots folder,
+    or to the current thread's buffer when called through render_to_buffer."""
+    buf = getattr(_target, 'buffer', None)
+    if buf is not None:
+        plt.savefig(buf, format=_target.ext)
+        return
     # If the directory does not exist, create it
     directory = 'plots'
     dirpath,filename = os.path.split(os.path.join(directory, name))
     if filename:
         if not os.path.exists(dirpath):
-            os.makedirs(dirpath)
+            try:
+                os.makedirs(dirpath)
+            except OSError:
+                # Created by another render process in the meantime
+                if not os.path.isdir(dirpath):
+                    raise
         # Save figure to the current directory
         savepath = os.path.join(dirpath, filename)
         # Actually save the figure
@@ -1,9 +1,21 @@
 #!/usr/bin/env python
 
 import os
+import warnings
 from predict_demand import demand_formatter as defo, demand_plotter as depl
 import numpy as np
 
+# Saved with each prediction, along with the last history hour used by the fit
+MODEL_VERSION = 'linreg-mad-1'
+# Outlier if more than MAD_THRESHOLD*MAD from the median
+MAD_THRESHOLD = 4.0
+# Outlier if less than MEDIAN_FRACTION of the median
+MEDIAN_FRACTION = 0.20
+# Weeks of history before a day used for its drift over time (day_trends)
+TREND_WEEKS = 10
+# Slot regressions, ordinary least squares, or weighted by the decay_weights of each week
+FIT_WEIGHTINGS = ['ols', 'wls']
+
 def mad(arr):
     """Median Absolute Deviation - identify the median of the 
     absolute distance from the dataset's median;
@@ -12,6 +24,72 @@ def mad(arr):
     med = np.median(arr)
     return np.median(np.abs(arr - med))
 
+def mad_bounds(med_logins, hour_mad):
+    """Returns (low_bound, high_bound) tuple of the valid (non-outlier) logins of a
+    slot with the given median and MAD: within MAD_THRESHOLD*MAD of the median,
+    additionally excluding all points <= MEDIAN_FRACTION of the median"""
+    low_bound = max(med_logins - (MAD_THRESHOLD*hour_mad), MEDIAN_FRACTION*med_logins)
+    high_bound = med_logins + (MAD_THRESHOLD*hour_mad)
+    return (low_bound, high_bound)
+
+def mad_classify(logins_arr):
+    """Statistically identify outliers within the logins of a single slot 
+    (same day of week & hour) through the MAD-based approach.
+    Returns (scores, keep, low_bound, high_bound) tuple, where
+    scores is the number of MADs each point is from the median (signed),
+    keep is the boolean array of valid (non-outlier) points and
+    valid points are within (low_bound, high_bound)"""
+    logins_arr = np.array(logins_arr, dtype=float)
+    hour_mad = mad(logins_arr)
+    if hour_mad == 0.0:
+        hour_mad = np.std(logins_arr) # Use standard deviation if MAD is zero
+    med_logins = np.median(logins_arr)
+    low_bound, high_bound = mad_bounds(med_logins, hour_mad)
+    keep = (logins_arr > low_bound) & (logins_arr < high_bound)
+    if not keep.any():
+        keep = abs(logins_arr-med_logins) <= 5*hour_mad
+        print 'WARNING: No points within MAD threshold! Increasing tolerance'
+    if hour_mad > 0.0:
+        scores = (logins_arr - med_logins) / hour_mad
+    else:
+        scores = np.zeros(logins_arr.shape)
+    return (scores, keep, low_bound, high_bound)
+
+def weekly_cube(id_list, logins_list):
+    """Pivots the hourly history (ids & their logins) into a single array of
+    weeks x day of week (Monday first) x hour of day, NaN where there is no history.
+    Returns (first_monday, cube) tuple, where first_monday (numpy datetime64 day)
+    is the first day of week 0"""
+    times = np.array(id_list, dtype='datetime64[h]')
+    days = times.astype('datetime64[D]')
+    weekdays = (days.astype(int) + 3) % 7 # 1970-01-01 was a Thursday
+    first = np.argmin(days)
+    first_monday = days[first] - np.timedelta64(weekdays[first], 'D')
+    weeks = (days - first_monday).astype(int) // 7
+    cube = np.full((weeks.max()+1, 7, 24), np.nan)
+    cube[weeks, weekdays, (times - days).astype(int)] = logins_list
+    return (first_monday, cube)
+
+def day_trends(first_monday, cube, day_ids, past_weeks=TREND_WEEKS):
+    """Given the weekly_cube of the history, returns the normalized (by mean) drift
+    of each hour of the same day of the week over the past_weeks before each of the
+    given days, as one array of days x past_weeks (oldest first) x 24 hours of
+    (logins-mean)/mean, with the mean of each hour over those weeks.
+    NaN where there is no history"""
+    days = np.array([str(x)[0:10] for x in day_ids], dtype='datetime64[D]')
+    offsets = (days - first_monday).astype(int)
+    weeks = offsets // 7
+    weekdays = offsets % 7
+    # Pad with empty weeks, so weeks before the first (or after the last) are NaN
+    padded = np.concatenate([np.full((past_weeks, 7, 24), np.nan), cube,
+        np.full((max(0, weeks.max() - cube.shape[0]), 7, 24), np.nan)])
+    window_idx = weeks[:, None] + np.arange(past_weeks)
+    windows = padded[window_idx, weekdays[:, None], :]
+    with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning) # Hours without any history
+        mean = np.nanmean(windows, axis=1)[:, None, :]
+        return (windows - mean) / mean
+
 def slope_smoothing(pred_slope_list):
     """Smoothes slopes with neighbors (adjacent hours of the same day).
     Optimistic approach to skew trend (slope) positive as demand is increasing
@@ -41,6 +119,22 @@ def slope_smoothing(pred_slope_list):
         pred_slope_smoothed.append(avg_sl)
     return pred_slope_smoothed
 
+def model_version(lookback_weeks=0, weighting='ols'):
+    """Returns the model version of predictions fit with the lookback window
+    and regression weighting, MODEL_VERSION for the full history & least squares"""
+    version = MODEL_VERSION
+    if weighting != 'ols':
+        version += '-' + weighting
+    if lookback_weeks:
+        version += '-lb%d' % lookback_weeks
+    return version
+
+def decay_weights(weeks):
+    """Returns the weight of each number of weeks in the past, 1-(x^2-1)/150
+    (see weighted_mean_calc), zero from 13 weeks on"""
+    weeks = np.asarray(weeks)
+    return np.maximum(0.0, 1.0-((weeks*weeks-1.0)/150.0))
+
 def weighted_mean_calc(weeks, logins):
     """Calculate a weighted mean with exponential favoring towards dates closer
     in time.
@@ -56,21 +150,24 @@ def weighted_mean_calc(weeks, logins):
     # 10 weeks = .34
     # 12 weeks = .05
     """
-    weights = np.array([max(0.0,1.0-((x*x-1.0)/150.0)) for x in weeks])
+    weights = decay_weights(weeks)
     if sum(weights) <= 0.0:
         weighted_mean = np.average(logins) # Don't use weighted mean if weight set sums to zero
     else:
         weighted_mean = np.average(logins, weights=weights)
     return weighted_mean
         
-def lin_reg_by_hour(all_data,outlier_data,debug=[]):
+def lin_reg_by_hour(all_data,outlier_data,debug=[],mad_masks=None,lookback_weeks=0,weighting='ols'):
     """Group data into same hour and day of week.
     Remove manually tagged outliers (in outlier_data),
-    statistically identify other outliers through MAD-based approach and remove,
+    statistically identify other outliers through MAD-based approach and remove
+    (mad_masks is an optional dictionary of saved classifications, id: True if valid),
     run least squares linear regression on remaining valid data,
     calculate weighted mean xy point and save with slope,
     run smoothing algorithm on calculated slopes to average values with neighboring hours (& skew towards positive trend),
     get prediction based on weighted mean and smoothed slope.
+    Only the last lookback_weeks weeks of all_data are used (every week if 0), and
+    weighting 'wls' weights each week of the regression by its decay_weights.
     Returns (id_list, predicted_logins, slope_list) tuple of 
     for an entire week (starting with hour immediately after last hour in all_data)"""
     # Remove outliers from data
@@ -79,8 +176,13 @@ def lin_reg_by_hour(all_data,outlier_data,debug=[]):
     all_data = [x for x in all_data if x['id'] not in outlier_ids]
     if debug: print 'Data size after: %d'%len(all_data)
         
+    if weighting not in FIT_WEIGHTINGS:
+        raise ValueError('Unknown fit weighting: %s' % weighting)
     # Get first predicted hour (1 hour past last history entry)
     pred_id = defo.add_x_hours(all_data[-1]['id'],1)
+    if lookback_weeks:
+        lookback_id = defo.add_x_hours(pred_id, -24*7*lookback_weeks)
+        all_data = [x for x in all_data if x['id'] >= lookback_id]
     pred_slope_list = []
     pred_list = []
     pred_point_list = [] # list of tuples (1 xy tuple per slope) so we can recalculate y-intercept after smoothing
@@ -103,25 +205,22 @@ def lin_reg_by_hour(all_data,outlier_data,debug=[]):
             logins_arr = np.array(logins)
             
             ## Find and remove MAD based outliers
-            hour_mad = mad(logins_arr)
-            if hour_mad == 0.0:
-                hour_mad = np.std(logins_arr) # Use standard deviation if MAD is zero
-            # Indices for data points > -5*MAD and < 5*MAD
-            # Additionally exclude all points <= 20% of the median
-            med_logins = np.median(logins_arr)
-            low_mad_idx = logins_arr > max(med_logins - (4*hour_mad), 0.20*med_logins)
-            high_mad_idx = logins_arr < med_logins + (4*hour_mad)
-            logins_mad_idx = low_mad_idx & high_mad_idx
-            if logins_mad_idx == []:
-                logins_mad_idx = abs(logins_arr-weighted_mean) < 5*hour_mad
-                print 'WARNING: No points within MAD threshold! Increasing tolerance'
-            for is_valid in logins_mad_idx:
-                if not is_valid:
-                    outlier_count = outlier_count + 1
+            # Use the saved classification when every hour in the slot has been scored
+            if mad_masks is not None and all([x['id'] in mad_masks for x in hour_data]):
+                logins_mad_idx = np.array([mad_masks[x['id']] for x in hour_data], dtype=bool)
+            else:
+                logins_mad_idx = mad_classify(logins_arr)[1]
+            outlier_count = outlier_count + np.sum(~logins_mad_idx)
                     
             # Least squares linear regression
             A = np.array([ -1*weeks_arr[logins_mad_idx], np.ones(weeks_arr[logins_mad_idx].size)])
-            lst_sq_pt = np.linalg.lstsq(A.T,logins_arr[logins_mad_idx])[0]
+            weights = decay_weights(weeks_arr[logins_mad_idx]) if weighting == 'wls' else None
+            if weights is not None and np.count_nonzero(weights) >= 2:
+                # Weighted least squares, both sides scaled by the square root of the weights
+                root_weights = np.sqrt(weights)
+                lst_sq_pt = np.linalg.lstsq(A.T*root_weights[:,None],logins_arr[logins_mad_idx]*root_weights)[0]
+            else:
+                lst_sq_pt = np.linalg.lstsq(A.T,logins_arr[logins_mad_idx])[0]
             
             # Weighted mean calculation for baseline xy point (used with smoothed slope)
             weighted_mean = weighted_mean_calc(weeks_arr[logins_mad_idx],logins_arr[logins_mad_idx])
@@ -134,7 +233,7 @@ def lin_reg_by_hour(all_data,outlier_data,debug=[]):
             if lst_sq_pt[0] < 0.0:
                 negative_slope_count = negative_slope_count+1
             if debug: 
-                print "Predicting %s%d: %f Median %f Mean, %f MAD"%(cur_day_name,cur_hour,med_logins,weighted_mean,hour_mad)
+                print "Predicting %s%d: %f Median %f Mean, %f MAD"%(cur_day_name,cur_hour,np.median(logins_arr),weighted_mean,mad(logins_arr))
                 print logins_arr
                 print logins_arr[logins_mad_idx]
                 print "  %fx+%f"%(lst_sq_pt[0],lst_sq_pt[1])
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# Parallel rendering of the analysis and prediction plots.
+#
+# Plots are described as independent render tasks, (label, demand_plotter function
+# name, args, kwargs) tuples holding only the (picklable) slice of data the plot
+# needs, and rendered by a pool of PLOT_WORKERS processes using the Agg backend.
+# With a single worker (or a single task) plots are rendered in this process.
+# Every plot is timed, and a summary report is printed and returned.
+#
+# The plots manifest (plots/manifest.json) saves the hash of each plot's inputs
+# (function, data slice & parameters) by label, the file name under plots/.
+# Tasks whose inputs are unchanged since the saved file was rendered are skipped.
+#
+# Single plots can also be rendered in memory (render_bytes, for the plots endpoint),
+# kept in a least recently used cache of PLOT_CACHE_SIZE images by input hash.
+
+from predict_demand import app, demand_plotter as depl
+import os
+import json
+import time
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+# Number of slowest plots listed in the timing report
+REPORT_SLOWEST = 5
+# Saved with every plot's input hash, change it when the plotting code changes
+# so every plot is rendered again
+MANIFEST_VERSION = 1
+MANIFEST_FILE = os.path.join('plots', 'manifest.json')
+
+_plot_cache = OrderedDict() # (input hash, format): image bytes, oldest first
+_cache_lock = threading.Lock()
+
+def task(label, func_name, *args, **kwargs):
+    """Returns the render task calling demand_plotter's func_name(*args, **kwargs),
+    reported under label (i.e. the saved file name)"""
+    return (label, func_name, args, kwargs)
+
+def row_dicts(rows, keys=None):
+    """Converts database rows (sqlite3.Row, which can't be sent to the render
+    processes) to dictionaries, of all columns or only the given keys"""
+    return [dict([(key, row[key]) for key in (keys or row.keys())]) for row in rows]
+
+def task_hash(render_task):
+    """Returns the hash of the task's inputs (function, data and parameters)"""
+    label, func_name, args, kwargs = render_task
+    inputs = json.dumps([MANIFEST_VERSION, func_name, args, kwargs], sort_keys=True, default=repr)
+    return hashlib.sha1(inputs).hexdigest()
+
+def plot_file(label):
+    """Returns the file the plot labeled label is saved to"""
+    return os.path.join('plots', label + '.png')
+
+def load_manifest():
+    """Returns the plots manifest (label: input hash), empty if there is none"""
+    try:
+        with open(MANIFEST_FILE, 'r') as infile:
+            return json.load(infile)
+    except (IOError, ValueError):
+        return {}
+
+def save_manifest(manifest):
+    """Saves the plots manifest, replacing the file in one step"""
+    if not os.path.isdir(os.path.dirname(MANIFEST_FILE)):
+        os.makedirs(os.path.dirname(MANIFEST_FILE))
+    with open(MANIFEST_FILE + '.tmp', 'w') as outfile:
+        json.dump(manifest, outfile, sort_keys=True, indent=0)
+    os.rename(MANIFEST_FILE + '.tmp', MANIFEST_FILE)
+
+def init_worker():
+    """Render process initializer"""
+    # The lock may have been held by another thread of the parent when forked
+    depl.render_lock = threading.RLock()
+
+def render_bytes(render_task, ext='png', input_hash=None):
+    """Renders a single task in memory, returns the image bytes (format ext).
+    Images are cached by input hash (task_hash) and format, dropping the least
+    recently used beyond PLOT_CACHE_SIZE images"""
+    key = (input_hash or task_hash(render_task), ext)
+    with _cache_lock:
+        if key in _plot_cache:
+            _plot_cache[key] = _plot_cache.pop(key) # Most recently used
+            return _plot_cache[key]
+    label, func_name, args, kwargs = render_task
+    image = depl.render_to_buffer(func_name, args, kwargs, ext)
+    with _cache_lock:
+        _plot_cache[key] = image
+        while len(_plot_cache) > app.config['PLOT_CACHE_SIZE']:
+            _plot_cache.popitem(last=False)
+    return image
+
+def render_one(render_task):
+    """Renders a single task, returns (label, seconds, error message or None)"""
+    label, func_name, args, kwargs = render_task
+    start_time = time.time()
+    try:
+        with depl.render_lock:
+            getattr(depl, func_name)(*args, **kwargs)
+    except Exception as err:
+        depl.plt.close('all')
+        return (label, time.time()-start_time, '%s: %s' % (type(err).__name__, err))
+    return (label, time.time()-start_time, None)
+
+def num_workers():
+    """Returns the number of render processes (PLOT_WORKERS, every core if 0)"""
+    workers = int(app.config.get('PLOT_WORKERS', 0))
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+    return workers
+
+def render(tasks, name='plots', force=False):
+    """Renders the list of tasks, in parallel if there are several workers.
+    Unless force is set, tasks whose inputs match the manifest (and whose
+    file exists) are skipped.
+    Returns the timing report dictionary (number of plots rendered, skipped and
+    failed, wall and summed render seconds, workers and the slowest plots)"""
+    manifest = load_manifest()
+    hashes = dict([(x[0], task_hash(x)) for x in tasks])
+    skipped = set()
+    if not force:
+        skipped = set([x[0] for x in tasks if manifest.get(x[0]) == hashes[x[0]] \
+            and os.path.exists(plot_file(x[0]))])
+        tasks = [x for x in tasks if x[0] not in skipped]
+    workers = min(num_workers(), len(tasks))
+    start_time = time.time()
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, init_worker)
+        try:
+            chunksize = max(1, len(tasks) // (workers*4))
+            results = list(pool.imap_unordered(render_one, tasks, chunksize))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [render_one(x) for x in tasks]
+    wall_seconds = time.time() - start_time
+    failed = [(label, error) for label, seconds, error in results if error is not None]
+    if results:
+        manifest.update([(label, hashes[label]) for label, seconds, error in results if error is None])
+        for label, error in failed:
+            manifest.pop(label, None)
+        save_manifest(manifest)
+    slowest = sorted([(seconds, label) for label, seconds, error in results], reverse=True)
+    report = {'plots': len(results), 'skipped': len(skipped), 'failed': len(failed),
+        'workers': max(workers, 1),
+        'wall_seconds': round(wall_seconds, 3),
+        'render_seconds': round(sum([x[0] for x in slowest]), 3),
+        'slowest': [(label, round(seconds, 3)) for seconds, label in slowest[0:REPORT_SLOWEST]]}
+    print "Rendered %d %s (%d unchanged) in %.2fs with %d workers (%.2fs rendering)" % \
+        (report['plots'], name, report['skipped'], report['wall_seconds'], report['workers'], \
+         report['render_seconds'])
+    for label, seconds in report['slowest']:
+        print "  %.3fs %s" % (seconds, label)
+    for label, error in failed:
+        print "  FAILED %s (%s)" % (label, error)
+    return report
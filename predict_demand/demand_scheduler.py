@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# Automatic prediction refresh after new history arrives.
+#
+# Every ingest increments the data_version counter (pipeline_state), and saved
+# predictions record the data version they were based on (predicted_data_version).
+# When the two differ, the scheduler queues a background predict job once ingest
+# has been quiet for REFRESH_DEBOUNCE seconds (or new data has been waiting for
+# REFRESH_MAX_DELAY seconds under constant streaming), never starting refreshes
+# more often than every REFRESH_MIN_INTERVAL seconds.
+# Triggers while a refresh is queued or running are coalesced into the next one.
+# A failed refresh is not retried until the data version changes again.
+# Every region with new data is watched (and refreshed) separately.
+
+from predict_demand import app, db_helper as dbh, demand_jobs
+from flask import g
+import time
+import threading
+
+# Seconds between checks of the data version when nothing is pending
+IDLE_POLL = 30.0
+
+_wake = threading.Event()
+_lock = threading.Lock()
+_threads = []
+_regions = set() # Regions whose data versions are watched
+
+def start():
+    """Starts the scheduler thread (once per process), if AUTO_REFRESH is enabled"""
+    if not app.config.get('AUTO_REFRESH'):
+        return
+    with _lock:
+        if _threads:
+            return
+        scheduler = threading.Thread(target=scheduler_loop, name='refresh-scheduler')
+        scheduler.daemon = True
+        scheduler.start()
+        _threads.append(scheduler)
+
+def notify(region=None):
+    """Wakes the scheduler after new history has been added to the region
+    (the current region if None)"""
+    with _lock:
+        _regions.add(region or dbh.current_region())
+    start()
+    _wake.set()
+
+def get_versions(region):
+    """Returns (data_version, predicted_data_version) tuple of the region"""
+    with app.app_context():
+        g.region = region
+        return (int(dbh.get_state('data_version', 0)),
+                int(dbh.get_state('predicted_data_version', 0)))
+
+def refresh_pending(state):
+    """Returns True if the region's refresh job is still queued or running.
+    A failed refresh job records its data version as failed (failed_version), so
+    it isn't retried until more data arrives, as it would only fail again"""
+    if state['refresh_job'] is None:
+        return False
+    job = demand_jobs.get_job(state['refresh_job'])
+    if job is not None and job['status'] in ('queued', 'running'):
+        return True
+    if job is not None and job['status'] == 'failed':
+        state['failed_version'] = state['refresh_version']
+        print "Prediction refresh (job %d) failed, not retried until data version %d changes" % \
+            (state['refresh_job'], state['refresh_version'])
+    state['refresh_job'] = None
+    return False
+
+def check_region(region, state, now):
+    """Queues the region's prediction refresh if it is due, where state holds the
+    region's scheduling (updated in place).
+    Returns the seconds until the region should be checked again"""
+    data_version, predicted_version = get_versions(region)
+    pending = refresh_pending(state)
+    up_to_date = data_version in (predicted_version, state['failed_version'])
+    if up_to_date or pending:
+        # Up to date (or failed to refresh), or the running refresh will be
+        # followed up once it's done
+        state['waiting_since'] = None if up_to_date else state['waiting_since']
+        return IDLE_POLL if up_to_date else 1.0
+    if data_version != state['last_version']:
+        state['last_version'] = data_version
+        state['changed_at'] = now
+    if state['waiting_since'] is None:
+        state['waiting_since'] = now
+    quiet = now - state['changed_at'] >= app.config['REFRESH_DEBOUNCE']
+    overdue = now - state['waiting_since'] >= app.config['REFRESH_MAX_DELAY']
+    if (quiet or overdue) and now - state['last_refresh'] >= app.config['REFRESH_MIN_INTERVAL']:
+        with app.app_context():
+            g.region = region
+            state['refresh_job'] = demand_jobs.submit('predict', num_days=app.config['REFRESH_DAYS'])
+        state['refresh_version'] = data_version
+        print "Scheduled prediction refresh (job %d) for %s data version %d" % \
+            (state['refresh_job'], region, data_version)
+        state['last_refresh'] = now
+        state['waiting_since'] = None
+    return 1.0
+
+def scheduler_loop():
+    """Watches the data version of each region, queueing debounced prediction refreshes"""
+    states = {}
+    while True:
+        with _lock:
+            regions = sorted(_regions | set([app.config['DEFAULT_REGION']]))
+        timeout = IDLE_POLL
+        for region in regions:
+            if not dbh.region_exists(region):
+                # Deleted, not created again by checking its versions
+                with _lock:
+                    _regions.discard(region)
+                states.pop(region, None)
+                continue
+            # Latest data version seen, when it last changed, when new data first
+            # arrived since the last refresh, the last refresh (time, job and its data
+            # version) and the data version whose refresh failed
+            state = states.setdefault(region, {'last_version': None, 'changed_at': None,
+                'waiting_since': None, 'last_refresh': 0.0, 'refresh_job': None,
+                'refresh_version': None, 'failed_version': None})
+            try:
+                timeout = min(timeout, check_region(region, state, time.time()))
+            except Exception as err:
+                print "Refresh scheduler error (%s)" % region
+                print err
+        _wake.wait(timeout)
+        _wake.clear()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# Mergeable quantile sketches of the logins of each slot (day of week & hour).
+#
+# A sketch holds the number of points, their total, min & max, and a sorted list of
+# [value, count] centroids.  Hourly login counts are small integers, so every distinct
+# value keeps its own centroid and quantiles, median & MAD match numpy exactly.
+# Beyond MAX_CENTROIDS distinct values, the closest neighboring centroids (weighted by
+# their counts, so sparse tails stay apart) are merged into their weighted mean,
+# keeping memory constant per slot however many years of history exist.
+# Sketches are updated in place as points are added or removed (an hour's logins
+# changing from one value to another), and merged to summarize several slots.
+
+import json
+import bisect
+import numpy as np
+
+# Centroids kept per sketch before neighbors are merged
+MAX_CENTROIDS = 200
+# Whiskers at the furthest points within WHISKER_IQR*IQR of the quartiles (as matplotlib)
+WHISKER_IQR = 1.5
+
+def new_sketch():
+    """Returns an empty sketch"""
+    return {'count': 0, 'total': 0, 'min': None, 'max': None, 'centroids': []}
+
+def from_json(sketch_json):
+    """Returns the sketch saved as json (to_json)"""
+    return json.loads(sketch_json)
+
+def to_json(sketch):
+    """Returns the sketch as a json string"""
+    return json.dumps(sketch, separators=(',', ':'))
+
+def add(sketch, value, count=1):
+    """Adds count points of value to the sketch"""
+    if count <= 0:
+        return sketch
+    centroids = sketch['centroids']
+    idx = bisect.bisect_left([x[0] for x in centroids], value)
+    if idx < len(centroids) and centroids[idx][0] == value:
+        centroids[idx][1] += count
+    else:
+        centroids.insert(idx, [value, count])
+    sketch['count'] += count
+    sketch['total'] += value*count
+    sketch['min'] = value if sketch['min'] is None else min(sketch['min'], value)
+    sketch['max'] = value if sketch['max'] is None else max(sketch['max'], value)
+    compact(sketch)
+    return sketch
+
+def remove(sketch, value, count=1):
+    """Removes count points of value from the sketch (from the nearest
+    centroid once values have been merged)"""
+    centroids = sketch['centroids']
+    while count > 0 and centroids:
+        values = [x[0] for x in centroids]
+        idx = bisect.bisect_left(values, value)
+        if idx == len(values) or (idx > 0 and value - values[idx-1] < values[idx] - value):
+            idx -= 1
+        removed = min(count, centroids[idx][1])
+        centroids[idx][1] -= removed
+        if centroids[idx][1] == 0:
+            del centroids[idx]
+        sketch['count'] -= removed
+        sketch['total'] -= value*removed
+        count -= removed
+    if not centroids:
+        sketch.update(new_sketch())
+    else:
+        if value <= sketch['min']:
+            sketch['min'] = centroids[0][0]
+        if value >= sketch['max']:
+            sketch['max'] = centroids[-1][0]
+    return sketch
+
+def merge(sketches):
+    """Returns a new sketch of the points of all the given sketches"""
+    merged = new_sketch()
+    counts = {}
+    for sketch in sketches:
+        for value, count in sketch['centroids']:
+            counts[value] = counts.get(value, 0) + count
+        merged['count'] += sketch['count']
+        merged['total'] += sketch['total']
+        for key, pick in (('min', min), ('max', max)):
+            if sketch[key] is not None:
+                merged[key] = sketch[key] if merged[key] is None else pick(merged[key], sketch[key])
+    merged['centroids'] = [[value, counts[value]] for value in sorted(counts)]
+    return compact(merged)
+
+def compact(sketch):
+    """Merges the closest neighboring centroids until there are at most
+    MAX_CENTROIDS, where closeness is the value gap times the combined count"""
+    centroids = sketch['centroids']
+    while len(centroids) > MAX_CENTROIDS:
+        values = np.array([x[0] for x in centroids], dtype=float)
+        counts = np.array([x[1] for x in centroids], dtype=float)
+        idx = int(np.argmin(np.diff(values) * (counts[:-1] + counts[1:])))
+        count = centroids[idx][1] + centroids[idx+1][1]
+        value = (centroids[idx][0]*centroids[idx][1] + centroids[idx+1][0]*centroids[idx+1][1]) / float(count)
+        centroids[idx:idx+2] = [[value, count]]
+    return sketch
+
+def _arrays(sketch):
+    """Returns (values, cumulative counts) numpy arrays of the centroids"""
+    values = np.array([x[0] for x in sketch['centroids']], dtype=float)
+    return values, np.cumsum([x[1] for x in sketch['centroids']])
+
+def _value_at(values, cum_counts, rank):
+    """Returns the value of the point at rank (0 based) in sorted order"""
+    return values[np.searchsorted(cum_counts, rank, side='right')]
+
+def percentiles(sketch, percents):
+    """Returns the list of percentiles (0-100) of the sketch's points, linearly
+    interpolated between the closest ranks (as numpy.percentile)"""
+    values, cum_counts = _arrays(sketch)
+    result = []
+    for percent in percents:
+        position = (percent/100.0) * (sketch['count']-1)
+        below = int(np.floor(position))
+        weight = position - below
+        above = min(below+1, sketch['count']-1)
+        result.append(float(_value_at(values, cum_counts, below)*(1.0-weight) + \
+            _value_at(values, cum_counts, above)*weight))
+    return result
+
+def median(sketch):
+    """Returns the median of the sketch's points (as numpy.median)"""
+    values, cum_counts = _arrays(sketch)
+    mid = sketch['count'] // 2
+    if sketch['count'] % 2:
+        return float(_value_at(values, cum_counts, mid))
+    return float((_value_at(values, cum_counts, mid-1) + _value_at(values, cum_counts, mid)) / 2.0)
+
+def median_mad(sketch):
+    """Returns (median, MAD) tuple, the Median Absolute Deviation being the median
+    of the absolute distance of the points from their median (demand_predictor.mad)"""
+    med = median(sketch)
+    deviations = {}
+    for value, count in sketch['centroids']:
+        deviation = abs(value - med)
+        deviations[deviation] = deviations.get(deviation, 0) + count
+    deviation_sketch = {'count': sketch['count'],
+        'centroids': [[x, deviations[x]] for x in sorted(deviations)]}
+    return (med, median(deviation_sketch))
+
+def std(sketch):
+    """Returns the (population) standard deviation of the sketch's points"""
+    values, cum_counts = _arrays(sketch)
+    counts = np.diff(np.r_[0, cum_counts])
+    mean = sketch['total'] / float(sketch['count'])
+    return float(np.sqrt(np.sum(counts * (values - mean)**2) / sketch['count']))
+
+def count_between(sketch, low_bound, high_bound):
+    """Returns the number of points within (low_bound, high_bound), exclusive"""
+    return sum([count for value, count in sketch['centroids'] if low_bound < value < high_bound])
+
+def box_stats(sketch):
+    """Summarizes the sketch's points for box plots, the same as matplotlib's
+    boxplot_stats (whiskers at the furthest points within 1.5*IQR of the quartiles).
+    Returns dictionary of num_weeks, total, mean, min_logins, q1, median, q3,
+    max_logins, whislo, whishi and fliers (list of points beyond the whiskers)"""
+    q1, med, q3 = percentiles(sketch, [25, 50, 75])
+    iqr = q3 - q1
+    inside = [value for value, count in sketch['centroids'] \
+        if q1 - WHISKER_IQR*iqr <= value <= q3 + WHISKER_IQR*iqr]
+    # Whiskers never end inside the box
+    whislo = min(inside[0], q1) if inside else q1
+    whishi = max(inside[-1], q3) if inside else q3
+    fliers = []
+    for value, count in sketch['centroids']:
+        if value < whislo or value > whishi:
+            fliers.extend([int(round(value))] * count)
+    return {'num_weeks': sketch['count'], 'total': int(sketch['total']),
+        'mean': sketch['total'] / float(sketch['count']), 'min_logins': int(sketch['min']),
+        'q1': q1, 'median': med, 'q3': q3, 'max_logins': int(sketch['max']),
+        'whislo': float(whislo), 'whishi': float(whishi), 'fliers': fliers}
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# Market timezone conversion of login timestamps, vectorized with numpy.
+#
+# Each timezone's UTC offsets are read once from the system's compiled tz database
+# (TZif files, i.e. /usr/share/zoneinfo/America/New_York) into a table of transition
+# times (UTC seconds) and the offset in effect from each transition on, extended past
+# the last listed transition with the file's POSIX TZ rule (i.e. EST5EDT,M3.2.0,M11.1.0).
+# A batch of timestamps is converted with a single searchsorted over the table, with no
+# per timestamp timezone objects.  Ids are the local wall clock hour (2012-03-11T01),
+# so weekly slots (day of week & hour) follow local time across DST changes.
+
+import os
+import re
+import struct
+import calendar
+import datetime
+import numpy as np
+
+# Folders searched for the compiled tz database
+ZONEINFO_DIRS = [os.environ.get('TZDIR'), '/usr/share/zoneinfo', '/usr/lib/zoneinfo', \
+    '/usr/share/lib/zoneinfo']
+# Years covered by transitions generated from the POSIX TZ rule
+RULE_LAST_YEAR = 2100
+# Earliest time, before every transition
+FIRST_TIME = -2**62
+ZONE_NAME = re.compile(r'^[A-Za-z0-9_+-]+(/[A-Za-z0-9_+-]+)*$')
+OFFSET_SUFFIX = re.compile(r'^(?:\.\d+)?(?:(Z)|([+-])(\d\d):?(\d\d))?$')
+POSIX_TZ = re.compile(r'^(?:<[^>]+>|[A-Za-z]+)([+-]?[\d:]+)(?:(?:<[^>]+>|[A-Za-z]+)([+-]?[\d:]+)?' + \
+    r',M(\d+)\.(\d)\.(\d)(?:/([+-]?[\d:]+))?,M(\d+)\.(\d)\.(\d)(?:/([+-]?[\d:]+))?)?$')
+
+_zones = {} # Timezone name: (transitions, offsets)
+
+def zone_path(zone):
+    """Returns the TZif file of the named timezone, None if there is none"""
+    if not zone or not ZONE_NAME.match(zone) or '..' in zone:
+        return None
+    for folder in ZONEINFO_DIRS:
+        if folder and os.path.isfile(os.path.join(folder, zone)):
+            return os.path.join(folder, zone)
+    return None
+
+def read_tzif(data):
+    """Returns (transition times, offset index of each transition, offsets, POSIX TZ rule)
+    from the contents of a TZif file, using the 64-bit data of version 2+ files"""
+    if data[0:4] != 'TZif':
+        raise ValueError('Not a TZif file')
+    version = data[4]
+    counts = struct.unpack('>6l', data[20:44])
+    time_size = 4
+    start = 44
+    if version >= '2':
+        # Skip the 32-bit data to the 64-bit header & data
+        isutcnt, isstdcnt, leapcnt, timecnt, typecnt, charcnt = counts
+        start += timecnt*5 + typecnt*6 + charcnt + leapcnt*8 + isstdcnt + isutcnt
+        counts = struct.unpack('>6l', data[start+20:start+44])
+        start += 44
+        time_size = 8
+    isutcnt, isstdcnt, leapcnt, timecnt, typecnt, charcnt = counts
+    times = np.frombuffer(data, dtype='>i%d' % time_size, count=timecnt, offset=start).astype(np.int64)
+    start += timecnt*time_size
+    indexes = np.frombuffer(data, dtype=np.uint8, count=timecnt, offset=start).astype(int)
+    start += timecnt
+    offsets = np.array([struct.unpack('>lBB', data[start+6*x:start+6*x+6])[0] for x in range(typecnt)])
+    start += typecnt*6 + charcnt + leapcnt*(time_size+4) + isstdcnt + isutcnt
+    rule = data[start:].strip() if version >= '2' else ''
+    return (times, indexes, offsets, rule)
+
+def posix_seconds(value, default=0):
+    """Returns the seconds of a POSIX TZ [+-]hh[:mm[:ss]] value"""
+    if value is None:
+        return default
+    sign = -1 if value.startswith('-') else 1
+    parts = [int(x) for x in value.lstrip('+-').split(':')]
+    return sign * sum([x*y for x, y in zip(parts, [3600, 60, 1])])
+
+def rule_day(year, month, week, weekday):
+    """Returns the day of the month of a POSIX TZ Mm.w.d rule, the weekday (0 is
+    Sunday) of the week of the month (5 is the last)"""
+    first_weekday = (datetime.date(year, month, 1).weekday() + 1) % 7
+    day = 1 + (weekday - first_weekday) % 7 + 7*(week-1)
+    while day > calendar.monthrange(year, month)[1]:
+        day -= 7
+    return day
+
+def rule_transitions(rule, first_year, last_year=RULE_LAST_YEAR):
+    """Returns (transition times, offsets) of the POSIX TZ rule for the years,
+    empty if the rule has no DST (or is not an Mm.w.d rule)"""
+    match = POSIX_TZ.match(rule or '')
+    if match is None or match.group(3) is None:
+        return ([], [])
+    std_offset = -posix_seconds(match.group(1))
+    dst_offset = -posix_seconds(match.group(2), -std_offset-3600)
+    rules = [(int(match.group(3)), int(match.group(4)), int(match.group(5)), \
+              posix_seconds(match.group(6), 7200), std_offset, dst_offset),
+             (int(match.group(7)), int(match.group(8)), int(match.group(9)), \
+              posix_seconds(match.group(10), 7200), dst_offset, std_offset)]
+    changes = []
+    for year in range(first_year, last_year+1):
+        for month, week, weekday, local_time, before, after in rules:
+            local = calendar.timegm((year, month, rule_day(year, month, week, weekday), 0, 0, 0))
+            changes.append((local + local_time - before, after))
+    changes.sort()
+    return ([x[0] for x in changes], [x[1] for x in changes])
+
+def load_zone(zone):
+    """Returns (transitions, offsets) table of the timezone (cached), arrays of UTC
+    seconds and the UTC offset [seconds] in effect from each transition on, the first
+    transition being before every time.
+    Raises ValueError if the timezone is unknown"""
+    if zone in _zones:
+        return _zones[zone]
+    path = zone_path(zone)
+    if path is None:
+        raise ValueError('Unknown timezone: %s' % zone)
+    with open(path, 'rb') as tzif:
+        times, indexes, offsets, rule = read_tzif(tzif.read())
+    transitions = [FIRST_TIME] + times.tolist()
+    table = [int(offsets[0]) if len(offsets) else 0] + offsets[indexes].tolist()
+    first_year = datetime.datetime.utcfromtimestamp(max(0, transitions[-1])).year
+    rule_times, rule_offsets = rule_transitions(rule, first_year)
+    for time, offset in zip(rule_times, rule_offsets):
+        if time > transitions[-1]:
+            transitions.append(time)
+            table.append(offset)
+    _zones[zone] = (np.array(transitions, dtype=np.int64), np.array(table, dtype=np.int64))
+    return _zones[zone]
+
+def utc_offsets(zone, utc_seconds):
+    """Returns the UTC offset [seconds] of the timezone at each of the UTC times"""
+    transitions, offsets = load_zone(zone)
+    return offsets[np.searchsorted(transitions, utc_seconds, side='right') - 1]
+
+def suffix_offsets(suffixes):
+    """Returns the UTC offset [seconds] given by each timestamp's suffix (following
+    the seconds, i.e. '+00:00', '.25Z' or '-0500'), None for invalid suffixes.
+    Timestamps without an offset are UTC"""
+    unique, inverse = np.unique(suffixes, return_inverse=True)
+    parsed = []
+    for suffix in unique:
+        match = OFFSET_SUFFIX.match(suffix)
+        if match is None:
+            parsed.append(None)
+        elif match.group(2) is None:
+            parsed.append(0)
+        else:
+            parsed.append((1 if match.group(2) == '+' else -1) * (int(match.group(3))*3600 + int(match.group(4))*60))
+    return [parsed[x] for x in inverse]
+
+def local_hour_ids(zone, naive_times, suffixes):
+    """Returns the local hour ids (yyyy-mm-ddThh) in the timezone of the timestamps,
+    given as array of datetime64[s] (as written) and their offset suffixes,
+    and the mask of valid timestamps"""
+    offsets = suffix_offsets(suffixes)
+    valid = np.array([x is not None for x in offsets], dtype=bool)
+    utc_seconds = naive_times[valid].astype(np.int64) - np.array([x for x in offsets if x is not None], dtype=np.int64)
+    local = (utc_seconds + utc_offsets(zone, utc_seconds)).astype('datetime64[s]')
+    return (np.datetime_as_string(local, unit='h'), valid)
+
+def skipped_hours(zone, first_id, last_id):
+    """Returns the local hour ids from first_id to last_id that don't exist in the
+    timezone, skipped as clocks move forward (i.e. 2012-03-11T02 in America/New_York)"""
+    transitions, offsets = load_zone(zone)
+    forward = np.flatnonzero(offsets[1:] > offsets[:-1]) + 1
+    skipped = []
+    for idx in forward:
+        start = transitions[idx] + offsets[idx-1]
+        for local in range(start - start % 3600 + (3600 if start % 3600 else 0), transitions[idx] + offsets[idx], 3600):
+            hour_id = datetime.datetime.utcfromtimestamp(local).strftime('%Y-%m-%dT%H')
+            if first_id <= hour_id <= last_id:
+                skipped.append(hour_id)
+    return skipped
@@ -22,5 +22,157 @@ create table prediction_outliers (
 drop table if exists login_predictions;
 create table login_predictions (
   id text primary key,
-  num_logins real not null
-);
\ No newline at end of file
+  num_logins real not null,
+  model_version text not null default ''
+);
+create index idx_history_slot on login_history (day_name, hour);
+
+drop table if exists history_mad_scores;
+create table history_mad_scores (
+  id text primary key,
+  day_name text not null,
+  hour integer not null,
+  score real not null,
+  low_bound real not null,
+  high_bound real not null,
+  threshold real not null,
+  is_outlier integer not null
+);
+create index idx_mad_scores_slot on history_mad_scores (day_name, hour);
+create index idx_mad_scores_outlier on history_mad_scores (is_outlier);
+
+drop table if exists mad_dirty_slots;
+create table mad_dirty_slots (
+  day_name text not null,
+  hour integer not null,
+  primary key (day_name, hour)
+);
+
+drop table if exists forecast_archive;
+create table forecast_archive (
+  id text not null,
+  model_version text not null,
+  num_logins real not null,
+  actual_logins integer not null,
+  archived_at text not null,
+  primary key (id, model_version)
+);
+create index idx_forecast_archive_version on forecast_archive (model_version);
+
+drop table if exists jobs;
+create table jobs (
+  id integer primary key autoincrement,
+  name text not null,
+  params text not null,
+  status text not null,
+  progress real not null default 0.0,
+  message text,
+  result text,
+  created_at text not null,
+  started_at text,
+  finished_at text,
+  duration real,
+  region text not null default ''
+);
+create index idx_jobs_status on jobs (status, name, params);
+
+drop table if exists slot_stats;
+create table slot_stats (
+  day_name text not null,
+  hour integer not null,
+  num_weeks integer not null,
+  total integer not null,
+  mean real not null,
+  min_logins integer not null,
+  q1 real not null,
+  median real not null,
+  q3 real not null,
+  max_logins integer not null,
+  whislo real not null,
+  whishi real not null,
+  fliers text not null,
+  primary key (day_name, hour)
+);
+
+drop table if exists slot_sketches;
+create table slot_sketches (
+  day_name text not null,
+  hour integer not null,
+  sketch text not null,
+  primary key (day_name, hour)
+);
+
+drop table if exists daily_rollup;
+create table daily_rollup (
+  day text primary key,
+  num_logins integer not null,
+  num_hours integer not null,
+  peak_logins integer not null
+);
+
+drop table if exists weekly_rollup;
+create table weekly_rollup (
+  week text primary key,
+  num_logins integer not null,
+  num_hours integer not null,
+  peak_logins integer not null,
+  num_days integer not null
+);
+
+drop table if exists slot_rollup;
+create table slot_rollup (
+  day_name text not null,
+  hour integer not null,
+  num_hours integer not null,
+  total integer not null,
+  sketch text not null,
+  primary key (day_name, hour)
+);
+
+drop table if exists history_archives;
+create table history_archives (
+  path text primary key,
+  first_id text not null,
+  last_id text not null,
+  num_hours integer not null,
+  num_logins integer not null,
+  size integer not null,
+  created_at text not null,
+  restored integer not null default 0
+);
+
+drop table if exists ingest_ledger;
+create table ingest_ledger (
+  fingerprint text primary key,
+  batch_id text,
+  num_logins integer not null,
+  ingested_at text not null
+);
+create unique index idx_ingest_ledger_batch on ingest_ledger (batch_id);
+
+drop table if exists dedup_filters;
+create table dedup_filters (
+  day text primary key,
+  bits blob not null
+);
+
+drop table if exists region_hierarchy;
+create table region_hierarchy (
+  region text primary key,
+  parent text,
+  level text
+);
+
+drop table if exists reconciled_predictions;
+create table reconciled_predictions (
+  id text primary key,
+  num_logins real not null,
+  method text not null
+);
+
+drop table if exists pipeline_state;
+create table pipeline_state (
+  key text primary key,
+  value text
+);
+insert or ignore into pipeline_state (key, value) values ('created', strftime('%s', 'now'));
\ No newline at end of file
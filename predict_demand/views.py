@@ -1,13 +1,59 @@
 #!/usr/bin/env python
 
-from predict_demand import app, demand_main
+from predict_demand import app, db_helper as dbh, demand_main, demand_jobs, demand_scheduler, \
+    demand_export, demand_render, demand_forecast, demand_hierarchy as dehi, demand_ledger
 import sqlite3
 from flask import Flask, request, session, g, redirect, url_for, abort, \
-     render_template, flash, make_response, jsonify
+     render_template, flash, make_response, jsonify, Response
 import datetime
 
 # API
+# Every /api route that reads or writes history and predictions is also served per
+# region, as /api/<region>/..., each region kept in its own database (see db_helper)
+@app.url_value_preprocessor
+def pull_region(endpoint, values):
+    """Saves the region of a /api/<region>/... request as g.region"""
+    if values and 'region' in values:
+        g.region = dbh.validate_region(values.pop('region'))
+        if g.region is None:
+            abort(404)
+
+@app.url_defaults
+def add_region(endpoint, values):
+    """Keeps the current region in the urls of region scoped routes"""
+    if 'region' not in values and g.get('region') and app.url_map.is_endpoint_expecting(endpoint, 'region'):
+        values['region'] = g.region
+
+@app.before_request
+def check_region():
+    """Regions are created by posting their history, other requests for a
+    region without a database are not found"""
+    if g.get('region') and request.endpoint != 'post_data' and not dbh.region_exists(g.region):
+        abort(404)
+
+@app.route('/api/regions', methods=['GET'])
+def get_regions():
+    """Returns every region with its number of history hours, first and last hour
+    and data version:
+    curl -i http://localhost:5000/api/regions
+    """
+    return make_response(jsonify( { 'regions': demand_main.get_regions() } ), 200)
+
+@app.route('/api/<region>', methods=['DELETE'])
+def delete_region():
+    """Deletes a region's database (its history, predictions and outliers),
+    only when logged in (as the web interface's /clear):
+    curl -i -b cookies.txt -X DELETE http://localhost:5000/api/dc
+    """
+    if not session.get('logged_in'):
+        abort(401)
+    error_msg = demand_main.delete_region(g.region)
+    if error_msg is not None:
+        return make_response(jsonify(error_msg), 400) #BAD REQUEST
+    return make_response(jsonify( { 'deleted': g.region } ), 200)
+
 @app.route('/api/demand', methods=['POST'])
+@app.route('/api/<region>/demand', methods=['POST'])
 def post_data():
     """Adds json timestamps to database.  Either can read in load json file and
     Allows list of values, i.e. from loading entire json file:
@@ -24,15 +70,24 @@ def post_data():
     "update" will hold the count of the entries appended to hours,
     and if the hour had to be created within the database,
     "insert" will hold the count of the entries created.
+    A list of timestamps is recorded in the ingest ledger, posting it again (in any order,
+    or with the same batch id, given as 'batch_id' key or X-Batch-Id header) is rejected
+    with 409, so retried uploads are safe.  A single timestamp is only recorded (and safe
+    to retry) if posted with a batch id:
+    curl -i -H "Content-Type: application/json" -H "X-Batch-Id: 2012-03-01" -X POST -d @uber_demand_prediction_challenge.json http://localhost:5000/api/demand
     """
     if not request.json:
         abort(400)
+    batch_id = request.headers.get('X-Batch-Id')
     if type(request.json) is list:
-        post_response = demand_main.api_insert(request.json)
-        if 'error' in post_response.keys():
+        post_response = demand_main.api_insert(request.json, batch_id=batch_id)
+        if post_response.get('replayed'):
+            http_code = 409 #CONFLICT
+        elif 'error' in post_response.keys():
             http_code = 400 #BAD REQUEST
         else:
             http_code = 201 #CREATED
+            demand_scheduler.notify()
         return make_response(jsonify(post_response),http_code)
     elif type(request.json) is dict:
         if 'timestamp' in request.json.keys():
@@ -45,11 +100,14 @@ def post_data():
             return make_response(jsonify( { 'error': 'Bad request, needs timestamp/timestamps key', 
                 'timestamp_example': '2012-03-01T00:05:55+00:00',
                 'timestamps':['2012-03-01T00:05:55+00:00', '2012-03-01T00:06:23+00:00']} ), 400)
-        post_response = demand_main.api_insert(json_data,single)
-        if 'error' in post_response.keys():
+        post_response = demand_main.api_insert(json_data, single, request.json.get('batch_id', batch_id))
+        if post_response.get('replayed'):
+            http_code = 409 #CONFLICT
+        elif 'error' in post_response.keys():
             http_code = 400 #BAD REQUEST
         else:
             http_code = 201 #CREATED
+            demand_scheduler.notify()
         return make_response(jsonify(post_response),http_code)
     else:
        abort(400)
@@ -57,27 +115,139 @@ def post_data():
 
 @app.route('/api/predict', methods=['PUT'])
 @app.route('/api/predict/<int:num_days>', methods=['PUT'])
+@app.route('/api/<region>/predict', methods=['PUT'])
+@app.route('/api/<region>/predict/<int:num_days>', methods=['PUT'])
 def update_predicted(num_days=15):
     """If historic client login data has been uploaded to the database,
     loads the predicted outliers and runs the prediction algorithm for the next
     specified number of days (15 days if unspecified).  Saves these predicted
     number of logins per hour to the database.
+    Runs as a background job, returns the job id immediately (status at /api/jobs/<id>).
     Using the following command will update the predictions for the
     next 15 days (from the day after the last entered timestamp):
     curl -i -X PUT http://localhost:5000/api/predict
     To specify the number of days to predict (i.e. 3 days), use the following:
     curl -i -X PUT http://localhost:5000/api/predict/3
+    To wait for the predictions and return them (instead of the job), use:
+    curl -i -X PUT http://localhost:5000/api/predict?wait=1
     """
-    get_response = demand_main.api_update_predictions(num_days)
-    if 'error' in get_response.keys():
-        http_code = 400 #BAD REQUEST
-    else:
-        http_code = 201 #CREATED
-    return make_response(jsonify(get_response),http_code)
+    error_msg = demand_main.validate_num_days(num_days)
+    if error_msg is not None:
+        return make_response(jsonify(error_msg),400)
+    if request.args.get('wait'):
+        get_response = demand_main.api_update_predictions(num_days)
+        if 'error' in get_response.keys():
+            http_code = 400 #BAD REQUEST
+        else:
+            http_code = 201 #CREATED
+        return make_response(jsonify(get_response),http_code)
+    job_id = demand_jobs.submit('predict', num_days=num_days)
+    return job_response(job_id)
+
+@app.route('/api/forecast', methods=['PUT'])
+def forecast_regions():
+    """Updates the predictions of every region (or of the comma separated regions)
+    in parallel, for the next days (15 if unspecified).
+    Runs as a background job, whose result is the timing and error of each region:
+    curl -i -X PUT http://localhost:5000/api/forecast
+    curl -i -X PUT "http://localhost:5000/api/forecast?regions=dc,nyc&days=7"
+    To wait for the forecasts and return the report (instead of the job), use:
+    curl -i -X PUT "http://localhost:5000/api/forecast?wait=1"
+    """
+    num_days = request.args.get('days', 15, type=int)
+    regions = request.args.get('regions')
+    regions = regions.split(',') if regions else None
+    error_msg = demand_forecast.validate_forecast(regions, num_days)
+    if error_msg is not None:
+        return make_response(jsonify(error_msg), 400) #BAD REQUEST
+    if request.args.get('wait'):
+        return make_response(jsonify(demand_forecast.forecast_regions(regions, num_days)), 200)
+    job_id = demand_jobs.submit('forecast', num_days=num_days, regions=regions)
+    return job_response(job_id)
+
+@app.route('/api/hierarchy', methods=['PUT'])
+def put_hierarchy():
+    """Replaces the region hierarchy, a JSON list of regions (already created)
+    with their parent region (none for the top level) and level:
+    curl -i -H "Content-Type: application/json" -X PUT -d '[{"region":"dc", "level":"city"},
+        {"region":"dc-nw", "parent":"dc", "level":"zone"}]' http://localhost:5000/api/hierarchy
+    """
+    nodes = request.get_json(silent=True)
+    error_msg = dehi.validate_hierarchy(nodes)
+    if error_msg is not None:
+        return make_response(jsonify(error_msg), 400) #BAD REQUEST
+    dehi.set_hierarchy(nodes)
+    return make_response(jsonify( { 'hierarchy': dehi.get_hierarchy() } ), 200)
+
+@app.route('/api/hierarchy', methods=['GET'])
+def get_hierarchy():
+    """Returns the region hierarchy:
+    curl -i http://localhost:5000/api/hierarchy
+    """
+    return make_response(jsonify( { 'hierarchy': dehi.get_hierarchy() } ), 200)
+
+@app.route('/api/reconcile', methods=['PUT'])
+def reconcile_hierarchy():
+    """Reconciles the saved predictions of every region of the hierarchy, so each
+    parent's forecast is the sum of its children's, with method mint (default,
+    combining every level) or bottom_up (summing the leaf regions).  With days, every
+    region is forecast first.
+    Runs as a background job, whose result is the reconciliation report:
+    curl -i -X PUT "http://localhost:5000/api/reconcile?method=bottom_up"
+    curl -i -X PUT "http://localhost:5000/api/reconcile?days=7"
+    To wait for the reconciliation and return the report (instead of the job), use:
+    curl -i -X PUT "http://localhost:5000/api/reconcile?wait=1"
+    """
+    method = request.args.get('method', 'mint')
+    num_days = request.args.get('days', None, type=int)
+    error_msg = dehi.validate_reconcile(method, num_days)
+    if error_msg is not None:
+        return make_response(jsonify(error_msg), 400) #BAD REQUEST
+    if request.args.get('wait'):
+        report = dehi.reconcile_hierarchy(method, num_days)
+        return make_response(jsonify(report), 400 if 'error' in report else 200)
+    job_id = demand_jobs.submit('reconcile', method=method, num_days=num_days)
+    return job_response(job_id)
+
+@app.route('/api/reconciled', methods=['GET'])
+@app.route('/api/<region>/reconciled', methods=['GET'])
+def get_reconciled():
+    """Returns the reconciled predictions of the region (PUT /api/reconcile first):
+    curl -i http://localhost:5000/api/dc-nw/reconciled
+    """
+    return make_response(jsonify(dehi.get_reconciled()), 200)
+
+@app.route('/api/jobs', methods=['GET'])
+def get_jobs():
+    """Returns the most recent background jobs, newest first:
+    curl -i http://localhost:5000/api/jobs
+    """
+    return make_response(jsonify( { 'jobs': demand_jobs.get_jobs() } ), 200)
+
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+def get_job(job_id):
+    """Returns the status of a background job: status (queued, running, done or
+    failed), progress (0.0 to 1.0), message, result, and timing
+    (created_at, started_at, finished_at and duration in seconds):
+    curl -i http://localhost:5000/api/jobs/1
+    """
+    job = demand_jobs.get_job(job_id)
+    if job is None:
+        abort(404)
+    return make_response(jsonify(job), 200)
+
+def job_response(job_id):
+    """Response for a submitted background job, 202 ACCEPTED with the
+    job status and its location"""
+    response = make_response(jsonify(demand_jobs.get_job(job_id)), 202)
+    response.headers['Location'] = url_for('get_job', job_id=job_id)
+    return response
 
 
 @app.route('/api/predict', methods=['GET'])
 @app.route('/api/predict/<int:num_days>', methods=['GET'])
+@app.route('/api/<region>/predict', methods=['GET'])
+@app.route('/api/<region>/predict/<int:num_days>', methods=['GET'])
 def get_predicted(num_days=None):
     """If predictions have been updated and stored in the database (via /api/predict PUT), 
     returns the predicted logins per hour for future demand.
@@ -89,16 +259,182 @@ def get_predicted(num_days=None):
     curl -i http://localhost:5000/api/predict
     To specify the number of days to predict (i.e. 3 days), use the following:
     curl -i http://localhost:5000/api/predict/3
+    To get an ordered page of predictions within a range of hours
+    (start inclusive, end exclusive, both optional), use the following and pass the
+    returned next_cursor as cursor to get the following page:
+    curl -i "http://localhost:5000/api/predict?start=2012-05-02T00&end=2012-05-09T00&limit=24"
+    Responses include an ETag, requests with a matching If-None-Match header
+    return 304 NOT MODIFIED (without reading the predictions).
     """
-    get_response = demand_main.api_predict(num_days)
+    etag = demand_main.get_prediction_etag()
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304) #NOT MODIFIED
+        response.set_etag(etag)
+        return response
+    range_args = [x for x in ('start', 'end', 'cursor', 'limit') if x in request.args]
+    if range_args and num_days is None:
+        get_response = demand_main.api_predict_range(request.args.get('start'), \
+            request.args.get('end'), request.args.get('cursor'), request.args.get('limit', type=int))
+    else:
+        get_response = demand_main.api_predict(num_days)
     if 'error' in get_response.keys():
         http_code = 400 #BAD REQUEST
     else:
         http_code = 200 #OK
-    return make_response(jsonify(get_response),http_code)
+    response = make_response(jsonify(get_response),http_code)
+    if http_code == 200:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/api/predict/query', methods=['POST'])
+@app.route('/api/<region>/predict/query', methods=['POST'])
+def query_predicted():
+    """Returns the predicted logins for a list of specific hours, including hours
+    beyond the saved predictions (evaluated from the fitted model, nothing is saved).
+    The json body is either the list of hours or a dictionary with an "hours" key:
+    curl -i -H "Content-Type: application/json" -X POST -d '{"hours":["2012-05-01T00","2012-06-01T12"]}' http://localhost:5000/api/predict/query
+    """
+    if not request.json:
+        abort(400)
+    if type(request.json) is dict:
+        hour_list = request.json.get('hours')
+    else:
+        hour_list = request.json
+    query_response = demand_main.api_predict_query(hour_list)
+    if 'error' in query_response.keys():
+        http_code = 400 #BAD REQUEST
+    else:
+        http_code = 200 #OK
+    return make_response(jsonify(query_response),http_code)
+
+
+@app.route('/api/history/compact', methods=['PUT'])
+@app.route('/api/<region>/history/compact', methods=['PUT'])
+def compact_history():
+    """Moves the history older than the hot window (the last weeks, HOT_WEEKS if
+    unspecified) out of the database, into a compressed archive file and per-slot
+    rollups.  Runs as a background job, whose result is the compaction report:
+    curl -i -X PUT "http://localhost:5000/api/history/compact?weeks=12"
+    To wait for the compaction and return the report (instead of the job), use:
+    curl -i -X PUT "http://localhost:5000/api/history/compact?wait=1"
+    """
+    hot_weeks = request.args.get('weeks', app.config['HOT_WEEKS'], type=int)
+    if hot_weeks <= 0:
+        return make_response(jsonify({'error':'Number of weeks to keep must be positive',
+            'weeks_example': 12}), 400) #BAD REQUEST
+    if request.args.get('wait'):
+        return make_response(jsonify(demand_main.compact_history(hot_weeks)), 200)
+    job_id = demand_jobs.submit('compact', hot_weeks=hot_weeks)
+    return job_response(job_id)
+
+@app.route('/api/history/reload', methods=['PUT'])
+@app.route('/api/<region>/history/reload', methods=['PUT'])
+def reload_history():
+    """Reloads the archived history of the days from start to end (every archived
+    hour if unspecified) into the database, until the next compaction.
+    Runs as a background job, whose result is the number of reloaded hours:
+    curl -i -X PUT "http://localhost:5000/api/history/reload?start=2012-03-01T00&end=2012-03-31T23"
+    To wait for the reload (instead of the job), use:
+    curl -i -X PUT "http://localhost:5000/api/history/reload?wait=1"
+    """
+    start_id = request.args.get('start')
+    end_id = request.args.get('end')
+    if request.args.get('wait'):
+        reloaded = demand_main.api_reload_history(start_id, end_id)
+        return make_response(jsonify(reloaded), 400 if 'error' in reloaded else 200)
+    job_id = demand_jobs.submit('reload', start_id=start_id, end_id=end_id)
+    return job_response(job_id)
+
+@app.route('/api/history/archives', methods=['GET'])
+@app.route('/api/<region>/history/archives', methods=['GET'])
+def get_history_archives():
+    """Returns the archive files of the compacted history, and the per-slot
+    rollups of the archived hours:
+    curl -i http://localhost:5000/api/history/archives
+    """
+    return make_response(jsonify(demand_main.get_history_archives()), 200)
+
+@app.route('/api/ledger', methods=['GET'])
+@app.route('/api/<region>/ledger', methods=['GET'])
+def get_ledger():
+    """Returns the most recently ingested batches of timestamps (up to limit, 50 if
+    unspecified), their fingerprint, batch id, number of logins and time ingested:
+    curl -i "http://localhost:5000/api/ledger?limit=10"
+    """
+    limit = request.args.get('limit', 50, type=int)
+    return make_response(jsonify( { 'batches': demand_ledger.get_ledger(max(1, limit)) } ), 200)
+
+@app.route('/api/export/<dataset>', methods=['GET'])
+@app.route('/api/<region>/export/<dataset>', methods=['GET'])
+def export_data(dataset):
+    """Streams a dataset (history, predictions, outliers or predicted_outliers) as
+    a file download, in format csv.gz (default), npy or arrow (if pyarrow is installed),
+    optionally limited to the hours from start (inclusive) to end (exclusive):
+    curl -o history.csv.gz http://localhost:5000/api/export/history
+    curl -o history.npy "http://localhost:5000/api/export/history?format=npy&start=2012-04-01T00"
+    """
+    export_format = request.args.get('format', 'csv.gz')
+    start_id = request.args.get('start')
+    end_id = request.args.get('end')
+    error_msg = demand_export.validate_export(dataset, export_format, start_id, end_id)
+    if error_msg is not None:
+        return make_response(jsonify(error_msg), 400) #BAD REQUEST
+    response = Response(demand_export.export(dataset, export_format, start_id, end_id, \
+        dbh.current_region()), \
+        mimetype=demand_export.FORMATS[export_format][0])
+    response.headers['Content-Disposition'] = 'attachment; filename=%s' % \
+        demand_export.export_filename(dataset, export_format)
+    return response
+
+
+@app.route('/plots/<kind>/<key>.<any(png, svg):ext>')
+@app.route('/plots/slopes.<any(png, svg):ext>', defaults={'kind': 'slopes', 'key': None})
+def show_plot(kind, key, ext):
+    """Renders a single plot in memory as png or svg (without the batch analysis):
+    the history of a calendar week, a day (history or predictions), the box plots
+    of a day of the week, or the slopes of the latest fitted model:
+    curl -o week.png http://localhost:5000/plots/week/2012-04-16.png
+    curl -o day.svg http://localhost:5000/plots/day/2012-05-03.svg
+    curl -o monday.png http://localhost:5000/plots/slot/Mo.png
+    curl -o slopes.png http://localhost:5000/plots/slopes.png
+    """
+    render_task = demand_main.plot_task(kind, key)
+    if render_task is None:
+        abort(404)
+    input_hash = demand_render.task_hash(render_task)
+    etag = '%s-%s' % (input_hash, ext)
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304) #NOT MODIFIED
+    else:
+        response = make_response(demand_render.render_bytes(render_task, ext, input_hash))
+        response.mimetype = 'image/svg+xml' if ext == 'svg' else 'image/png'
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=%d' % app.config['PLOT_MAX_AGE']
+    return response
+
+
+@app.route('/api/accuracy', methods=['GET'])
+@app.route('/api/<region>/accuracy', methods=['GET'])
+def get_accuracy():
+    """Returns the forecast error of archived predictions (predictions whose hours
+    now have actual data), grouped by model, optionally with each fit's error (runs=1):
+    curl -i http://localhost:5000/api/accuracy
+    curl -i "http://localhost:5000/api/accuracy?runs=1"
+    """
+    accuracy = demand_main.get_forecast_accuracy(request.args.get('runs', 0, type=int))
+    if not accuracy:
+        return make_response(jsonify( { 'error': 'No archived predictions with actuals' } ), 404)
+    return make_response(jsonify( { 'accuracy': accuracy } ), 200)
 
 
 # Web interface GUI with basic user authentication
+@app.before_first_request
+def start_scheduler():
+    """Starts the automatic prediction refresh (AUTO_REFRESH)"""
+    demand_scheduler.start()
+
 @app.teardown_appcontext
 def close_db(error):
     """Closes the database again at the end of the request."""
@@ -107,12 +443,23 @@ def close_db(error):
 
 @app.route('/')
 def show_entries():
-    pred = demand_main.get_predictions()
-    hist = demand_main.get_login_history()
-    if not hist and not pred:
+    period = request.args.get('period', 'day')
+    if period not in demand_main.ROLLUPS:
+        period = 'day'
+    pred = demand_main.get_prediction_rollup()
+    hist = demand_main.get_history_rollup(period, request.args.get('before'), request.args.get('after'))
+    paging = 'before' in request.args or 'after' in request.args
+    if not hist['rows'] and not pred and not paging:
         return render_template('show_entries.html', show_db=0)
     else:
-        return render_template('show_entries.html', show_db=1, entries=pred, history=hist)
+        return render_template('show_entries.html', show_db=1, entries=pred, history=hist, period=period)
+
+@app.route('/day/<day>')
+def show_day(day):
+    detail = demand_main.get_day_detail(day)
+    if detail is None:
+        abort(404)
+    return render_template('day.html', **detail)
 
 @app.route('/clear')
 def clear_loaded_db():
@@ -133,16 +480,18 @@ def read_json():
         if errorMsg is not None:
             flash(errorMsg)
         else:
-            flash('Login data added to database. Predictions should be updated')
-        demand_main.delete_predictions_with_actuals()
+            flash('Login data added to database. Predictions will be updated')
+            demand_scheduler.notify()
+        demand_main.archive_predictions_with_actuals()
     else:
         # Adding single data point
         error_msg = demand_main.add_single_login(request.form['client_login_time'])
         if 'error' in error_msg.keys():
             flash('Invalid timestamp entry')
         else:
-            flash('Data point updated database. Predictions should be updated')
-        demand_main.delete_predictions_with_actuals()
+            flash('Data point updated database. Predictions will be updated')
+            demand_scheduler.notify()
+        demand_main.archive_predictions_with_actuals()
     return redirect(url_for('show_entries'))
     
 @app.route('/outlier', methods=['POST'])
@@ -152,8 +501,11 @@ def add_outlier():
     # Track manually inputted outliers
     # Load outlier database with predetermined dates
     if request.form['Submit'] == 'Load Outliers':
-        demand_main.mark_predetermined_outliers()
-        flash('Outliers marked')
+        error_msg = demand_main.mark_predetermined_outliers()
+        if error_msg is not None:
+            flash(error_msg)
+        else:
+            flash('Outliers marked')
     else:
         error_msg = demand_main.mark_outlier(request.form['outlier_id'], request.form['reason'])
         if error_msg is not None:
@@ -162,25 +514,27 @@ def add_outlier():
             flash('Outlier marked')
     return redirect(url_for('show_entries'))
 
+@app.route('/outliers')
+def review_outliers():
+    if not session.get('logged_in'):
+        abort(401)
+    manual, automatic = demand_main.get_outliers()
+    return render_template('outliers.html', manual=manual, automatic=automatic)
+
 @app.route('/analysis')
 def analysis_plots():
     if not session.get('logged_in'):
         abort(401)
-    demand_main.fill_missing_hours()
-    demand_main.run_analytics()
-    lin_reg_pred_plots = 1 # None: skips plots, much faster
-    demand_main.plot_predictions(lin_reg_pred_plots)
-    flash('Analysis Complete & Plots Saved')
+    job_id = demand_jobs.submit('analysis')
+    flash('Analysis queued (job %d), plots will be saved when complete' % job_id)
     return redirect(url_for('show_entries'))
 
 @app.route('/predict')
 def update_prediction():
     if not session.get('logged_in'):
         abort(401)
-    demand_main.fill_missing_hours()
-    #demand_main.plot_predictions()
-    demand_main.predict_demand(2012,05,01,15)
-    flash('Updated Predicted Demand')
+    job_id = demand_jobs.submit('predict', num_days=15)
+    flash('Prediction update queued (job %d)' % job_id)
     return redirect(url_for('show_entries'))
 
 @app.route('/writecsv')
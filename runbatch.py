@@ -0,0 +1,8 @@
+#!/usr/bin/env python
+
+import os
+import sys
+# Headless, the web routes are not loaded
+os.environ['PREDICT_DEMAND_HEADLESS'] = '1'
+from predict_demand import demand_batch
+sys.exit(demand_batch.main())
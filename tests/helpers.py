@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# Shared setup of the tests, run from the top level directory with:
+#   python -m unittest discover -s tests
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from predict_demand import app, db_helper as dbh
+
+SAMPLE_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), \
+    'uber_demand_prediction_challenge.json')
+
+def sample_logins():
+    """Returns the login timestamps of the sample data (March & April 2012)"""
+    with open(SAMPLE_FILE, 'r') as infile:
+        return json.load(infile)
+
+class TempDatabaseTestCase(unittest.TestCase):
+    """Runs each test against new databases in a temporary folder (created with
+    the schema on first use), with the background refresh disabled"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.saved_config = dict(app.config)
+        app.config.update(DATABASE=os.path.join(self.tmp, 'test.db'),
+            REGION_DATABASE=os.path.join(self.tmp, 'regions', '%s.db'),
+            ARCHIVE_FOLDER=os.path.join(self.tmp, 'archive'),
+            AUTO_REFRESH=False, FORECAST_WORKERS=1, PLOT_WORKERS=1, TESTING=True)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        dbh.close_headless_db()
+        app.config.clear()
+        app.config.update(self.saved_config)
+        shutil.rmtree(self.tmp)
+
+    def post_json(self, url, data, headers=None):
+        """Returns (status code, json response) of POSTing data to url"""
+        response = self.client.post(url, data=json.dumps(data), headers=headers or {}, \
+            content_type='application/json')
+        return (response.status_code, json.loads(response.data))
+
+    def total_logins(self, region=None):
+        """Returns the number of logins saved in the region's history"""
+        db = dbh.connect_db(region)
+        try:
+            return db.execute('SELECT COALESCE(SUM(num_logins), 0) FROM login_history').fetchone()[0]
+        finally:
+            db.close()
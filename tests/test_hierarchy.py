@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# Hierarchical reconciliation (demand_hierarchy), on an unbalanced hierarchy:
+#   city -> north, south -> south-east, south-west
+
+import json
+import unittest
+import numpy as np
+from predict_demand import db_helper as dbh, demand_hierarchy as dehi
+from helpers import TempDatabaseTestCase
+
+HIERARCHY = [{'region': 'city', 'parent': None, 'level': 'city'},
+             {'region': 'north', 'parent': 'city', 'level': 'zone'},
+             {'region': 'south', 'parent': 'city', 'level': 'zone'},
+             {'region': 'south-east', 'parent': 'south', 'level': 'neighborhood'},
+             {'region': 'south-west', 'parent': 'south', 'level': 'neighborhood'}]
+
+class SummingMatrixTest(unittest.TestCase):
+
+    def test_unbalanced(self):
+        nodes, leaves, S = dehi.summing_matrix(HIERARCHY)
+        self.assertEqual(nodes, ['city', 'north', 'south', 'south-east', 'south-west'])
+        self.assertEqual(leaves, ['north', 'south-east', 'south-west'])
+        self.assertEqual(S.tolist(), [[1, 1, 1], [1, 0, 0], [0, 1, 1], [0, 1, 0], [0, 0, 1]])
+        self.assertEqual(dehi.leaf_rows(S).tolist(), [1, 3, 4])
+
+    def test_single_child(self):
+        # The only child's row is the leaf's, not its parent's
+        nodes, leaves, S = dehi.summing_matrix([{'region': 'city', 'parent': None},
+                                                {'region': 'zone', 'parent': 'city'}])
+        self.assertEqual(leaves, ['zone'])
+        self.assertEqual(dehi.leaf_rows(S).tolist(), [1])
+
+class ReconcileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.S = dehi.summing_matrix(HIERARCHY)[2]
+        # Incoherent base forecasts, nodes x 3 hours
+        self.base = np.array([[30.0, 12.0, 0.0],
+                              [10.0, 5.0, 0.0],
+                              [15.0, 8.0, 1.0],
+                              [6.0, 3.0, 0.0],
+                              [7.0, 4.0, 2.0]])
+
+    def assert_coherent(self, reconciled):
+        np.testing.assert_allclose(reconciled, self.S.dot(reconciled[dehi.leaf_rows(self.S)]))
+
+    def test_bottom_up(self):
+        reconciled = dehi.reconcile(self.S, self.base, 'bottom_up')
+        self.assert_coherent(reconciled)
+        np.testing.assert_allclose(reconciled[[1, 3, 4]], self.base[[1, 3, 4]])
+        np.testing.assert_allclose(reconciled[0], [23.0, 12.0, 2.0])
+
+    def test_mint(self):
+        variances = np.array([4.0, 1.0, 2.0, 0.5, 3.0])
+        reconciled = dehi.reconcile(self.S, self.base, 'mint', variances)
+        self.assert_coherent(reconciled)
+        # Same as the direct S (S' W^-1 S)^-1 S' W^-1 base
+        W_inv = np.diag(1.0 / variances)
+        P = np.linalg.inv(self.S.T.dot(W_inv).dot(self.S)).dot(self.S.T).dot(W_inv)
+        np.testing.assert_allclose(reconciled, self.S.dot(P).dot(self.base))
+
+    def test_mint_structural(self):
+        reconciled = dehi.reconcile(self.S, self.base, 'mint')
+        W_inv = np.diag(1.0 / self.S.sum(axis=1))
+        P = np.linalg.inv(self.S.T.dot(W_inv).dot(self.S)).dot(self.S.T).dot(W_inv)
+        np.testing.assert_allclose(reconciled, self.S.dot(P).dot(self.base))
+
+    def test_mint_keeps_coherent(self):
+        coherent = self.S.dot(self.base[[1, 3, 4]])
+        np.testing.assert_allclose(dehi.reconcile(self.S, coherent, 'mint', [4.0, 1.0, 2.0, 0.5, 3.0]), coherent)
+
+class ReconcileHierarchyTest(TempDatabaseTestCase):
+
+    def setUp(self):
+        TempDatabaseTestCase.setUp(self)
+        # Hours 00 & 01 predicted by every region, 02 only by some
+        predictions = {'city': [40.0, 20.0], 'north': [10.0, 5.0, 1.0], 'south': [25.0, 14.0],
+                       'south-east': [12.0, 6.0, 1.0], 'south-west': [11.0, 7.0]}
+        for region, values in predictions.items():
+            db = dbh.connect_db(region)
+            db.executemany('INSERT INTO login_predictions (id, num_logins) values (?, ?)', \
+                [('2012-05-01T%02d' % hour, value) for hour, value in enumerate(values)])
+            db.commit()
+            db.close()
+        response = self.client.put('/api/hierarchy', data=json.dumps(HIERARCHY), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def reconciled(self, region):
+        return json.loads(self.client.get('/api/%s/reconciled' % region).data)
+
+    def test_bottom_up(self):
+        response = self.client.put('/api/reconcile?wait=1&method=bottom_up')
+        self.assertEqual(response.status_code, 200)
+        report = json.loads(response.data)
+        self.assertEqual((report['nodes'], report['leaves'], report['hours']), (5, 3, 2))
+        self.assertEqual(self.reconciled('city'), {'method': 'bottom_up',
+            'predictions': {'2012-05-01T00': 33.0, '2012-05-01T01': 18.0}})
+        self.assertEqual(self.reconciled('south')['predictions'], {'2012-05-01T00': 23.0, '2012-05-01T01': 13.0})
+        self.assertEqual(self.reconciled('north')['predictions'], {'2012-05-01T00': 10.0, '2012-05-01T01': 5.0})
+
+    def test_mint(self):
+        response = self.client.put('/api/reconcile?wait=1&method=mint')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['weights'], 'structural')
+        values = dict([(x, self.reconciled(x)['predictions']) for x in ['city', 'north', 'south', 'south-east', 'south-west']])
+        for hour in ['2012-05-01T00', '2012-05-01T01']:
+            self.assertAlmostEqual(values['city'][hour], values['north'][hour] + values['south'][hour])
+            self.assertAlmostEqual(values['south'][hour], values['south-east'][hour] + values['south-west'][hour])
+
+    def test_invalid(self):
+        self.assertEqual(self.client.put('/api/reconcile?wait=1&method=top_down').status_code, 400)
+        cycle = [{'region': 'north', 'parent': 'south'}, {'region': 'south', 'parent': 'north'}]
+        response = self.client.put('/api/hierarchy', data=json.dumps(cycle), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        unknown = [{'region': 'east'}]
+        response = self.client.put('/api/hierarchy', data=json.dumps(unknown), content_type='application/json')
+        self.assertEqual(json.loads(response.data)['regions'], ['east'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# Replay-safe ingestion (demand_ledger): batch fingerprints, replays and Bloom dedup.
+
+import json
+import random
+import unittest
+import numpy as np
+from predict_demand import app, db_helper as dbh, demand_ledger as dele
+from helpers import TempDatabaseTestCase
+
+class FingerprintTest(unittest.TestCase):
+
+    def test_order_independent(self):
+        logins = ['2012-03-01T00:05:55+00:00', '2012-03-01T00:06:23+00:00', '2012-03-01T01:00:00+00:00']
+        self.assertEqual(dele.batch_fingerprint(logins), dele.batch_fingerprint(logins[::-1]))
+
+    def test_content_dependent(self):
+        self.assertNotEqual(dele.batch_fingerprint(['2012-03-01T00:05:55']),
+                            dele.batch_fingerprint(['2012-03-01T00:05:56']))
+        # A repeated login is part of the batch
+        self.assertNotEqual(dele.batch_fingerprint(['2012-03-01T00:05:55']),
+                            dele.batch_fingerprint(['2012-03-01T00:05:55'] * 2))
+
+class BloomTest(unittest.TestCase):
+
+    def test_size(self):
+        bits, hashes = dele.bloom_size(100000, 0.001)
+        self.assertEqual(bits % 8, 0)
+        # About 14.4 bits & 10 hashes per key at 0.1% false positives
+        self.assertTrue(1430000 < bits < 1450000)
+        self.assertEqual(hashes, 10)
+
+    def test_indexes(self):
+        keys = [u'2012-03-01T00:%02d:00' % x for x in range(60)]
+        indexes = dele.bloom_indexes(keys, 8000, 5)
+        self.assertEqual(indexes.shape, (60, 5))
+        self.assertTrue((indexes < 8000).all())
+        # Same key, same bits
+        self.assertTrue((dele.bloom_indexes(keys[3:4], 8000, 5) == indexes[3]).all())
+
+    def test_false_positive_rate(self):
+        bits, hashes = dele.bloom_size(2000, 0.01)
+        bit_array = np.zeros(bits, dtype=bool)
+        bit_array[dele.bloom_indexes([u'in-%d' % x for x in range(2000)], bits, hashes).ravel().astype(np.int64)] = True
+        outside = dele.bloom_indexes([u'out-%d' % x for x in range(5000)], bits, hashes).astype(np.int64)
+        self.assertLess(bit_array[outside].all(axis=1).mean(), 0.03)
+
+class DedupTest(TempDatabaseTestCase):
+
+    def setUp(self):
+        TempDatabaseTestCase.setUp(self)
+        app.config.update(DEDUP_WINDOW_DAYS=3, DEDUP_DAY_CAPACITY=1000)
+        self.db = dbh.get_db()
+
+    def dedup(self, logins):
+        result = dele.dedup_logins(self.db.cursor(), logins)
+        self.db.commit()
+        return result
+
+    def test_within_batch(self):
+        logins, duplicates = self.dedup(['2012-03-01T00:05:55', '2012-03-01T00:05:55', '2012-03-01T00:06:00'])
+        self.assertEqual(logins, ['2012-03-01T00:05:55', '2012-03-01T00:06:00'])
+        self.assertEqual(duplicates, 1)
+
+    def test_across_batches(self):
+        self.dedup(['2012-03-01T00:05:55', '2012-03-02T00:05:55'])
+        logins, duplicates = self.dedup(['2012-03-02T00:05:55', '2012-03-02T00:06:00', '2012-03-01T00:05:55'])
+        self.assertEqual(logins, ['2012-03-02T00:06:00'])
+        self.assertEqual(duplicates, 2)
+
+    def test_window(self):
+        self.dedup(['2012-03-01T00:05:55'])
+        # Moving the window past the day drops its filter, so the day is no longer checked
+        self.dedup(['2012-03-05T00:00:00'])
+        days = [x[0] for x in self.db.execute('SELECT day FROM dedup_filters ORDER BY day')]
+        self.assertEqual(days, ['2012-03-05'])
+        self.assertEqual(self.dedup(['2012-03-01T00:05:55']), (['2012-03-01T00:05:55'], 0))
+
+    def test_invalid_days_kept(self):
+        self.assertEqual(self.dedup(['bad', 'bad']), (['bad', 'bad'], 0))
+
+class ReplayTest(TempDatabaseTestCase):
+
+    def test_replayed_batch(self):
+        logins = ['2012-03-01T00:05:55', '2012-03-01T00:06:23', '2012-03-01T01:00:00']
+        status, response = self.post_json('/api/demand', logins)
+        self.assertEqual(status, 201)
+        shuffled = list(logins)
+        random.Random(1).shuffle(shuffled)
+        status, response = self.post_json('/api/demand', shuffled)
+        self.assertEqual(status, 409)
+        self.assertTrue(response['replayed'])
+        self.assertEqual(self.total_logins(), 3)
+
+    def test_batch_id(self):
+        headers = {'X-Batch-Id': 'b1'}
+        self.assertEqual(self.post_json('/api/demand', ['2012-03-01T00:05:55'], headers)[0], 201)
+        status, response = self.post_json('/api/demand', {'timestamps': ['2012-03-01T02:00:00'], 'batch_id': 'b1'})
+        self.assertEqual(status, 409)
+        self.assertEqual(response['batch_id'], 'b1')
+        self.assertEqual(self.total_logins(), 1)
+
+    def test_single_login(self):
+        login = {'timestamp': '2012-03-01T00:05:55', 'batch_id': 's1'}
+        self.assertEqual(self.post_json('/api/demand', login)[0], 201)
+        self.assertEqual(self.post_json('/api/demand', login)[0], 409)
+        # Without a batch id identical single logins are separate logins
+        self.assertEqual(self.post_json('/api/demand', {'timestamp': '2012-03-01T00:05:55'})[0], 201)
+        self.assertEqual(self.total_logins(), 2)
+
+    def test_invalid_batch_not_recorded(self):
+        self.assertEqual(self.post_json('/api/demand', ['bad'])[0], 400)
+        self.assertEqual(self.post_json('/api/demand', ['bad'])[0], 400)
+        ledger = json.loads(self.client.get('/api/ledger').data)
+        self.assertEqual(ledger['batches'], [])
+
+    def test_dedup_timestamps(self):
+        app.config['DEDUP_TIMESTAMPS'] = True
+        self.post_json('/api/demand', ['2012-03-01T00:05:55', '2012-03-01T00:06:23'])
+        status, response = self.post_json('/api/demand', ['2012-03-01T00:06:23', '2012-03-01T00:07:00'])
+        self.assertEqual(status, 201)
+        self.assertEqual(response['duplicates'], 1)
+        self.assertEqual(self.total_logins(), 3)
+
+if __name__ == '__main__':
+    unittest.main()
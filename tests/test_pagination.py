@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# Range & cursor pagination of the saved predictions, and their ETag (GET /api/predict).
+
+import json
+import unittest
+from predict_demand import app, db_helper as dbh
+from helpers import TempDatabaseTestCase, sample_logins
+
+# 3 days of hourly predictions
+HOURS = ['2012-05-%02dT%02d' % (day, hour) for day in range(1, 4) for hour in range(24)]
+
+class PaginationTest(TempDatabaseTestCase):
+
+    def setUp(self):
+        TempDatabaseTestCase.setUp(self)
+        db = dbh.connect_db()
+        db.executemany('INSERT INTO login_predictions (id, num_logins) values (?, ?)', \
+            [(x, float(idx)) for idx, x in enumerate(HOURS)])
+        db.commit()
+        db.close()
+
+    def get(self, query):
+        response = self.client.get('/api/predict?' + query)
+        return (response.status_code, json.loads(response.data))
+
+    def test_pages(self):
+        ids = []
+        cursor = ''
+        pages = 0
+        while cursor is not None:
+            status, page = self.get('limit=10' + ('&cursor=' + cursor if cursor else ''))
+            self.assertEqual(status, 200)
+            self.assertTrue(len(page['predictions']) <= 10)
+            ids += [x['id'] for x in page['predictions']]
+            cursor = page['next_cursor']
+            pages += 1
+        self.assertEqual(ids, HOURS)
+        self.assertEqual(pages, 8)
+
+    def test_exact_last_page(self):
+        # A full last page has no next cursor
+        status, page = self.get('limit=72')
+        self.assertEqual(len(page['predictions']), 72)
+        self.assertEqual(page['next_cursor'], None)
+
+    def test_range(self):
+        status, page = self.get('start=2012-05-02T00&end=2012-05-02T06&limit=4')
+        self.assertEqual([x['id'] for x in page['predictions']], HOURS[24:28])
+        self.assertEqual(page['predictions'][0]['num_logins'], 24.0)
+        self.assertEqual(page['next_cursor'], '2012-05-02T03')
+        status, page = self.get('start=2012-05-02T00&end=2012-05-02T06&limit=4&cursor=' + page['next_cursor'])
+        self.assertEqual([x['id'] for x in page['predictions']], HOURS[28:30])
+        self.assertEqual(page['next_cursor'], None)
+
+    def test_default_limit(self):
+        app.config['API_PAGE_SIZE'] = 50
+        status, page = self.get('start=2012-05-01T00')
+        self.assertEqual(len(page['predictions']), 50)
+        self.assertEqual(page['next_cursor'], HOURS[49])
+
+    def test_invalid(self):
+        for query in ['limit=0', 'limit=5001', 'start=2012-05-32T00', 'cursor=tomorrow']:
+            self.assertEqual(self.get(query)[0], 400, query)
+
+    def test_etag(self):
+        response = self.client.get('/api/predict?limit=10')
+        etag = response.headers['ETag']
+        self.assertEqual(self.client.get('/api/predict', headers={'If-None-Match': etag}).status_code, 304)
+        self.assertEqual(self.client.get('/api/predict', headers={'If-None-Match': '"other"'}).status_code, 200)
+        # Errors have no ETag
+        self.assertNotIn('ETag', self.client.get('/api/predict?limit=0').headers)
+
+class PredictionEtagTest(TempDatabaseTestCase):
+
+    def test_refresh_changes_etag(self):
+        self.assertEqual(self.post_json('/api/demand', sample_logins())[0], 201)
+        self.assertEqual(self.client.put('/api/predict/1?wait=1').status_code, 201)
+        etag = self.client.get('/api/predict').headers['ETag']
+        self.assertEqual(self.client.get('/api/predict', headers={'If-None-Match': etag}).status_code, 304)
+        self.assertEqual(self.client.put('/api/predict/2?wait=1').status_code, 201)
+        response = self.client.get('/api/predict', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(len(json.loads(response.data)), 48)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# Debounced prediction refresh (demand_scheduler), checked at given times.
+
+import time
+import unittest
+from predict_demand import app, db_helper as dbh, demand_jobs, demand_scheduler as desc
+from helpers import TempDatabaseTestCase, sample_logins
+
+class SchedulerTest(TempDatabaseTestCase):
+
+    def setUp(self):
+        TempDatabaseTestCase.setUp(self)
+        app.config.update(REFRESH_DEBOUNCE=10, REFRESH_MIN_INTERVAL=60, REFRESH_MAX_DELAY=30, REFRESH_DAYS=1)
+        self.region = app.config['DEFAULT_REGION']
+        self.state = {'last_version': None, 'changed_at': None, 'waiting_since': None, 'last_refresh': 0.0,
+            'refresh_job': None, 'refresh_version': None, 'failed_version': None}
+        self.logins = sample_logins()
+
+    def ingest(self, count=2000):
+        """Posts the next logins of the sample data"""
+        logins, self.logins = self.logins[:count], self.logins[count:]
+        self.assertEqual(self.post_json('/api/demand', logins)[0], 201)
+
+    def bump_version(self):
+        """New data version without any history, so its refresh fails"""
+        db = dbh.connect_db()
+        dbh.increment_state(db.cursor(), 'data_version')
+        db.commit()
+        db.close()
+
+    def check(self, now):
+        return desc.check_region(self.region, self.state, 1000.0 + now)
+
+    def wait_for_job(self):
+        for attempt in range(600):
+            job = demand_jobs.get_job(self.state['refresh_job'])
+            if job['status'] not in ('queued', 'running'):
+                return job
+            time.sleep(0.05)
+        self.fail('Job %d still %s' % (job['id'], job['status']))
+
+    def test_debounce(self):
+        self.assertEqual(self.check(0), desc.IDLE_POLL)
+        self.ingest()
+        self.check(0)
+        self.ingest()
+        self.check(5)
+        self.check(14)
+        self.assertEqual(self.state['refresh_job'], None)
+        # Quiet for 10 seconds since the last ingest
+        self.check(15)
+        self.assertNotEqual(self.state['refresh_job'], None)
+        self.assertEqual(self.state['refresh_version'], 2)
+        self.assertEqual(self.wait_for_job()['status'], 'done')
+        self.assertEqual(self.check(16), desc.IDLE_POLL)
+        self.assertEqual(self.state['refresh_job'], None)
+
+    def test_max_delay(self):
+        # Constant streaming is refreshed once data has waited REFRESH_MAX_DELAY
+        for now in range(0, 30, 5):
+            self.ingest()
+            self.check(now)
+            self.assertEqual(self.state['refresh_job'], None)
+        self.ingest()
+        self.check(30)
+        self.assertNotEqual(self.state['refresh_job'], None)
+        self.wait_for_job()
+
+    def test_min_interval(self):
+        self.ingest()
+        self.check(0)
+        self.check(10)
+        first_job = self.state['refresh_job']
+        self.wait_for_job()
+        self.ingest()
+        self.check(20)
+        self.check(59)
+        # Quiet, but the last refresh started less than REFRESH_MIN_INTERVAL ago
+        self.assertEqual(self.state['refresh_job'], None)
+        self.check(70)
+        self.assertNotEqual(self.state['refresh_job'], None)
+        self.assertNotEqual(self.state['refresh_job'], first_job)
+        self.wait_for_job()
+
+    def test_coalesced(self):
+        self.ingest()
+        self.check(0)
+        self.check(10)
+        job_id = self.state['refresh_job']
+        # Ingest while the refresh is pending doesn't queue another
+        self.ingest()
+        if demand_jobs.get_job(job_id)['status'] in ('queued', 'running'):
+            self.assertEqual(self.check(11), 1.0)
+            self.assertEqual(self.state['refresh_job'], job_id)
+        self.wait_for_job()
+        # Followed up, unless the refresh already predicted from both ingests
+        self.check(80)
+        self.check(90)
+        if self.state['refresh_job'] is not None:
+            self.assertNotEqual(self.state['refresh_job'], job_id)
+            self.wait_for_job()
+        self.assertEqual(desc.get_versions(self.region), (2, 2))
+
+    def test_failed_not_retried(self):
+        self.bump_version()
+        self.check(0)
+        self.check(10)
+        self.assertEqual(self.wait_for_job()['status'], 'failed')
+        self.assertEqual(self.check(100), desc.IDLE_POLL)
+        self.assertEqual(self.state['failed_version'], 1)
+        self.check(200)
+        self.assertEqual(self.state['refresh_job'], None)
+        # Retried once the data version changes
+        self.ingest(6000)
+        self.check(300)
+        self.check(310)
+        self.assertEqual(self.state['refresh_version'], 2)
+        self.assertEqual(self.wait_for_job()['status'], 'done')
+
+if __name__ == '__main__':
+    unittest.main()
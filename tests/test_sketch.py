@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# Slot quantile sketches (demand_sketch), against numpy & matplotlib on the same points.
+
+import random
+import unittest
+import numpy as np
+from matplotlib import cbook
+from predict_demand import demand_sketch as desk
+
+def sketch_of(points):
+    sketch = desk.new_sketch()
+    for point in points:
+        desk.add(sketch, point)
+    return sketch
+
+class ExactTest(unittest.TestCase):
+    """Login counts are small integers, kept exactly"""
+
+    def setUp(self):
+        rng = random.Random(7)
+        self.points = [rng.randint(0, 60) for x in range(501)]
+        self.sketch = sketch_of(self.points)
+
+    def test_percentiles(self):
+        percents = [0, 1, 10, 25, 33.3, 50, 75, 90, 99, 100]
+        np.testing.assert_allclose(desk.percentiles(self.sketch, percents), np.percentile(self.points, percents))
+
+    def test_median_mad(self):
+        med, mad = desk.median_mad(self.sketch)
+        self.assertEqual(med, np.median(self.points))
+        self.assertEqual(mad, np.median(np.abs(np.array(self.points) - np.median(self.points))))
+        # Even number of points
+        self.assertEqual(desk.median(sketch_of([1, 2, 4, 10])), 3.0)
+
+    def test_std(self):
+        self.assertAlmostEqual(desk.std(self.sketch), np.std(self.points))
+
+    def test_remove(self):
+        for point in self.points[:200]:
+            desk.remove(self.sketch, point)
+        expected = sketch_of(self.points[200:])
+        self.assertEqual(self.sketch, expected)
+        for point in self.points[200:]:
+            desk.remove(self.sketch, point)
+        self.assertEqual(self.sketch, desk.new_sketch())
+
+    def test_merge(self):
+        merged = desk.merge([sketch_of(self.points[:100]), sketch_of(self.points[100:]), desk.new_sketch()])
+        self.assertEqual(merged, self.sketch)
+
+    def test_json(self):
+        self.assertEqual(desk.from_json(desk.to_json(self.sketch)), self.sketch)
+
+    def test_box_stats(self):
+        points = self.points + [150, 200, 0, 0]
+        stats = desk.box_stats(sketch_of(points))
+        expected = cbook.boxplot_stats(np.array(points))[0]
+        for key in ['q1', 'med', 'q3', 'whislo', 'whishi', 'mean']:
+            self.assertAlmostEqual(stats['median' if key == 'med' else key], expected[key], msg=key)
+        self.assertEqual(sorted(stats['fliers']), sorted(expected['fliers'].tolist()))
+        self.assertEqual((stats['num_weeks'], stats['min_logins'], stats['max_logins']), (len(points), 0, 200))
+
+class CompactTest(unittest.TestCase):
+
+    def test_bounded(self):
+        rng = random.Random(3)
+        points = [rng.lognormvariate(3, 1) for x in range(5000)]
+        sketch = sketch_of(points)
+        self.assertTrue(len(sketch['centroids']) <= desk.MAX_CENTROIDS)
+        self.assertEqual(sketch['count'], 5000)
+        self.assertEqual((sketch['min'], sketch['max']), (min(points), max(points)))
+        self.assertAlmostEqual(sketch['total'], sum(points))
+        # Quantiles within 2% of rank
+        for percent, value in zip([10, 50, 90], desk.percentiles(sketch, [10, 50, 90])):
+            rank = np.searchsorted(np.sort(points), value) / 50.0
+            self.assertTrue(abs(rank - percent) < 2, (percent, rank))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Market timezone binning (demand_timezone), against the system's tz database.
+
+import calendar
+import unittest
+import numpy as np
+from predict_demand import app, db_helper as dbh, demand_timezone as detz, demand_formatter as defo
+from helpers import TempDatabaseTestCase
+
+NEW_YORK = 'America/New_York'
+
+def utc(*time_tuple):
+    return calendar.timegm(time_tuple + (0,)*(6-len(time_tuple)))
+
+@unittest.skipUnless(detz.zone_path(NEW_YORK), 'No tz database')
+class OffsetTest(unittest.TestCase):
+
+    def test_dst_2012(self):
+        # EDT from 2012-03-11 07:00 UTC to 2012-11-04 06:00 UTC
+        times = [utc(2012, 3, 11, 6, 59), utc(2012, 3, 11, 7), utc(2012, 11, 4, 5, 59), utc(2012, 11, 4, 6)]
+        self.assertEqual(detz.utc_offsets(NEW_YORK, np.array(times)).tolist(), [-18000, -14400, -14400, -18000])
+
+    def test_rule_extension(self):
+        # Past the file's transitions, from the POSIX rule: DST from the second Sunday of March
+        times = [utc(2050, 3, 13, 6, 59), utc(2050, 3, 13, 7), utc(2050, 7, 1)]
+        self.assertEqual(detz.utc_offsets(NEW_YORK, np.array(times)).tolist(), [-18000, -14400, -14400])
+
+    def test_unknown_zone(self):
+        self.assertRaises(ValueError, detz.load_zone, 'Mars/Olympus_Mons')
+        self.assertRaises(ValueError, detz.load_zone, '../etc/passwd')
+
+    def test_suffix_offsets(self):
+        self.assertEqual(detz.suffix_offsets(['', '+00:00', '.25Z', '-0500', '+05:30', 'x']),
+                         [0, 0, 0, -18000, 19800, None])
+
+@unittest.skipUnless(detz.zone_path(NEW_YORK), 'No tz database')
+class BinningTest(unittest.TestCase):
+
+    def test_skipped_hours(self):
+        self.assertEqual(detz.skipped_hours(NEW_YORK, '2012-03-01T00', '2012-12-31T23'), ['2012-03-11T02'])
+        self.assertEqual(detz.skipped_hours(NEW_YORK, '2012-04-01T00', '2012-12-31T23'), [])
+
+    def test_local_hour_ids(self):
+        naive = np.array(['2012-03-11T06:30:00', '2012-03-11T07:30:00', '2012-03-11T03:30:00', '2012-03-11T12:00:00'],
+                         dtype='datetime64[s]')
+        ids, valid = detz.local_hour_ids(NEW_YORK, naive, ['+00:00', 'Z', '-04:00', 'bad'])
+        self.assertEqual(valid.tolist(), [True, True, True, False])
+        # Local time jumps from 01:59 EST to 03:00 EDT
+        self.assertEqual(ids.tolist(), ['2012-03-11T01', '2012-03-11T03', '2012-03-11T03'])
+
+    def test_repeated_hour(self):
+        # 01:xx happens twice as clocks move back, both are binned in the same hour
+        naive = np.array(['2012-11-04T05:30:00', '2012-11-04T06:30:00'], dtype='datetime64[s]')
+        ids, valid = detz.local_hour_ids(NEW_YORK, naive, ['', ''])
+        self.assertEqual(ids.tolist(), ['2012-11-04T01', '2012-11-04T01'])
+
+    def test_datetimes_to_dict(self):
+        logins = [u'2012-03-01T00:05:55+00:00', u'2012-03-01T04:59:59+00:00', u'2012-03-01T05:00:00+00:00',
+                  u'2012-03-01T00:10:00-05:00', u'2012-03-01Tbad']
+        self.assertEqual(defo.datetimes_to_dict(logins, NEW_YORK),
+                         {'2012-02-29T19': ['2012-02-29T19'], '2012-02-29T23': ['2012-02-29T23'],
+                          '2012-03-01T00': ['2012-03-01T00']*2})
+        # Without a zone the offsets are ignored
+        self.assertEqual(sorted(defo.datetimes_to_dict(logins[0:4])),
+                         ['2012-03-01T00', '2012-03-01T04', '2012-03-01T05'])
+
+@unittest.skipUnless(detz.zone_path(NEW_YORK), 'No tz database')
+class RegionTimezoneTest(TempDatabaseTestCase):
+
+    def setUp(self):
+        TempDatabaseTestCase.setUp(self)
+        app.config['REGION_TIMEZONES'] = {'nyc': NEW_YORK}
+
+    def history_ids(self, region):
+        db = dbh.connect_db(region)
+        try:
+            return [tuple(x) for x in db.execute('SELECT id, num_logins FROM login_history ORDER BY id')]
+        finally:
+            db.close()
+
+    def test_local_history(self):
+        logins = ['2012-03-11T06:30:00+00:00', '2012-03-11T07:30:00+00:00', '2012-03-11T07:45:00+00:00']
+        self.assertEqual(self.post_json('/api/nyc/demand', logins)[0], 201)
+        self.assertEqual(self.post_json('/api/demand', logins)[0], 201)
+        self.assertEqual(self.history_ids('nyc'), [('2012-03-11T01', 1), ('2012-03-11T03', 2)])
+        self.assertEqual(self.history_ids(None), [('2012-03-11T06', 1), ('2012-03-11T07', 2)])
+
+    def test_timezone_changed(self):
+        self.post_json('/api/nyc/demand', ['2012-03-11T06:30:00+00:00'])
+        app.config['REGION_TIMEZONES'] = {'nyc': 'Europe/London'}
+        status, response = self.post_json('/api/nyc/demand', ['2012-03-11T07:30:00+00:00'])
+        self.assertEqual(status, 400)
+        self.assertEqual(response['timezone'], NEW_YORK)
+        self.assertEqual(self.history_ids('nyc'), [('2012-03-11T01', 1)])
+
+if __name__ == '__main__':
+    unittest.main()